@@ -1,74 +1,357 @@
 # @cursor start
 import os
+import json
+import time
+import logging
+import asyncio
+import queue
+import threading
+import httpx
 import requests
-from config import AI_PROVIDER, AI_API_URL, AI_API_KEY, AI_MODEL
+from config import (
+    AI_POOL_SIZE, AI_CONNECT_TIMEOUT, AI_READ_TIMEOUT,
+    AI_CONCURRENCY, AI_STREAM, AI_MAX_TOKENS, AI_MAX_ATTEMPTS
+)
+from http_session import create_session
+from metrics import record_http, record_tokens, LLM_FAILOVERS
+from tracing import span, event
+from prompt_planner import estimate_tokens
+from provider_pool import get_shared_pool, parse_retry_after, RETRYABLE_STATUS
+
+logger = logging.getLogger(__name__)
 
 class AIClient:
-    """通用AI大模型客户端，支持任意厂商（简化版）"""
-    def __init__(self):
-        pass
+    """通用AI大模型客户端，支持任意厂商；配置多个端点时按健康状态路由并自动故障切换"""
+    def __init__(self, pool=None):
+        # 共享连接池，超时避免AI接口挂起时阻塞审查线程
+        self.session = create_session(AI_POOL_SIZE, backend="llm")
+        self.timeout = (AI_CONNECT_TIMEOUT, AI_READ_TIMEOUT)
+        self.pool = pool if pool is not None else get_shared_pool()
 
-    def review_code(self, code_changes):
+    def build_prompt(self, code_changes, template=True):
+        """将代码变更填入审查提示词；template为False时原样发送（如行内评论等自带格式要求的提示词）"""
+        if not template:
+            return code_changes
         from config import REVIEW_PROMPT
-        
-        # 通用API调用逻辑
-        prompt = REVIEW_PROMPT.format(code_changes=code_changes)
-        headers = {
-            "Authorization": f"Bearer {AI_API_KEY}",
+        return REVIEW_PROMPT.format(code_changes=code_changes)
+
+    def _build_headers(self, endpoint):
+        return {
+            "Authorization": f"Bearer {endpoint.api_key}",
             "Content-Type": "application/json"
         }
-        
-        # 根据AI_PROVIDER自动适配API格式
-        data = self._build_api_request_data(prompt)
-        
-        print(f"🔍 调试信息:")
-        print(f"   Provider: {AI_PROVIDER}")
-        print(f"   API URL: {AI_API_URL}")
-        print(f"   Model: {AI_MODEL}")
-        
-        response = requests.post(AI_API_URL, headers=headers, json=data)
-        
-        if response.status_code != 200:
-            print(f"❌ API请求失败:")
-            print(f"   状态码: {response.status_code}")
-            print(f"   响应内容: {response.text}")
-        
-        response.raise_for_status()
-        
-        # 根据AI_PROVIDER解析响应
-        return self._parse_api_response(response.json())
-
-    def _build_api_request_data(self, prompt):
-        """根据AI_PROVIDER构建API请求数据"""
-        if AI_PROVIDER == "aliyun":
+
+    def review_code(self, code_changes, template=True):
+        """审查单个提示词；超时、5xx、429时换端点重试，最多尝试AI_MAX_ATTEMPTS次"""
+        prompt = self.build_prompt(code_changes, template)
+        tried = []
+        for attempt in range(1, AI_MAX_ATTEMPTS + 1):
+            endpoint, delay = self.pool.acquire(tried)
+            if delay:
+                time.sleep(delay)
+            start = time.perf_counter()
+            try:
+                result = self._request(endpoint, prompt, attempt)
+            except Exception as e:
+                reason, retry_after = _failure_reason(e)
+                self.pool.release(endpoint, failure=reason, retry_after=retry_after)
+                if reason is None or attempt == AI_MAX_ATTEMPTS:
+                    raise
+                self._record_failover(endpoint, reason, attempt)
+                tried.append(endpoint.name)
+                continue
+            self.pool.release(endpoint, latency=time.perf_counter() - start)
+            return result
+
+    def _request(self, endpoint, prompt, attempt=1):
+        """向指定端点发送一次非流式请求"""
+        headers = self._build_headers(endpoint)
+        # 根据端点的provider自动适配API格式
+        data = self._build_api_request_data(prompt, endpoint)
+
+        with span('llm review', provider=endpoint.provider, endpoint=endpoint.name, model=endpoint.model,
+                  stream=False, attempt=attempt) as item:
+            logger.debug(f"AI请求: endpoint={endpoint.name} url={endpoint.url} model={endpoint.model}")
+            response = self.session.post(endpoint.url, headers=headers, json=data, timeout=self.timeout)
+
+            if response.status_code != 200:
+                logger.error(f"AI API请求失败({endpoint.name}): {response.status_code} {response.text[:200]}")
+
+            response.raise_for_status()
+
+            # 根据端点的provider解析响应
+            response_json = response.json()
+            result = self._parse_api_response(response_json, endpoint)
+            item.set(**self._record_usage(endpoint, prompt, result, self._parse_usage(response_json, endpoint)))
+            return result
+
+    def _record_failover(self, endpoint, reason, attempt):
+        logger.warning(f"AI端点 {endpoint.name} 请求失败（{reason}），第 {attempt} 次尝试后切换端点重试")
+        LLM_FAILOVERS.inc(endpoint=endpoint.name, reason=reason)
+        event('failover', endpoint=endpoint.name, reason=reason, attempt=attempt)
+
+    def _build_api_request_data(self, prompt, endpoint):
+        """根据端点的provider构建API请求数据"""
+        if endpoint.provider == "aliyun":
             # 阿里云通义千问格式
             return {
-                "model": AI_MODEL,
+                "model": endpoint.model,
                 "input": {
                     "prompt": prompt
                 },
                 "parameters": {
-                    "result_format": "message"
+                    "result_format": "message",
+                    "max_tokens": AI_MAX_TOKENS
                 }
             }
         else:
             # 默认OpenAI兼容格式（适用于siliconflow, openai, deepseek等）
             return {
-                "model": AI_MODEL,
+                "model": endpoint.model,
                 "messages": [
                     {"role": "system", "content": "你是一位资深的代码审查专家。"},
                     {"role": "user", "content": prompt}
                 ],
-                "max_tokens": 2000,
+                "max_tokens": AI_MAX_TOKENS,
                 "temperature": 0.3
             }
 
-    def _parse_api_response(self, response_json):
-        """根据AI_PROVIDER解析API响应"""
-        if AI_PROVIDER == "aliyun":
+    def _parse_api_response(self, response_json, endpoint):
+        """根据端点的provider解析API响应"""
+        if endpoint.provider == "aliyun":
             return response_json["output"]["text"]
         else:
             # 默认OpenAI兼容格式
             return response_json["choices"][0]["message"]["content"]
 
-# @cursor end 
\ No newline at end of file
+    def _parse_usage(self, response_json, endpoint):
+        """根据端点的provider解析token用量，返回 (prompt_tokens, completion_tokens)，没有时返回None"""
+        usage = response_json.get("usage") or {}
+        if endpoint.provider == "aliyun":
+            prompt_tokens, completion_tokens = usage.get("input_tokens"), usage.get("output_tokens")
+        else:
+            prompt_tokens, completion_tokens = usage.get("prompt_tokens"), usage.get("completion_tokens")
+        if prompt_tokens is None or completion_tokens is None:
+            return None
+        return prompt_tokens, completion_tokens
+
+    def _record_usage(self, endpoint, prompt, result, usage):
+        """记录token用量指标（按端点统计），接口未返回用量时按文本估算；返回用于span的用量属性"""
+        estimated = usage is None
+        if estimated:
+            usage = (estimate_tokens(prompt), estimate_tokens(result))
+        record_tokens(endpoint.name, *usage)
+        return {'prompt_tokens': usage[0], 'completion_tokens': usage[1], 'tokens_estimated': estimated}
+
+    def _enable_stream(self, data, headers, endpoint):
+        """根据端点的provider开启SSE流式输出"""
+        if endpoint.provider == "aliyun":
+            headers["X-DashScope-SSE"] = "enable"
+            data["parameters"]["incremental_output"] = True
+        else:
+            data["stream"] = True
+
+    def _parse_stream_chunk(self, chunk_json, endpoint):
+        """根据端点的provider解析SSE增量数据，返回本次新增文本"""
+        if endpoint.provider == "aliyun":
+            output = chunk_json.get("output", {})
+            if output.get("text") is not None:
+                return output["text"]
+            choices = output.get("choices") or [{}]
+            return (choices[0].get("message") or {}).get("content") or ""
+        choices = chunk_json.get("choices") or [{}]
+        return (choices[0].get("delta") or {}).get("content") or ""
+
+
+def _failure_reason(error):
+    """判断失败是否应换端点重试：返回 (原因, Retry-After秒数)，不应重试时原因为None"""
+    if isinstance(error, (requests.HTTPError, httpx.HTTPStatusError)):
+        response = error.response
+        if response is not None and response.status_code in RETRYABLE_STATUS:
+            return response.status_code, parse_retry_after(response.headers.get('Retry-After'))
+        return None, None
+    if isinstance(error, (requests.Timeout, requests.ConnectionError, httpx.TransportError)):
+        return type(error).__name__, None
+    return None, None
+
+
+class AsyncAIClient(AIClient):
+    """
+    基于asyncio的AI客户端：支持SSE流式响应，多个提示词有界并发请求
+
+    所有审查共用一个后台事件循环和长连接的httpx.AsyncClient，concurrency是整个实例的并发上限
+    （应用每个进程只创建一个实例，即进程内所有并行审查合计的AI请求数）
+    """
+    def __init__(self, concurrency=AI_CONCURRENCY, stream=AI_STREAM, pool=None):
+        super().__init__(pool)
+        self.concurrency = max(1, concurrency)
+        self.stream = stream
+        self.async_timeout = httpx.Timeout(AI_READ_TIMEOUT, connect=AI_CONNECT_TIMEOUT)
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        self._client = None
+        self._semaphore = None
+
+    def _get_loop(self):
+        """后台事件循环在首次审查时启动（gunicorn fork之后），之后一直复用"""
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="ai-client-loop", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def _get_client(self):
+        """在后台事件循环中调用：返回共享的 (AsyncClient, 并发信号量)"""
+        if self._client is None:
+            limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+            self._client = httpx.AsyncClient(timeout=self.async_timeout, limits=limits)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._client, self._semaphore
+
+    async def review_code_async(self, client, code_changes, on_delta=None, template=True):
+        """
+        异步审查单个提示词，流式模式下每收到一段文本调用on_delta(text)；template含义同review_code
+
+        超时、5xx、429时换端点重试；流式响应已输出部分文本后失败则不再重试，避免重复输出
+        """
+        prompt = self.build_prompt(code_changes, template)
+        tried = []
+        for attempt in range(1, AI_MAX_ATTEMPTS + 1):
+            endpoint, delay = await self.pool.acquire_async(tried)
+            if delay:
+                await asyncio.sleep(delay)
+            emitted = []
+
+            def forward(text):
+                emitted.append(len(text))
+                if on_delta:
+                    on_delta(text)
+            try:
+                result, latency = await self._request_async(client, endpoint, prompt, forward, attempt)
+            except Exception as e:
+                reason, retry_after = _failure_reason(e)
+                self.pool.release(endpoint, failure=reason, retry_after=retry_after)
+                if reason is None or emitted or attempt == AI_MAX_ATTEMPTS:
+                    raise
+                self._record_failover(endpoint, reason, attempt)
+                tried.append(endpoint.name)
+                continue
+            self.pool.release(endpoint, latency=latency)
+            return result
+
+    async def _request_async(self, client, endpoint, prompt, on_delta, attempt=1):
+        """向指定端点发送一次请求，返回 (结果, 用于路由的延迟)；流式请求的延迟为首字延迟"""
+        headers = self._build_headers(endpoint)
+        data = self._build_api_request_data(prompt, endpoint)
+        with span('llm review', provider=endpoint.provider, endpoint=endpoint.name, model=endpoint.model,
+                  stream=self.stream, attempt=attempt) as item:
+            start = time.perf_counter()
+            if not self.stream:
+                try:
+                    response = await client.post(endpoint.url, headers=headers, json=data)
+                except httpx.HTTPError as e:
+                    record_http('llm', type(e).__name__, time.perf_counter() - start)
+                    raise
+                elapsed = time.perf_counter() - start
+                record_http('llm', response.status_code, elapsed)
+                item.set(status=response.status_code, response_bytes=len(response.content))
+                if response.status_code != 200:
+                    logger.error(f"AI API请求失败({endpoint.name}): {response.status_code} {response.text[:200]}")
+                response.raise_for_status()
+                response_json = response.json()
+                result = self._parse_api_response(response_json, endpoint)
+                item.set(**self._record_usage(endpoint, prompt, result, self._parse_usage(response_json, endpoint)))
+                return result, elapsed
+
+            self._enable_stream(data, headers, endpoint)
+            parts = []
+            usage = None
+            # 首个增量到达时间
+            first_delta_at = None
+            try:
+                async with client.stream("POST", endpoint.url, headers=headers, json=data) as response:
+                    item.set(status=response.status_code)
+                    if response.status_code != 200:
+                        await response.aread()
+                        logger.error(f"AI API流式请求失败({endpoint.name}): "
+                                     f"{response.status_code} {response.text[:200]}")
+                        record_http('llm', response.status_code, time.perf_counter() - start)
+                        response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[5:].strip()
+                        if payload == "[DONE]":
+                            break
+                        if not payload:
+                            continue
+                        chunk_json = json.loads(payload)
+                        # 部分提供商在最后的增量中返回用量（阿里云每段返回累计用量）
+                        usage = self._parse_usage(chunk_json, endpoint) or usage
+                        delta = self._parse_stream_chunk(chunk_json, endpoint)
+                        if delta:
+                            if first_delta_at is None:
+                                first_delta_at = time.perf_counter()
+                            parts.append(delta)
+                            on_delta(delta)
+            except httpx.TransportError as e:
+                record_http('llm', type(e).__name__, time.perf_counter() - start)
+                raise
+            elapsed = time.perf_counter() - start
+            record_http('llm', response.status_code, elapsed)
+            result = "".join(parts)
+            item.set(
+                response_bytes=len(result.encode('utf-8')),
+                first_token_ms=round((first_delta_at - start) * 1000, 1) if first_delta_at else None,
+                **self._record_usage(endpoint, prompt, result, usage)
+            )
+            return result, (first_delta_at - start) if first_delta_at else elapsed
+
+    async def review_many_async(self, code_changes_list, on_delta=None, on_result=None, template=True):
+        """
+        有界并发审查多个提示词，返回与输入顺序一致的结果列表（失败项为异常对象）
+        on_result(index, result) 在每个提示词完成时调用（失败时result为异常对象）
+        须在后台事件循环中运行（由review_many提交），与其他审查共享连接和并发上限
+        """
+        client, semaphore = self._get_client()
+
+        async def run(index, code_changes):
+            async with semaphore:
+                callback = (lambda text: on_delta(index, text)) if on_delta else None
+                try:
+                    result = await self.review_code_async(client, code_changes, callback, template)
+                except Exception as e:
+                    result = e
+            if on_result:
+                on_result(index, result)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return await asyncio.gather(
+            *(run(i, c) for i, c in enumerate(code_changes_list)), return_exceptions=True
+        )
+
+    def review_many(self, code_changes_list, on_delta=None, on_result=None, template=True):
+        """
+        同步入口（供审查工作线程调用）：on_delta(index, text)接收流式增量，on_result(index, result)接收单个结果
+        回调在调用线程中执行（如发布进度评论），不阻塞其他审查共用的事件循环
+        """
+        events = queue.Queue()
+        relay = lambda callback: (lambda *args: events.put((callback, args))) if callback else None
+        future = asyncio.run_coroutine_threadsafe(
+            self.review_many_async(code_changes_list, relay(on_delta), relay(on_result), template), self._get_loop()
+        )
+        future.add_done_callback(lambda _: events.put(None))
+        while True:
+            item = events.get()
+            if item is None:
+                break
+            callback, args = item
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error(f"审查结果回调失败: {e}")
+        return future.result()
+
+# @cursor end
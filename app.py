@@ -1,11 +1,17 @@
 # @cursor start
 import json
+import re
 import logging
-from flask import Flask, request, jsonify
-from gitlab_client import GitLabClient
-from ai_client import AIClient
-from code_reviewer import CodeReviewer
-from config import HOST, PORT, REVIEW_TRIGGER_KEYWORDS
+import threading
+from flask import Flask, Response, request, jsonify
+from git_mirror import create_gitlab_client
+from ai_client import AsyncAIClient
+from code_reviewer import CodeReviewer, REVIEW_FAILED_PREFIX
+from review_queue import ReviewQueue, ReviewScheduler, QueueFullError
+from metrics import REGISTRY, STAGE_SECONDS, QUEUE_JOBS, CACHE_HITS, CACHE_MISSES, LLM_ENDPOINT_UP
+from tracing import trace, span
+from progress_note import ProgressNote
+from config import HOST, PORT, DEBUG, REVIEW_TRIGGER_KEYWORDS
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -15,14 +21,202 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 
 # 初始化客户端
-gitlab_client = GitLabClient()
-ai_client = AIClient()
+gitlab_client = create_gitlab_client()
+ai_client = AsyncAIClient()
 code_reviewer = CodeReviewer(gitlab_client, ai_client)
 
+# 最终评论标题（按触发方式区分）
+FINAL_COMMENT_TITLES = {
+    'merge_request': '🤖 **AI智能分析完成**',
+    'note': '🤖 **AI智能分析完成** (由评论触发)'
+}
+
+# 审查进行中时原地更新的进度评论（避免使用触发关键词）
+PROGRESS_COMMENT = """🤖 **AI代码审查机器人**
+
+⏳ 审查进行中：已完成 {done}/{total} 个审查分块，以下为已完成文件的结果，全部完成后本评论将更新为最终结果。
+
+{result}
+
+---
+*由AI代码审查机器人自动生成*"""
+
+# 开始审查时发布的处理中评论（避免使用触发关键词），审查过程中原地更新进度和最终结果
+PROCESSING_COMMENT = """🤖 **AI代码审查机器人**
+
+⏳ 正在处理智能分析请求...
+
+**处理步骤：**
+1. 📋 分析代码变更
+2. 🔍 获取相关上下文
+3. 🤖 AI智能分析
+4. 💬 生成详细建议
+
+请稍候，已完成的文件会陆续更新到本评论。"""
+
+# 评论触发时的处理中评论
+TRIGGERED_PROCESSING_COMMENT = """🤖 **AI代码审查机器人**
+
+✅ 检测到触发关键词: `{note_body}`
+⏳ 正在启动智能分析...
+
+**处理步骤：**
+1. 📋 分析代码变更
+2. 🔍 获取相关上下文  
+3. 🤖 AI智能分析
+4. 💬 生成详细建议
+
+请稍候，已完成的文件会陆续更新到本评论。"""
+
+# 队列已满、任务被拒绝时的提示
+BUSY_COMMENT = """🤖 **AI代码审查机器人**
+
+⚠️ 当前待审查任务过多，本次请求未能加入队列，请稍后重新触发。"""
+
+class ReviewFailedError(Exception):
+    """审查失败（结果已发布，但不可被后续触发复用）"""
+
+def run_review_job(job):
+    """执行队列中的审查任务并发布最终评论（整个任务记录为一次追踪）"""
+    with trace(f"job-{job['id']}", project_id=job['project_id'], mr_iid=job['mr_iid'],
+               trigger=job['trigger'], head_sha=job.get('head_sha')):
+        return _run_review_job(job)
+
+def _run_review_job(job):
+    project_id = job['project_id']
+    mr_iid = job['mr_iid']
+    progress_note = None
+    if job.get('reused_result') is not None:
+        # 同一head_sha已审查（或正在审查）过，直接投递已有结果
+        review_result = job['reused_result']
+        logger.info(f"MR #{mr_iid} head_sha {job.get('head_sha')} 复用已有审查结果")
+    else:
+        # 处理中评论在工作线程开始审查时发布（webhook不调用GitLab接口，保证及时响应），
+        # 评论ID写入任务，任务被恢复重试时继续使用同一条评论
+        note_id = job['payload'].get('note_id')
+        if note_id is None:
+            note_id = post_status_comment(project_id, mr_iid, processing_comment_for(job))
+            if note_id is not None:
+                review_queue.update_payload(job['id'], dict(job['payload'], note_id=note_id))
+        progress = None
+        if note_id is not None:
+            progress_note = ProgressNote(gitlab_client, project_id, mr_iid, note_id)
+            progress = lambda text, done, total: progress_note.update(
+                PROGRESS_COMMENT.format(done=done, total=total, result=text)
+            )
+        review_result = code_reviewer.review_merge_request(project_id, mr_iid, progress)
+    
+    # 最终审查结果（避免使用触发关键词）
+    final_comment = f"""{FINAL_COMMENT_TITLES.get(job['trigger'], FINAL_COMMENT_TITLES['merge_request'])}
+
+{review_result}
+
+---
+*由AI代码审查机器人自动生成*"""
+    
+    try:
+        with STAGE_SECONDS.time(stage='summary_posting'), span('summary_posting'):
+            if progress_note:
+                progress_note.finish(final_comment)
+            else:
+                gitlab_client.add_comment(project_id, mr_iid, final_comment)
+        logger.info(f"审查完成，已发布最终评论到 MR #{mr_iid}")
+    except Exception as e:
+        logger.error(f"发布最终评论失败: {e}")
+    if review_result.startswith(REVIEW_FAILED_PREFIX):
+        raise ReviewFailedError(review_result)
+    return review_result
+
+def processing_comment_for(job):
+    """任务对应的处理中评论内容"""
+    if job['trigger'] == 'note':
+        return TRIGGERED_PROCESSING_COMMENT.format(note_body=job['payload'].get('note_body', ''))
+    return PROCESSING_COMMENT
+
+def get_head_sha(webhook_data):
+    """
+    从webhook数据中获取MR当前head_sha，用于合并重复的审查任务
+    不请求GitLab接口（webhook需在GitLab超时前响应）；数据中没有时返回None，不进行任务合并
+    """
+    merge_request = webhook_data.get('merge_request') or webhook_data.get('object_attributes') or {}
+    head_sha = (merge_request.get('last_commit') or {}).get('id')
+    if not head_sha:
+        logger.warning("webhook数据中没有head_sha，不进行任务合并")
+    return head_sha
+
+# 任务合并方式对应的响应说明
+SUBMIT_MESSAGES = {
+    'queued': '审查已启动，正在处理中...',
+    'attached': '相同提交的审查正在进行，已合并到该任务',
+    'reused': '相同提交已审查过，将直接复用审查结果'
+}
+
+# 需要处理的webhook事件（X-Gitlab-Event请求头），其余事件不解析请求体直接忽略
+HANDLED_EVENTS = {
+    'Merge Request Hook': 'merge_request',
+    'Note Hook': 'note'
+}
+
+# 触发关键词的原始字节形式（含JSON转义形式），用于在解析前快速过滤评论事件
+TRIGGER_KEYWORD_BYTES = tuple({
+    form
+    for keyword in REVIEW_TRIGGER_KEYWORDS
+    for form in (keyword.lower().encode('utf-8'), json.dumps(keyword.lower()).strip('"').encode('ascii'))
+})
+
+# 打开/重新打开MR的 "action" 字段（MR事件中只有object_attributes含action），更新、审批等动作在解析前过滤
+MERGE_REQUEST_OPEN_ACTION_BYTES = re.compile(rb'"action"\s*:\s*"(?:open|reopen)"')
+
+def prefilter_webhook(event, body):
+    """
+    根据X-Gitlab-Event请求头和原始请求体快速判断是否可以忽略（不解析JSON）
+    返回忽略原因，需要完整处理时返回None；只过滤确定无需处理的事件
+    """
+    if not event:
+        return None  # 没有事件头（如手工调用）时走完整解析
+    kind = HANDLED_EVENTS.get(event)
+    if kind is None:
+        return f'不支持的事件类型: {event}'
+    if kind == 'merge_request' and not MERGE_REQUEST_OPEN_ACTION_BYTES.search(body):
+        return '不是Merge Request打开事件'
+    if kind == 'note':
+        lowered = body.lower()
+        if not any(keyword in lowered for keyword in TRIGGER_KEYWORD_BYTES):
+            return '评论不包含触发关键词'
+    return None
+
+# 审查任务队列与有界工作线程池
+review_queue = ReviewQueue()
+review_scheduler = ReviewScheduler(review_queue, run_review_job)
+review_scheduler.start()
+
+def _cache_stats(attribute):
+    """采集各缓存的命中/未命中次数"""
+    caches = {
+        'review_result': code_reviewer.review_cache,
+        'file_content': code_reviewer.file_cache.memory,
+        'file_content_disk': code_reviewer.file_cache.disk
+    }
+    return {(name,): getattr(cache, attribute) for name, cache in caches.items() if cache is not None}
+
+# 采集时读取的指标：队列深度（所有进程共享同一个队列）、缓存命中情况与AI端点熔断状态
+QUEUE_JOBS.set_function(lambda: {(status,): count for status, count in review_queue.stats().items()})
+CACHE_HITS.set_function(lambda: _cache_stats('hits'))
+CACHE_MISSES.set_function(lambda: _cache_stats('misses'))
+LLM_ENDPOINT_UP.set_function(
+    lambda: {(endpoint['name'],): int(endpoint['state'] != 'open') for endpoint in ai_client.pool.status()}
+)
+REGISTRY.start_flusher()
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """处理GitLab webhook请求"""
     try:
+        # 快速过滤：大部分事件无需处理，不解析请求体直接返回
+        ignored_reason = prefilter_webhook(request.headers.get('X-Gitlab-Event'), request.get_data(cache=True))
+        if ignored_reason:
+            return jsonify({'status': 'ignored', 'message': ignored_reason}), 200
+        
         # 解析webhook数据
         webhook_data = request.get_json()
         object_kind = webhook_data.get('object_kind', 'unknown')
@@ -73,6 +267,25 @@ def is_bot_comment(webhook_data):
         logger.error(f"检查机器人评论失败: {e}")
         return False
 
+def post_status_comment(project_id, mr_iid, body):
+    """发布处理中评论，返回评论ID；发布失败时返回None（最终结果改为发布新评论）"""
+    try:
+        note = gitlab_client.add_comment(project_id, mr_iid, body)
+        logger.info(f"已添加处理中评论到 MR #{mr_iid}")
+        return note.get('id')
+    except Exception as e:
+        logger.error(f"添加处理中评论失败: {e}")
+        return None
+
+def post_busy_comment(project_id, mr_iid):
+    """任务被拒绝时在后台发布繁忙提示，不阻塞webhook响应"""
+    def post():
+        try:
+            gitlab_client.add_comment(project_id, mr_iid, BUSY_COMMENT)
+        except Exception as e:
+            logger.error(f"发布繁忙提示失败: {e}")
+    threading.Thread(target=post, name="busy-comment", daemon=True).start()
+
 def handle_merge_request_event(webhook_data):
     """处理Merge Request事件（优化版）"""
     # 检查是否是打开事件
@@ -85,44 +298,17 @@ def handle_merge_request_event(webhook_data):
     
     logger.info(f"开始审查 MR #{mr_iid} in project {project_id}")
     
-    # 立即添加处理中的评论（避免使用触发关键词）
-    processing_comment = """🤖 **AI代码审查机器人**
-
-⏳ 正在处理智能分析请求...
-
-**处理步骤：**
-1. 📋 分析代码变更
-2. 🔍 获取相关上下文
-3. 🤖 AI智能分析
-4. 💬 生成详细建议
-
-请稍候，分析结果将在几分钟内完成。"""
-    
+    # 审查任务入队（相同head_sha的任务会被合并），队列满时直接拒绝；处理中评论由工作线程发布
     try:
-        gitlab_client.add_comment(project_id, mr_iid, processing_comment)
-        logger.info(f"已添加处理中评论到 MR #{mr_iid}")
-    except Exception as e:
-        logger.error(f"添加处理中评论失败: {e}")
+        _, mode = review_scheduler.submit(
+            project_id, mr_iid, 'merge_request', {}, head_sha=get_head_sha(webhook_data)
+        )
+    except QueueFullError as e:
+        logger.warning(f"审查任务被拒绝: {e}")
+        post_busy_comment(project_id, mr_iid)
+        return jsonify({'status': 'busy', 'message': str(e)}), 429
     
-    # 异步执行代码审查
-    def review_callback(review_result):
-        try:
-            # 添加最终审查结果评论（避免使用触发关键词）
-            final_comment = f"""🤖 **AI智能分析完成**
-
-{review_result}
-
----
-*由AI代码审查机器人自动生成*"""
-            
-            gitlab_client.add_comment(project_id, mr_iid, final_comment)
-            logger.info(f"审查完成，已添加最终评论到 MR #{mr_iid}")
-        except Exception as e:
-            logger.error(f"添加最终评论失败: {e}")
-    
-    code_reviewer.review_merge_request_async(project_id, mr_iid, review_callback)
-    
-    return jsonify({'status': 'success', 'message': '审查已启动，正在处理中...'}), 200
+    return jsonify({'status': 'success', 'mode': mode, 'message': SUBMIT_MESSAGES[mode]}), 200
 
 def handle_note_event(webhook_data):
     """处理评论事件（优化版）"""
@@ -151,54 +337,36 @@ def handle_note_event(webhook_data):
         
         logger.info(f"评论触发审查: MR #{mr_iid}, 评论ID: {comment_id}, 内容: {note_body}")
         
-        # 立即回复触发确认（避免使用触发关键词）
-        trigger_comment = f"""🤖 **AI代码审查机器人**
-
-✅ 检测到触发关键词: `{note_body}`
-⏳ 正在启动智能分析...
-
-**处理步骤：**
-1. 📋 分析代码变更
-2. 🔍 获取相关上下文  
-3. 🤖 AI智能分析
-4. 💬 生成详细建议
-
-请稍候，分析结果将在几分钟内完成。"""
-        
+        # 审查任务入队（相同head_sha进行中的任务会被合并），队列满时直接拒绝；触发确认评论由工作线程发布
         try:
-            gitlab_client.add_comment(project_id, mr_iid, trigger_comment)
-            logger.info(f"已添加触发确认评论到 MR #{mr_iid}")
-        except Exception as e:
-            logger.error(f"添加触发确认评论失败: {e}")
+            _, mode = review_scheduler.submit(
+                project_id, mr_iid, 'note', {'comment_id': comment_id, 'note_body': note_body},
+                head_sha=get_head_sha(webhook_data), reuse=False  # 手动触发：重新审查，不复用已有结果
+            )
+        except QueueFullError as e:
+            logger.warning(f"审查任务被拒绝: {e}")
+            post_busy_comment(project_id, mr_iid)
+            return jsonify({'status': 'busy', 'message': str(e)}), 429
         
-        # 异步执行代码审查
-        def review_callback(review_result):
-            try:
-                # 添加最终审查结果评论（避免使用触发关键词）
-                final_comment = f"""🤖 **AI智能分析完成** (由评论触发)
-
-{review_result}
-
----
-*由AI代码审查机器人自动生成*"""
-                
-                gitlab_client.add_comment(project_id, mr_iid, final_comment)
-                logger.info(f"评论触发审查完成，已添加最终评论到 MR #{mr_iid}")
-            except Exception as e:
-                logger.error(f"添加最终评论失败: {e}")
-        
-        code_reviewer.review_merge_request_async(project_id, mr_iid, review_callback)
-        
-        return jsonify({'status': 'success', 'message': '评论触发审查已启动，正在处理中...'}), 200
+        return jsonify({'status': 'success', 'mode': mode, 'message': SUBMIT_MESSAGES[mode]}), 200
         
     except Exception as e:
         logger.error(f"处理评论事件失败: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus格式指标"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """健康检查接口"""
-    return jsonify({'status': 'healthy', 'message': 'AI代码审查服务运行正常'}), 200
+    """健康检查接口（附带各AI端点的熔断状态、延迟和错误率）"""
+    return jsonify({
+        'status': 'healthy',
+        'message': 'AI代码审查服务运行正常',
+        'ai_endpoints': ai_client.pool.status()
+    }), 200
 
 @app.route('/', methods=['GET'])
 def index():
@@ -216,7 +384,8 @@ def index():
         ],
         'endpoints': {
             'webhook': '/webhook',
-            'health': '/health'
+            'health': '/health',
+            'metrics': '/metrics'
         }
     }), 200
 
@@ -232,6 +401,8 @@ def handle_error(error):
     }), error.code
 
 if __name__ == '__main__':
-    logger.info(f"启动AI代码审查服务（性能优化版），监听 {HOST}:{PORT}")
-    app.run(host=HOST, port=PORT, debug=True)
+    # 开发模式：Flask开发服务器（生产环境请使用 start.sh 以gunicorn多进程方式运行）
+    logger.info(f"启动AI代码审查服务（开发模式），监听 {HOST}:{PORT}")
+    # 关闭自动重载，避免重载进程重复启动审查工作线程
+    app.run(host=HOST, port=PORT, debug=DEBUG, use_reloader=False, threaded=True)
 # @cursor end 
\ No newline at end of file
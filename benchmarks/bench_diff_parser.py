@@ -0,0 +1,147 @@
+# @cursor start
+"""
+diff解析基准：对比旧版（每次审查解析3次、每块字符串字典）与单次解析的 __slots__ 结构
+
+运行: python3 benchmarks/bench_diff_parser.py [--size-mb 4] [--repeat 3]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diff_parser import parse_diff  # noqa: E402
+
+
+def generate_diff(size_mb, seed=42):
+    """生成指定大小的diff文本（随机混合上下文、新增、删除行）"""
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+    parts = []
+    size = 0
+    old_no = new_no = 1
+    while size < target:
+        lines = []
+        old_count = new_count = 0
+        for _ in range(rng.randint(10, 60)):
+            kind = rng.choice(' ++-')
+            text = f"    value_{rng.randint(0, 10 ** 6)} = compute(value_{rng.randint(0, 10 ** 6)})"
+            lines.append(kind + text)
+            if kind != '+':
+                old_count += 1
+            if kind != '-':
+                new_count += 1
+        hunk = f"@@ -{old_no},{old_count} +{new_no},{new_count} @@\n" + '\n'.join(lines)
+        parts.append(hunk)
+        size += len(hunk) + 1
+        old_no += old_count + rng.randint(5, 50)
+        new_no += new_count + rng.randint(5, 50)
+    return '\n'.join(parts)
+
+
+def legacy_parse_diff(diff_content):
+    """旧版 CodeReviewer.parse_diff：每块构建字符串列表字典"""
+    added_lines, removed_lines, diff_blocks = [], [], []
+    block = {'old_start': 0, 'new_start': 0, 'old_lines': [], 'new_lines': [],
+             'old_line_numbers': [], 'new_line_numbers': [], 'context': []}
+    old_no = new_no = 0
+    for line in diff_content.split('\n'):
+        if line.startswith('@@'):
+            if block['old_lines'] or block['new_lines']:
+                diff_blocks.append(block)
+            match = re.match(r'^@@ -(\d+),?(\d+)? \+(\d+),?(\d+)? @@', line)
+            if match:
+                block = {'old_start': int(match.group(1)), 'new_start': int(match.group(3)),
+                         'old_lines': [], 'new_lines': [], 'old_line_numbers': [],
+                         'new_line_numbers': [], 'context': []}
+                old_no, new_no = block['old_start'], block['new_start']
+        elif line.startswith('+') and not line.startswith('+++'):
+            added_lines.append(line[1:])
+            block['new_lines'].append(line[1:])
+            block['new_line_numbers'].append(new_no)
+            new_no += 1
+        elif line.startswith('-') and not line.startswith('---'):
+            removed_lines.append(line[1:])
+            block['old_lines'].append(line[1:])
+            block['old_line_numbers'].append(old_no)
+            old_no += 1
+        elif line.startswith(' '):
+            block['context'].append(line[1:])
+            old_no += 1
+            new_no += 1
+    if block['old_lines'] or block['new_lines']:
+        diff_blocks.append(block)
+    return {'added': '\n'.join(added_lines), 'removed': '\n'.join(removed_lines),
+            'raw': diff_content, 'blocks': diff_blocks}
+
+
+def legacy_extract_diff_new_lines(diff_content):
+    """旧版 GitLabClient.extract_diff_new_lines"""
+    results = []
+    new_no = None
+    for line in diff_content.split('\n'):
+        if line.startswith('@@'):
+            m = re.match(r'@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@', line)
+            if m:
+                new_no = int(m.group(1))
+            continue
+        if line.startswith('+') and not line.startswith('+++'):
+            if new_no is not None:
+                results.append((new_no, line[1:]))
+                new_no += 1
+        elif line.startswith('-') and not line.startswith('---'):
+            continue
+        elif new_no is not None:
+            new_no += 1
+    return results
+
+
+def run_legacy(diff_content):
+    # 上下文格式化、行内评论生成、行内评论定位各解析一次，结果同时存活
+    return (legacy_parse_diff(diff_content), legacy_parse_diff(diff_content),
+            legacy_extract_diff_new_lines(diff_content))
+
+
+def run_single_pass(diff_content):
+    # 解析一次，各阶段共享同一结构
+    parsed = parse_diff(diff_content)
+    return parsed, parsed.added_line_numbers()
+
+
+def measure(func, diff_content, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(diff_content)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    result = func(diff_content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="diff解析基准")
+    parser.add_argument('--size-mb', type=float, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    diff_content = generate_diff(args.size_mb)
+    print(f"diff大小: {len(diff_content) / 1024 / 1024:.1f} MB, 行数: {diff_content.count(chr(10)) + 1}")
+    results = {
+        '旧版(3次解析)': measure(run_legacy, diff_content, args.repeat),
+        '单次解析': measure(run_single_pass, diff_content, args.repeat),
+    }
+    for name, (seconds, peak) in results.items():
+        print(f"{name:<12} 耗时 {seconds * 1000:8.1f} ms   峰值内存 {peak / 1024 / 1024:8.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
+# @cursor end
@@ -0,0 +1,284 @@
+# @cursor start
+"""
+端到端审查基准：启动本地GitLab/LLM替身服务（benchmarks/fake_servers.py），
+直接调用 CodeReviewer.review_merge_request（review场景）以及经 /webhook 入队由工作线程执行（webhook场景），
+统计吞吐量、p50/p99延迟、各接口调用次数和峰值内存
+
+结果追加到 benchmarks/results/<提交>.jsonl，用 --compare <提交> 与之前的结果对比
+
+运行: python3 benchmarks/bench_review.py [--scenario both] [--reviews 20] [--concurrency 4] [--files 20]
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_servers import add_arguments  # noqa: E402
+
+# 与替身服务共享的参数（原样传给 fake_servers.py）
+SERVER_ARGS = ('files', 'lines', 'hunk_size', 'hunk_gap', 'file_lines', 'gitlab_latency', 'llm_latency',
+               'llm_tokens_per_sec', 'error_rate', 'llm_error_rate', 'seed')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_fake_server(args, port):
+    """在子进程中启动替身服务，避免其CPU和内存计入被测进程"""
+    command = [sys.executable, os.path.join(BENCH_DIR, 'fake_servers.py'), '--port', str(port)]
+    for name in SERVER_ARGS:
+        command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("替身服务启动失败")
+
+
+def configure_environment(args, port, work_dir):
+    """被测模块在导入时读取配置，必须在导入前设置环境变量"""
+    base_url = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        'GITLAB_URL': base_url,
+        'GITLAB_TOKEN': 'bench-token',
+        'AI_PROVIDER': 'openai',
+        'AI_API_URL': f"{base_url}/v1/chat/completions",
+        'AI_API_KEY': 'bench-key',
+        'AI_STREAM': 'true' if args.stream else 'false',
+        'REVIEW_WORKERS': str(args.concurrency),
+        'REVIEW_QUEUE_DB': os.path.join(work_dir, 'review_queue.db'),
+        'REVIEW_CACHE_DB': os.path.join(work_dir, 'review_cache.db'),
+        'FILE_CACHE_DISK_DB': '',
+        'METRICS_DIR': '',
+        'TRACE_DIR': '',
+    })
+
+
+def fetch_stats(port):
+    import requests
+    return requests.get(f"http://127.0.0.1:{port}/__stats", timeout=5).json()
+
+
+def reset_stats(port):
+    import requests
+    requests.post(f"http://127.0.0.1:{port}/__reset", timeout=5)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def mr_iids(args, first_iid):
+    """每次审查使用不同的MR；--same-mr 时重复审查同一个MR（测量缓存命中）"""
+    if args.same_mr:
+        return [first_iid] * args.reviews
+    return list(range(first_iid, first_iid + args.reviews))
+
+
+def run_review_scenario(args, first_iid):
+    """并发直接调用 review_merge_request"""
+    from ai_client import AsyncAIClient
+    from code_reviewer import CodeReviewer, REVIEW_FAILED_PREFIX
+    from gitlab_client import GitLabClient
+
+    reviewer = CodeReviewer(GitLabClient(), AsyncAIClient())
+
+    def review(mr_iid):
+        start = time.perf_counter()
+        result = reviewer.review_merge_request(args.project_id, mr_iid)
+        return time.perf_counter() - start, result.startswith(REVIEW_FAILED_PREFIX)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        outcomes = list(executor.map(review, mr_iids(args, first_iid)))
+    elapsed = time.perf_counter() - started
+    return elapsed, [latency for latency, _ in outcomes], sum(1 for _, failed in outcomes if failed), {}
+
+
+def run_webhook_scenario(args, first_iid):
+    """经 /webhook 提交MR打开事件，等待工作线程处理完所有任务；延迟为入队到完成的时间"""
+    import app as webapp
+
+    client = webapp.app.test_client()
+    ingest_latencies = []
+    started = time.perf_counter()
+    for mr_iid in mr_iids(args, first_iid):
+        payload = {
+            'object_kind': 'merge_request',
+            'project': {'id': args.project_id},
+            'object_attributes': {'iid': mr_iid, 'state': 'opened', 'action': 'open',
+                                  'last_commit': {'id': '%040x' % mr_iid}}
+        }
+        request_start = time.perf_counter()
+        response = client.post('/webhook', json=payload, headers={'X-Gitlab-Event': 'Merge Request Hook'})
+        ingest_latencies.append(time.perf_counter() - request_start)
+        if response.status_code != 200:
+            raise RuntimeError(f"webhook返回 {response.status_code}: {response.get_data(as_text=True)}")
+
+    # 等待所有任务完成
+    while True:
+        stats = webapp.review_queue.stats()
+        if not stats.get('pending') and not stats.get('running'):
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    with webapp.review_queue._connect() as conn:
+        rows = conn.execute(
+            "SELECT status, created_at, finished_at FROM jobs WHERE project_id = ? AND mr_iid >= ? AND mr_iid < ?",
+            (str(args.project_id), first_iid, first_iid + args.reviews)
+        ).fetchall()
+    latencies = [row['finished_at'] - row['created_at'] for row in rows if row['finished_at']]
+    failures = sum(1 for row in rows if row['status'] != 'done')
+    webapp.review_scheduler.stop(timeout=5)
+    extra = {
+        'ingest_p50_ms': round(percentile(ingest_latencies, 50) * 1000, 2),
+        'ingest_p99_ms': round(percentile(ingest_latencies, 99) * 1000, 2)
+    }
+    return elapsed, latencies, failures, extra
+
+
+SCENARIOS = {
+    'review': run_review_scenario,
+    'webhook': run_webhook_scenario,
+}
+
+
+def git_revision():
+    def run(*command):
+        return subprocess.run(command, cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+    commit = run('git', 'rev-parse', '--short', 'HEAD') or 'unknown'
+    dirty = bool(run('git', 'status', '--porcelain', '--untracked-files=no'))
+    return commit, dirty
+
+
+def save_result(result):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{result['commit']}.jsonl")
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    return path
+
+
+def load_results(commit):
+    """读取某个提交的结果，每个场景取最后一次"""
+    path = os.path.join(RESULTS_DIR, f"{commit}.jsonl")
+    if not os.path.exists(path):
+        return {}
+    results = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            result = json.loads(line)
+            results[result['scenario']] = result
+    return results
+
+
+def print_result(result, baseline=None):
+    def delta(key):
+        if not baseline or not baseline.get(key):
+            return ''
+        return f" ({(result[key] - baseline[key]) / baseline[key] * 100:+.1f}%)"
+
+    print(f"\n== {result['scenario']} @ {result['commit']}{' (有未提交修改)' if result['dirty'] else ''}")
+    print(f"审查 {result['reviews']} 次，失败 {result['failures']} 次，耗时 {result['elapsed_s']} s")
+    print(f"吞吐 {result['throughput_per_min']} 次/分钟{delta('throughput_per_min')}")
+    print(f"延迟 p50 {result['p50_s']} s{delta('p50_s')}   p99 {result['p99_s']} s{delta('p99_s')}")
+    if 'ingest_p50_ms' in result:
+        print(f"webhook响应 p50 {result['ingest_p50_ms']} ms   p99 {result['ingest_p99_ms']} ms")
+    print(f"峰值内存 RSS {result['peak_rss_mb']} MB{delta('peak_rss_mb')}"
+          + (f"   Python堆 {result['peak_heap_mb']} MB" if result.get('peak_heap_mb') is not None else ''))
+    print(f"接口调用 {result['api_calls_total']} 次{delta('api_calls_total')}，下行 {result['bytes_out_kb']} KB")
+    for key, count in sorted(result['api_calls'].items()):
+        base = f" (基线 {baseline['api_calls'].get(key, 0)})" if baseline else ''
+        print(f"  {key:<52} {count}{base}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端审查基准")
+    parser.add_argument('--scenario', choices=['review', 'webhook', 'both'], default='both')
+    parser.add_argument('--reviews', type=int, default=20, help='每个场景的审查次数')
+    parser.add_argument('--concurrency', type=int, default=4, help='并发审查数')
+    parser.add_argument('--project-id', type=int, default=1)
+    parser.add_argument('--same-mr', action='store_true', help='重复审查同一个MR（webhook场景中同一MR的任务会合并）')
+    parser.add_argument('--no-stream', dest='stream', action='store_false', help='LLM不使用流式响应')
+    parser.add_argument('--tracemalloc', action='store_true', help='统计Python堆峰值（会降低吞吐）')
+    parser.add_argument('--no-save', dest='save', action='store_false', help='不保存结果')
+    parser.add_argument('--compare', help='与指定提交的结果对比')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    port = free_port()
+    server = start_fake_server(args, port)
+    work_dir = tempfile.mkdtemp(prefix='review-bench-')
+    configure_environment(args, port, work_dir)
+    commit, dirty = git_revision()
+    baseline = load_results(args.compare) if args.compare else {}
+    scenarios = ['review', 'webhook'] if args.scenario == 'both' else [args.scenario]
+
+    try:
+        for index, scenario in enumerate(scenarios):
+            reset_stats(port)
+            if args.tracemalloc:
+                tracemalloc.start()
+            # 不同场景使用不同的MR编号，避免复用前一场景的缓存
+            elapsed, latencies, failures, extra = SCENARIOS[scenario](args, 1 + index * args.reviews)
+            peak_heap = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+            if args.tracemalloc:
+                tracemalloc.stop()
+            stats = fetch_stats(port)
+            result = {
+                'commit': commit,
+                'dirty': dirty,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'scenario': scenario,
+                'params': {name: getattr(args, name) for name in SERVER_ARGS + ('reviews', 'concurrency', 'stream', 'same_mr')},
+                'reviews': args.reviews,
+                'failures': failures,
+                'elapsed_s': round(elapsed, 3),
+                'throughput_per_min': round(args.reviews / elapsed * 60, 2),
+                'p50_s': round(percentile(latencies, 50), 3),
+                'p99_s': round(percentile(latencies, 99), 3),
+                # ru_maxrss 为进程启动以来的峰值（Linux单位KB）
+                'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                'peak_heap_mb': round(peak_heap / 1024 / 1024, 1) if peak_heap is not None else None,
+                'api_calls': stats['counts'],
+                'api_calls_total': sum(stats['counts'].values()),
+                'bytes_out_kb': round(stats['bytes_out'] / 1024, 1),
+            }
+            result.update(extra)
+            print_result(result, baseline.get(scenario))
+            if args.save:
+                print(f"结果已保存: {os.path.relpath(save_result(result), ROOT_DIR)}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
+# @cursor end
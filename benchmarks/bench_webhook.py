@@ -0,0 +1,110 @@
+# @cursor start
+"""
+webhook压测：以固定并发持续向运行中的服务发送GitLab webhook，统计吞吐量和延迟
+
+默认只发送会被忽略的事件（流水线、已关闭或更新的MR、不含触发关键词的评论），不会触发真实审查；
+--trigger-ratio 大于0时按比例混入触发审查的评论事件（请只对测试环境使用）
+
+运行: python3 benchmarks/bench_webhook.py [--url http://127.0.0.1:8080/webhook] [--concurrency 32] [--duration 10]
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+
+
+def make_payload(kind, rng, body_size):
+    """构造与GitLab实际大小相近的webhook请求，返回 (X-Gitlab-Event, 请求体)"""
+    project = {'id': rng.randint(1, 50), 'name': 'demo', 'description': 'x' * body_size}
+    mr = {'iid': rng.randint(1, 500), 'state': 'opened', 'last_commit': {'id': '%040x' % rng.getrandbits(160)}}
+    if kind == 'pipeline':
+        return 'Pipeline Hook', {'object_kind': 'pipeline', 'project': project,
+                                 'object_attributes': {'status': 'success', 'stages': ['build', 'test']}}
+    if kind == 'push':
+        return 'Push Hook', {'object_kind': 'push', 'project': project, 'commits': [{'message': 'fix'}] * 5}
+    if kind == 'mr_closed':
+        return 'Merge Request Hook', {'object_kind': 'merge_request', 'project': project,
+                                      'object_attributes': dict(mr, state='closed', action='close')}
+    if kind == 'mr_update':
+        return 'Merge Request Hook', {'object_kind': 'merge_request', 'project': project,
+                                      'object_attributes': dict(mr, action='update')}
+    if kind == 'note':
+        return 'Note Hook', {'object_kind': 'note', 'project': project, 'merge_request': mr,
+                             'user': {'username': 'developer'},
+                             'object_attributes': {'id': rng.randint(1, 10 ** 6), 'note': '看起来不错，已经修改'}}
+    # 触发审查的评论
+    return 'Note Hook', {'object_kind': 'note', 'project': project, 'merge_request': mr,
+                         'user': {'username': 'developer'},
+                         'object_attributes': {'id': rng.randint(1, 10 ** 6), 'note': '/review'}}
+
+
+def worker(url, deadline, trigger_ratio, body_size, latencies, statuses, lock, seed):
+    rng = random.Random(seed)
+    session = requests.Session()
+    local_latencies = []
+    local_statuses = Counter()
+    while time.perf_counter() < deadline:
+        if rng.random() < trigger_ratio:
+            kind = 'trigger'
+        else:
+            kind = rng.choice(['pipeline', 'push', 'mr_closed', 'mr_update', 'note'])
+        event, payload = make_payload(kind, rng, body_size)
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'X-Gitlab-Event': event}
+        start = time.perf_counter()
+        try:
+            status = session.post(url, data=data, headers=headers, timeout=30).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        local_latencies.append(time.perf_counter() - start)
+        local_statuses[status] += 1
+    with lock:
+        latencies.extend(local_latencies)
+        statuses.update(local_statuses)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="webhook压测")
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--trigger-ratio', type=float, default=0.0)
+    parser.add_argument('--body-size', type=int, default=4096, help='每个请求附带的填充字节数')
+    args = parser.parse_args()
+
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(args.url, deadline, args.trigger_ratio, args.body_size,
+                                              latencies, statuses, lock, i))
+        for i in range(args.concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"并发 {args.concurrency}，持续 {elapsed:.1f} s，请求 {len(latencies)} 个，吞吐 {len(latencies) / elapsed:.0f} req/s")
+    print(f"延迟 p50 {percentile(latencies, 50) * 1000:.1f} ms   p99 {percentile(latencies, 99) * 1000:.1f} ms"
+          f"   max {(latencies[-1] if latencies else 0) * 1000:.1f} ms")
+    print(f"状态码: {dict(statuses)}")
+
+
+if __name__ == '__main__':
+    main()
+# @cursor end
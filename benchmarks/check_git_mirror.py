@@ -0,0 +1,162 @@
+# @cursor start
+"""
+本地Git镜像后端的离线检查：在临时目录中创建本地仓库（修改、删除、重命名、新增、二进制、
+类型变化、带空格、引号和非ASCII字符的路径），通过 GIT_MIRROR_URL_TEMPLATE 克隆为镜像，
+对比 MirrorGitLabClient 计算的变更、文件内容，以及增量fetch和缺少提交时的REST回退
+
+不需要网络和GitLab；任一检查失败时以非0状态退出
+
+运行: python3 benchmarks/check_git_mirror.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+failures = []
+
+
+def check(name, actual, expected):
+    ok = actual == expected
+    print(f"{'✅' if ok else '❌'} {name}")
+    if not ok:
+        print(f"   期望: {expected!r}\n   实际: {actual!r}")
+        failures.append(name)
+
+
+def git(repo, *args):
+    return subprocess.run(['git', '-C', repo, *args], check=True, capture_output=True, text=True).stdout.strip()
+
+
+def write(repo, path, content, mode='w'):
+    full_path = os.path.join(repo, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, mode) as f:
+        f.write(content)
+
+
+def build_repository(repo):
+    """返回 (base_sha, head_sha)"""
+    git(repo, 'init', '-q', '-b', 'main')
+    git(repo, 'config', 'user.email', 'bench@example.com')
+    git(repo, 'config', 'user.name', 'bench')
+    write(repo, 'src/a.py', ''.join(f"line {i}\n" for i in range(1, 41)))
+    write(repo, 'src/gone.py', 'keep\n')
+    write(repo, 'src/mv.py', ''.join(f"row {i}\n" for i in range(1, 31)))
+    write(repo, 'bin.dat', b'x\0y', 'wb')
+    write(repo, 'link.py', 'print(1)\n')
+    write(repo, 'z.py', 'a = 1\n')
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '-qm', 'base')
+    base_sha = git(repo, 'rev-parse', 'HEAD')
+
+    write(repo, 'src/a.py', ''.join(
+        ("line 5 changed\n" if i == 5 else f"line {i}\n") for i in range(1, 41) if i != 30
+    ))
+    git(repo, 'rm', '-q', 'src/gone.py')
+    git(repo, 'mv', 'src/mv.py', 'src/moved.py')
+    write(repo, 'src/moved.py', 'row new\n', 'a')
+    write(repo, 'src/spa ce.py', 'new file\n')
+    write(repo, 'src/中文.py', 'x = 1\n')
+    write(repo, 'src/q"t.py', 'y = 1\n')
+    write(repo, 'bin.dat', b'x\0z', 'wb')
+    # 普通文件变为符号链接（类型变化），其后还有其他文件的修改
+    os.remove(os.path.join(repo, 'link.py'))
+    os.symlink('z.py', os.path.join(repo, 'link.py'))
+    write(repo, 'z.py', 'a = 2\n')
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '-qm', 'head')
+    return base_sha, git(repo, 'rev-parse', 'HEAD')
+
+
+def main():
+    work_dir = tempfile.mkdtemp(prefix='git-mirror-check-')
+    repo = os.path.join(work_dir, 'origin')
+    os.makedirs(repo)
+    base_sha, head_sha = build_repository(repo)
+    # 被测模块在导入时读取配置；GitLab地址不可达，用于验证REST回退
+    os.environ.update({
+        'GITLAB_URL': 'http://127.0.0.1:9',
+        'GIT_MIRROR_DIR': os.path.join(work_dir, 'mirrors'),
+        'GIT_MIRROR_URL_TEMPLATE': repo,
+        'METRICS_DIR': '',
+        'TRACE_DIR': '',
+    })
+    from git_mirror import MirrorGitLabClient, create_gitlab_client
+
+    client = create_gitlab_client()
+    check('配置GIT_MIRROR_DIR时使用镜像后端', isinstance(client, MirrorGitLabClient), True)
+    diff_refs = {'base_sha': base_sha, 'head_sha': head_sha}
+    changes = {c['new_path']: c for c in client.iter_merge_request_changes(1, 1, diff_refs)}
+
+    check('变更文件列表', sorted(changes), sorted([
+        'bin.dat', 'link.py', 'src/a.py', 'src/gone.py', 'src/moved.py', 'src/q"t.py', 'src/spa ce.py', 'src/中文.py', 'z.py'
+    ]))
+    check('修改文件的diff', changes['src/a.py']['diff'].count('\n@@') + 1, 2)
+    check('修改文件的新增行', '+line 5 changed' in changes['src/a.py']['diff'], True)
+    check('删除文件', (changes['src/gone.py']['deleted_file'], changes['src/gone.py']['diff']),
+          (True, '@@ -1 +0,0 @@\n-keep\n'))
+    moved = changes['src/moved.py']
+    check('重命名文件', (moved['old_path'], moved['renamed_file'], moved['diff'].rstrip('\n').endswith('+row new')),
+          ('src/mv.py', True, True))
+    check('带空格路径的新增文件', (changes['src/spa ce.py']['new_file'], changes['src/spa ce.py']['diff']),
+          (True, '@@ -0,0 +1 @@\n+new file\n'))
+    check('非ASCII路径', changes['src/中文.py']['diff'], '@@ -0,0 +1 @@\n+x = 1\n')
+    check('git加引号转义的路径', changes['src/q"t.py']['diff'], '@@ -0,0 +1 @@\n+y = 1\n')
+    check('二进制文件diff为空', changes['bin.dat']['diff'], '')
+    link = changes['link.py']
+    check('类型变化合并为一个变更', (link['new_file'], link['deleted_file'], '+z.py' in link['diff']),
+          (False, False, True))
+    check('类型变化之后的文件diff不错位', changes['z.py']['diff'], '@@ -1 +1 @@\n-a = 1\n+a = 2\n')
+
+    check('读取文件行区间', client.get_file_lines(1, 'src/a.py', [(4, 5), (39, 50)], head_sha),
+          [['line 4', 'line 5 changed'], ['line 40']])
+    check('不存在的文件', client.get_file_content(1, 'missing.py', head_sha), None)
+    check('文件元数据', client.get_file_metadata(1, 'src/spa ce.py', head_sha),
+          {'blob_id': git(repo, 'rev-parse', f"{head_sha}:src/spa ce.py"), 'size': len('new file\n')})
+    check('不存在文件的元数据', client.get_file_metadata(1, 'missing.py', head_sha), None)
+
+    write(repo, 'z.py', 'a = 3\n')
+    git(repo, 'commit', '-qam', 'more')
+    new_head = git(repo, 'rev-parse', 'HEAD')
+    changes = {c['new_path']: c for c in client.iter_merge_request_changes(
+        1, 1, {'base_sha': head_sha, 'head_sha': new_head}
+    )}
+    check('新提交增量fetch', changes['z.py']['diff'], '@@ -1 +1 @@\n-a = 2\n+a = 3\n')
+
+    try:
+        list(client.iter_merge_request_changes(1, 1, {'base_sha': base_sha, 'head_sha': 'f' * 40}))
+        fell_back = False
+    except Exception:
+        fell_back = True  # 镜像中没有该提交，改用REST接口（本检查中不可达）
+    check('缺少提交时退回REST接口', fell_back, True)
+
+    # 认证头只通过环境变量传给git，不出现在命令行参数中
+    from git_mirror import GitMirror
+    calls = []
+    original_run = subprocess.run
+
+    def recording_run(command, **kwargs):
+        calls.append((command, kwargs.get('env') or {}))
+        return original_run(command, **kwargs)
+    subprocess.run = recording_run
+    try:
+        GitMirror(os.path.join(work_dir, 'auth.git'), repo, 'Authorization: Basic c2VjcmV0').ensure_commits(head_sha)
+    finally:
+        subprocess.run = original_run
+    clone_command, clone_env = next(call for call in calls if 'clone' in call[0])
+    check('认证头不在命令行中', any('Authorization' in part for part in clone_command), False)
+    check('认证头通过GIT_CONFIG_*传递', 'Authorization: Basic c2VjcmV0' in clone_env.values(), True)
+
+    if failures:
+        print(f"\n{len(failures)} 项检查失败")
+        sys.exit(1)
+    print("\n全部检查通过")
+
+
+if __name__ == '__main__':
+    main()
+# @cursor end
@@ -0,0 +1,342 @@
+# @cursor start
+"""
+基准测试用的本地替身服务：GitLab REST接口（GitLabClient用到的部分）和chat completions接口
+
+延迟、错误率和MR规模可配置，结果按 (project_id, mr_iid) 确定性生成；
+GET /__stats 返回各接口调用次数，POST /__reset 清零
+
+运行: python3 benchmarks/fake_servers.py --port 18900 [--files 20 --lines 40 --llm-latency 800]
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+MR_PATH = re.compile(r'^/api/v4/projects/(\d+)/merge_requests/(\d+)(/.*)?$')
+RAW_PATH = re.compile(r'^/api/v4/projects/(\d+)/repository/files/(.+)/raw$')
+FILE_PATH = re.compile(r'^/api/v4/projects/(\d+)/repository/files/([^/]+)$')
+FILE_SECTION = re.compile(r'^## 文件: (.+)$', re.MULTILINE)
+
+
+class FakeBackend:
+    """替身服务的状态：MR数据生成、已发布的讨论和调用统计"""
+
+    def __init__(self, args):
+        self.args = args
+        self.counts = Counter()
+        self.bytes_out = 0
+        self.discussions = {}  # (project_id, mr_iid) -> [discussion]
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.rng = random.Random(args.seed)
+
+    def count(self, key, size=0):
+        with self.lock:
+            self.counts[key] += 1
+            self.bytes_out += size
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def fail(self, rate):
+        with self.lock:
+            return self.rng.random() < rate
+
+    @staticmethod
+    def head_sha(project_id, mr_iid):
+        return hashlib.sha1(f"{project_id}:{mr_iid}".encode()).hexdigest()
+
+    def file_path(self, index):
+        return f"src/module_{index}.py"
+
+    def file_content(self, path):
+        lines = [f"value_{n} = compute({n})  # {path}" for n in range(1, self.args.file_lines + 1)]
+        return '\n'.join(lines) + '\n'
+
+    def make_diff(self, mr_iid, index):
+        """每隔hunk_gap行一个@@块，每块新增hunk_size行，共lines行新增；内容随MR变化，避免命中审查结果缓存"""
+        hunk_size = max(1, min(self.args.hunk_size, self.args.lines))
+        hunks = []
+        added = 0
+        new_start = 10
+        while added < self.args.lines:
+            count = min(hunk_size, self.args.lines - added)
+            body = [f" value_{new_start - 1} = compute({new_start - 1})"]
+            body += [f"+    result_{index}_{added + i} = process(result_{index}_{added + i - 1}, mr={mr_iid})"
+                     for i in range(count)]
+            body += [f"-value_{new_start} = legacy({new_start})"]
+            hunks.append(f"@@ -{new_start - 1},2 +{new_start - 1},{count + 1} @@\n" + '\n'.join(body))
+            added += count
+            new_start += self.args.hunk_gap
+        return '\n'.join(hunks) + '\n'
+
+    def merge_request(self, project_id, mr_iid, with_changes):
+        head_sha = self.head_sha(project_id, mr_iid)
+        data = {
+            'id': int(mr_iid), 'iid': int(mr_iid), 'project_id': int(project_id),
+            'state': 'opened', 'source_branch': f"feature-{mr_iid}", 'target_branch': 'main',
+            'sha': head_sha,
+            'diff_refs': {'base_sha': '0' * 40, 'start_sha': '0' * 40, 'head_sha': head_sha}
+        }
+        if with_changes:
+            data['changes'] = self.diffs(mr_iid, 0, self.args.files)
+        return data
+
+    def diffs(self, mr_iid, start, end):
+        return [
+            {'old_path': self.file_path(i), 'new_path': self.file_path(i), 'new_file': False,
+             'renamed_file': False, 'deleted_file': False, 'diff': self.make_diff(mr_iid, i)}
+            for i in range(start, min(end, self.args.files))
+        ]
+
+    def review_reply(self, prompt):
+        """按提示词生成符合格式的审查结果；与真实模型一样优先遵循审查模板的分节格式"""
+        if '行内评论' in prompt and '按文件分别输出审查结果' not in prompt:
+            lines = prompt.count('行号:')
+            return '\n---\n'.join('建议补充异常处理' if i % 2 == 0 else '无' for i in range(lines))
+        paths = FILE_SECTION.findall(prompt) or ['unknown']
+        sections = [
+            f"## 文件: {path.strip()}\n### 代码评分：{70 + i % 20}分（0-100）\n\n#### ❌ 问题：\n- 缺少输入校验\n"
+            for i, path in enumerate(dict.fromkeys(paths))
+        ]
+        return '\n'.join(sections)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    backend = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _gitlab_delay_or_error(self, key):
+        """模拟GitLab延迟和错误，返回True表示已返回错误"""
+        args = self.backend.args
+        time.sleep(args.gitlab_latency / 1000.0)
+        if self.backend.fail(args.error_rate):
+            self.backend.count(f"{key} [error]")
+            self._send_json(500, {'message': '500 Internal Server Error'})
+            return True
+        return False
+
+    def do_HEAD(self):
+        """文件元数据：与GitLab一样在响应头中返回blob SHA和大小"""
+        match = FILE_PATH.match(urlsplit(self.path).path)
+        key = 'HEAD /repository/files/:path'
+        if not match or self._gitlab_delay_or_error(key):
+            if not match:
+                self._send_json(404, {'message': '404 Not Found'})
+            return
+        body = self.backend.file_content(unquote(match.group(2))).encode('utf-8')
+        self.send_response(200)
+        self.send_header('X-Gitlab-Blob-Id', hashlib.sha1(b'blob %d\0' % len(body) + body).hexdigest())
+        self.send_header('X-Gitlab-Size', str(len(body)))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.backend.count(key)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/__stats':
+            with self.backend.lock:
+                stats = {'counts': dict(self.backend.counts), 'bytes_out': self.backend.bytes_out}
+            self._send_json(200, stats)
+            return
+        match = RAW_PATH.match(url.path)
+        if match:
+            key = 'GET /repository/files/:path/raw'
+            if self._gitlab_delay_or_error(key):
+                return
+            body = self.backend.file_content(unquote(match.group(2))).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # 客户端读完需要的行后提前关闭连接
+            self.backend.count(key, len(body))
+            return
+        match = MR_PATH.match(url.path)
+        if not match:
+            self._send_json(404, {'message': '404 Not Found'})
+            return
+        project_id, mr_iid, suffix = match.group(1), match.group(2), match.group(3) or ''
+        key = f"GET /merge_requests/:iid{suffix}"
+        if self._gitlab_delay_or_error(key):
+            return
+        if suffix == '/discussions':
+            query = parse_qs(url.query)
+            page = int(query.get('page', ['1'])[0])
+            per_page = int(query.get('per_page', ['20'])[0])
+            with self.backend.lock:
+                discussions = list(self.backend.discussions.get((project_id, mr_iid), []))
+            items = discussions[(page - 1) * per_page:page * per_page]
+            next_page = str(page + 1) if page * per_page < len(discussions) else ''
+            size = self._send_json(200, items, {'X-Next-Page': next_page})
+        elif suffix == '/diffs':
+            query = parse_qs(url.query)
+            page = int(query.get('page', ['1'])[0])
+            per_page = int(query.get('per_page', ['20'])[0])
+            items = self.backend.diffs(mr_iid, (page - 1) * per_page, page * per_page)
+            next_page = str(page + 1) if page * per_page < self.backend.args.files else ''
+            size = self._send_json(200, items, {'X-Next-Page': next_page})
+        elif suffix in ('', '/changes'):
+            size = self._send_json(200, self.backend.merge_request(project_id, mr_iid, suffix == '/changes'))
+        else:
+            size = self._send_json(404, {'message': '404 Not Found'})
+        self.backend.count(key, size)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path == '/__reset':
+            with self.backend.lock:
+                self.backend.counts.clear()
+                self.backend.bytes_out = 0
+            self._send_json(200, {})
+            return
+        if url.path.endswith('/chat/completions'):
+            self._chat_completions()
+            return
+        match = MR_PATH.match(url.path)
+        if not match:
+            self._send_json(404, {'message': '404 Not Found'})
+            return
+        project_id, mr_iid, suffix = match.group(1), match.group(2), match.group(3) or ''
+        key = f"POST /merge_requests/:iid{suffix}"
+        data = self._read_json()
+        if self._gitlab_delay_or_error(key):
+            return
+        if suffix == '/discussions':
+            discussion = {'id': f"d{self.backend.new_id()}", 'notes': [
+                {'id': self.backend.new_id(), 'body': data.get('body', ''), 'position': data.get('position')}
+            ]}
+            with self.backend.lock:
+                self.backend.discussions.setdefault((project_id, mr_iid), []).append(discussion)
+            size = self._send_json(201, discussion)
+        elif suffix == '/notes':
+            size = self._send_json(201, {'id': self.backend.new_id(), 'body': data.get('body', '')})
+        else:
+            size = self._send_json(404, {'message': '404 Not Found'})
+        self.backend.count(key, size)
+
+    def do_PUT(self):
+        url = urlsplit(self.path)
+        match = MR_PATH.match(url.path)
+        key = 'PUT /merge_requests/:iid/notes/:id'
+        data = self._read_json()
+        if not match:
+            self._send_json(404, {'message': '404 Not Found'})
+            return
+        if self._gitlab_delay_or_error(key):
+            return
+        size = self._send_json(200, {'id': int(url.path.rsplit('/', 1)[-1]), 'body': data.get('body', '')})
+        self.backend.count(key, size)
+
+    def _chat_completions(self):
+        args = self.backend.args
+        data = self._read_json()
+        prompt = data['messages'][-1]['content'] if 'messages' in data else data['input']['prompt']
+        time.sleep(args.llm_latency / 1000.0)
+        if self.backend.fail(args.llm_error_rate):
+            self.backend.count('POST /chat/completions [error]')
+            self._send_json(503, {'error': {'message': 'overloaded'}})
+            return
+        reply = self.backend.review_reply(prompt)
+        usage = {'prompt_tokens': len(prompt) // 2, 'completion_tokens': len(reply) // 2}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        if not data.get('stream'):
+            size = self._send_json(200, {'choices': [{'message': {'role': 'assistant', 'content': reply}}],
+                                         'usage': usage})
+            self.backend.count('POST /chat/completions', size)
+            return
+
+        # SSE流式输出，按tokens/s节奏发送（约2个字符1个token）
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chunk_chars = 16
+        interval = (chunk_chars / 2) / args.llm_tokens_per_sec if args.llm_tokens_per_sec > 0 else 0
+        size = 0
+        events = [{'choices': [{'delta': {'content': reply[i:i + chunk_chars]}}]}
+                  for i in range(0, len(reply), chunk_chars)]
+        events.append({'choices': [], 'usage': usage})
+        for event in events:
+            payload = f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(payload), payload))
+            size += len(payload)
+            if interval:
+                time.sleep(interval)
+        done = b'data: [DONE]\n\n'
+        self.wfile.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(done), done))
+        self.backend.count('POST /chat/completions', size)
+
+
+def add_arguments(parser):
+    """替身服务参数（基准脚本复用）"""
+    parser.add_argument('--files', type=int, default=20, help='每个MR的变更文件数')
+    parser.add_argument('--lines', type=int, default=40, help='每个文件的新增行数')
+    parser.add_argument('--hunk-size', type=int, default=8, help='每个@@块的新增行数')
+    parser.add_argument('--hunk-gap', type=int, default=60, help='相邻@@块的行距')
+    parser.add_argument('--file-lines', type=int, default=2000, help='每个文件的总行数')
+    parser.add_argument('--gitlab-latency', type=float, default=20, help='GitLab接口延迟（毫秒）')
+    parser.add_argument('--llm-latency', type=float, default=500, help='LLM首字延迟（毫秒）')
+    parser.add_argument('--llm-tokens-per-sec', type=float, default=200, help='LLM流式输出速度，0为不限速')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='GitLab接口错误率')
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='LLM接口错误率')
+    parser.add_argument('--seed', type=int, default=42)
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 压测结束时客户端断开连接属于正常情况
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(args, port):
+    handler = type('BoundHandler', (Handler,), {'backend': FakeBackend(args)})
+    server = QuietServer(('127.0.0.1', port), handler)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GitLab/LLM替身服务")
+    parser.add_argument('--port', type=int, default=18900)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(f"替身服务监听 http://127.0.0.1:{args.port}", flush=True)
+    serve(args, args.port)
+
+
+if __name__ == '__main__':
+    main()
+# @cursor end
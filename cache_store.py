@@ -0,0 +1,210 @@
+# @cursor start
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class SQLiteLRUCache:
+    """基于SQLite的持久化键值缓存，按总字节数进行LRU淘汰"""
+
+    def __init__(self, db_path, max_bytes):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed_at)")
+
+    def _connect(self):
+        """每次操作独立连接，线程/进程安全"""
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def get(self, key):
+        """读取缓存，命中时刷新访问时间"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        with self._stats_lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return row[0] if row is not None else None
+
+    def set(self, key, value):
+        """写入缓存，超出容量时淘汰最久未访问的条目"""
+        size = len(value.encode('utf-8') if isinstance(value, str) else value)
+        if size > self.max_bytes:
+            return
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, size, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, size, time.time())
+                )
+                self._evict(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT key, size FROM cache ORDER BY accessed_at").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            total -= size
+
+
+class MemoryLRUCache:
+    """线程安全的内存缓存，按总字节数进行LRU淘汰"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._items = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        size = len(value.encode('utf-8') if isinstance(value, str) else value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.size -= evicted_size
+
+
+COMMIT_SHA_PATTERN = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
+
+
+def is_commit_sha(ref):
+    """ref是否为完整提交SHA（只有SHA对应的内容不可变，可跨审查缓存）"""
+    return bool(ref) and bool(COMMIT_SHA_PATTERN.match(ref))
+
+
+class FileContentCache:
+    """进程级文件内容缓存：按(项目, 路径, 提交SHA)缓存，内存LRU + 可选磁盘层，并发加载同一文件只下载一次"""
+
+    def __init__(self, max_bytes, disk_path=None, disk_max_bytes=0):
+        self.memory = MemoryLRUCache(max_bytes)
+        self.disk = SQLiteLRUCache(disk_path, disk_max_bytes) if disk_path and disk_max_bytes > 0 else None
+        self._loader = SingleFlight()
+
+    def get_or_load(self, project_id, file_path, sha, loader):
+        """读取缓存，未命中时调用loader()加载；加载结果为None时不缓存"""
+        key = f"{project_id}:{sha}:{file_path}"
+        content = self.memory.get(key)
+        if content is not None:
+            return content
+
+        def load():
+            if self.disk is not None:
+                cached = self.disk.get(key)
+                if cached is not None:
+                    self.memory.set(key, cached)
+                    return cached
+            loaded = loader()
+            if loaded is not None:
+                self.memory.set(key, loaded)
+                if self.disk is not None:
+                    self.disk.set(key, loaded)
+            return loaded
+
+        return self._loader.do(key, load)
+
+
+class _Flight:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """同一键的并发加载只执行一次，其余调用等待其结果；不同键互不阻塞"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, loader):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = loader()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+
+_shared_file_cache = None
+_shared_file_cache_lock = threading.Lock()
+
+
+def get_shared_file_cache():
+    """进程内共享的文件内容缓存"""
+    global _shared_file_cache
+    with _shared_file_cache_lock:
+        if _shared_file_cache is None:
+            from config import FILE_CACHE_MAX_BYTES, FILE_CACHE_DISK_DB, FILE_CACHE_DISK_MAX_BYTES
+            _shared_file_cache = FileContentCache(
+                FILE_CACHE_MAX_BYTES, FILE_CACHE_DISK_DB, FILE_CACHE_DISK_MAX_BYTES
+            )
+        return _shared_file_cache
+# @cursor end
@@ -1,44 +1,298 @@
 # @cursor start
 import re
-import threading
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
-from config import REVIEW_FILE_TYPES, IGNORE_FILE_TYPES, MAX_FILES, CONTEXT_LINES
+from config import (
+    REVIEW_FILE_TYPES, IGNORE_FILE_TYPES, CONTEXT_LINES, CONTEXT_FETCH_CONCURRENCY, REVIEW_PIPELINE_WORKERS,
+    SYMBOL_CONTEXT_MAX_TOKENS,
+    REVIEW_PROMPT, PROMPT_VERSION, REVIEW_CACHE_DB, REVIEW_CACHE_MAX_BYTES
+)
+from provider_pool import get_shared_pool
+from cache_store import SQLiteLRUCache, SingleFlight, get_shared_file_cache, is_commit_sha
+from mr_context import MergeRequestContext
+from gitlab_client import is_truncated_diff
+from metrics import review_scope
+from tracing import trace, propagate
+from pipeline import Pipeline
+from prompt_planner import PromptPlanner, ReviewUnit, relevance_score
+from diff_parser import parse_diff, parse_change, context_windows
+from symbol_index import (
+    OUTLINE_VERSION, OUTLINE_MAX_FILE_BYTES, supports_outline, build_outline, dump_outline, load_outline,
+    symbol_windows
+)
 # from prd_analyzer import PRDAnalyzer  # 暂不启用PRD分析
 
+# 审查失败结果前缀，失败结果不会被复用
+REVIEW_FAILED_PREFIX = "❌ 审查失败"
+
+
+class ReviewResult(str):
+    """审查结果文本；complete为False表示部分文件审查失败、被跳过或行内评论发布失败，不可被后续触发复用"""
+
+    def __new__(cls, text, complete=True):
+        result = super().__new__(cls, text)
+        result.complete = complete
+        return result
+
+
+# AI审查结果中的文件分节标题，如 "## 文件: src/app.py"
+FILE_SECTION_PATTERN = re.compile(r'^#{1,6}\s*文件\s*[:：]\s*`?(.+?)`?\s*$')
+SCORE_PATTERN = re.compile(r'代码评分\s*[:：]\s*(\d+)')
+
+# AI表示该行无需评论的回复
+NO_ISSUE_REPLIES = {'无', '没有问题', '无问题', 'N/A', 'none', 'None'}
+
 class CodeReviewer:
     """代码审查器"""
     
-    def __init__(self, gitlab_client, ai_client):
+    def __init__(self, gitlab_client, ai_client, review_cache=None, file_cache=None):
         self.gitlab_client = gitlab_client
         self.ai_client = ai_client
+        # AI审查结果缓存（按内容哈希，跨审查持久化）
+        self.review_cache = review_cache or SQLiteLRUCache(REVIEW_CACHE_DB, REVIEW_CACHE_MAX_BYTES)
+        # 缓存键中的模型：审查可能由任一已配置端点完成，按端点模型集合区分
+        self.model_key = (getattr(ai_client, 'pool', None) or get_shared_pool()).model_key
+        # 按token预算拆分提示词
+        self.prompt_planner = PromptPlanner()
         # self.prd_analyzer = PRDAnalyzer(gitlab_client)  # 暂不启用PRD分析
         
-        # 添加缓存机制
-        self._file_cache = {}  # 文件内容缓存
-        self._cache_lock = threading.Lock()  # 缓存锁
+        # 上下文行缓存：进程内共享，按提交SHA跨审查复用
+        self.file_cache = file_cache or get_shared_file_cache()
+        self._file_loader = SingleFlight()  # 非SHA引用不缓存，仅合并并发请求
     
-    def _get_cached_file_content(self, project_id, file_path, branch="main"):
-        """获取缓存的文件内容"""
-        cache_key = f"{project_id}:{file_path}:{branch}"
+    def _get_cached_file_lines(self, project_id, file_path, ranges, branch="main"):
+        """获取文件指定行区间的内容（缓存），branch为提交SHA时跨审查缓存"""
+        spec = ','.join(f"{start}-{end}" for start, end in ranges)
         
-        with self._cache_lock:
-            if cache_key in self._file_cache:
-                return self._file_cache[cache_key]
-            
-            # 获取文件内容并缓存
+        def load():
+            try:
+                slices = self.gitlab_client.get_file_lines(project_id, file_path, ranges, branch)
+            except Exception as e:
+                print(f"获取文件内容失败: {e}")
+                return None
+            return json.dumps(slices, ensure_ascii=False) if slices is not None else None
+        
+        if is_commit_sha(branch):
+            cached = self.file_cache.get_or_load(project_id, f"{file_path}#L{spec}", branch, load)
+        else:
+            # 分支名对应的内容可变，不做跨审查缓存
+            cached = self._file_loader.do(f"{project_id}:{file_path}#L{spec}:{branch}", load)
+        return json.loads(cached) if cached is not None else None
+    
+    def _get_cached_file_metadata(self, project_id, file_path, branch="main"):
+        """获取文件的blob SHA和大小（缓存），branch为提交SHA时跨审查缓存"""
+        def load():
+            try:
+                metadata = self.gitlab_client.get_file_metadata(project_id, file_path, branch)
+            except Exception as e:
+                print(f"获取文件信息失败: {e}")
+                return None
+            return json.dumps(metadata) if metadata is not None else None
+        
+        if is_commit_sha(branch):
+            cached = self.file_cache.get_or_load(project_id, f"{file_path}#meta", branch, load)
+        else:
+            cached = self._file_loader.do(f"{project_id}:{file_path}#meta:{branch}", load)
+        return json.loads(cached) if cached is not None else None
+    
+    def _get_outline(self, project_id, file_path, branch="main"):
+        """
+        文件的符号大纲，按blob SHA缓存（与项目、提交无关，内容相同即复用），只缓存大纲不缓存文件内容
+        先查文件大小，超过OUTLINE_MAX_FILE_BYTES或无法获取时返回None（不下载）；
+        返回 (符号列表, 文件行数, 文件内容)，命中缓存时未下载文件，文件内容为None
+        """
+        metadata = self._get_cached_file_metadata(project_id, file_path, branch)
+        if not metadata or not metadata.get('blob_id') or metadata['size'] > OUTLINE_MAX_FILE_BYTES:
+            return None
+        downloaded = {}
+        
+        def load():
             try:
                 content = self.gitlab_client.get_file_content(project_id, file_path, branch)
-                self._file_cache[cache_key] = content
-                return content
             except Exception as e:
                 print(f"获取文件内容失败: {e}")
-                self._file_cache[cache_key] = None
                 return None
+            if content is None:
+                return None
+            downloaded['content'] = content
+            return dump_outline(build_outline(file_path, content), len(content.splitlines()))
+        
+        extension = self._get_file_extension(file_path)
+        cached = self.file_cache.get_or_load('outline', f"v{OUTLINE_VERSION}.{extension}", metadata['blob_id'], load)
+        if cached is None:
+            return None
+        symbols, line_count = load_outline(cached)
+        return symbols, line_count, downloaded.get('content')
+    
+    def prefetch_contexts(self, project_id, changes, branch="main"):
+        """并发获取各文件的上下文（并发数受CONTEXT_FETCH_CONCURRENCY限制），返回 {文件路径: 上下文块}"""
+        def fetch(change):
+            return change.get('new_path', 'unknown'), self._fetch_context(project_id, change, branch)
+        
+        changes = list(changes)
+        if len(changes) <= 1 or CONTEXT_FETCH_CONCURRENCY <= 1:
+            return dict(fetch(change) for change in changes)
+        with ThreadPoolExecutor(max_workers=min(CONTEXT_FETCH_CONCURRENCY, len(changes))) as executor:
+            return dict(executor.map(propagate(fetch), changes))
     
-    def _clear_cache(self):
-        """清理缓存"""
-        with self._cache_lock:
-            self._file_cache.clear()
+    def _fetch_context(self, project_id, change, branch="main"):
+        return self.get_file_context(project_id, change.get('new_path', 'unknown'), parse_change(change).hunks, branch)
+    
+    def _review_cache_key(self, code_changes, template=True):
+        """根据规范化后的变更内容、端点模型集合和提示词版本计算缓存键（原样发送的提示词不含审查模板）"""
+        normalized = '\n'.join(line.rstrip() for line in code_changes.strip().splitlines())
+        digest = hashlib.sha256()
+        for part in (self.model_key, PROMPT_VERSION, REVIEW_PROMPT if template else 'raw', normalized):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+    
+    def _review_code_cached(self, code_changes, template=True):
+        """
+        带结果缓存的AI请求，命中时不调用AI；template为False时提示词不套用审查模板
+        与批量审查走同一入口，受AsyncAIClient的进程级并发上限约束
+        """
+        result = self._review_many_cached([code_changes], template=template)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+    
+    def _review_many_cached(self, code_changes_list, on_result=None, template=True):
+        """
+        批量带缓存审查：未命中缓存的提示词并发请求AI，失败项返回异常对象
+        on_result(index, result) 在每个提示词得到结果时调用（缓存命中的立即调用）
+        """
+        cache_keys = [self._review_cache_key(c, template) for c in code_changes_list]
+        results = [self.review_cache.get(key) for key in cache_keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if on_result:
+            for i, result in enumerate(results):
+                if result is not None:
+                    on_result(i, result)
+        if not missing:
+            return results
+        
+        if hasattr(self.ai_client, 'review_many'):
+            responses = self.ai_client.review_many(
+                [code_changes_list[i] for i in missing],
+                on_result=(lambda index, response: on_result(missing[index], response)) if on_result else None,
+                template=template
+            )
+        else:
+            responses = []
+            for i in missing:
+                try:
+                    responses.append(self.ai_client.review_code(code_changes_list[i], template))
+                except Exception as e:
+                    responses.append(e)
+                if on_result:
+                    on_result(i, responses[-1])
+        for i, response in zip(missing, responses):
+            results[i] = response
+            if not isinstance(response, Exception):
+                self.review_cache.set(cache_keys[i], response)
+        return results
+    
+    def _file_digest(self, project_id, mr_iid, change):
+        """单个文件diff的摘要，用作增量审查的复用键"""
+        file_path = change.get('new_path', 'unknown')
+        diff_content = '\n'.join(line.rstrip() for line in change.get('diff', '').splitlines())
+        digest = hashlib.sha256()
+        for part in (self.model_key, PROMPT_VERSION, REVIEW_PROMPT, str(project_id), str(mr_iid), file_path, diff_content):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return f"file:{digest.hexdigest()}"
+    
+    def _match_section_path(self, heading, file_paths):
+        """
+        分节标题对应的文件：优先完全匹配；否则按路径边界（'/'）的后缀匹配，
+        只有唯一候选时才采用（如标题为 __init__.py 而本次有多个同名文件时不匹配）
+        """
+        if heading in file_paths:
+            return heading
+        candidates = [p for p in file_paths if p.endswith('/' + heading) or heading.endswith('/' + p)]
+        return candidates[0] if len(candidates) == 1 else None
+    
+    def split_review_by_file(self, review_text, file_paths):
+        """按 "## 文件: xxx" 标题拆分AI审查结果，返回 {file_path: 审查内容}，没有可识别的分节时返回空字典"""
+        sections = {}
+        current_path = None
+        current_lines = []
+        for line in review_text.split('\n'):
+            match = FILE_SECTION_PATTERN.match(line.strip())
+            if match:
+                if current_path:
+                    sections[current_path] = '\n'.join(current_lines).strip()
+                heading = match.group(1).strip()
+                current_path = self._match_section_path(heading, file_paths)
+                current_lines = [f"## 文件: {current_path}"] if current_path else []
+            elif current_path:
+                current_lines.append(line)
+        if current_path:
+            sections[current_path] = '\n'.join(current_lines).strip()
+        return sections
+    
+    def build_review_units(self, changes, project_id, branch="main", contexts=None):
+        """把每个文件的变更格式化为审查片段，超出token预算的大文件按@@块拆分"""
+        units = []
+        if contexts is None:
+            contexts = self.prefetch_contexts(project_id, changes, branch)
+        for change in changes:
+            file_path = change.get('new_path', 'unknown')
+            score = relevance_score(change)
+            text = self.format_code_changes_with_context([change], project_id, branch, contexts)
+            if self.prompt_planner.fits(text):
+                units.append(ReviewUnit(file_path, text, score))
+                continue
+            
+            # 大文件：按@@块贪心分组，每组单独格式化（上下文随块一起拆分）
+            parsed_diff = parse_change(change)
+            header = parsed_diff.preamble
+            hunks = parsed_diff.hunks
+            context_blocks = contexts.get(file_path, [])
+            format_hunks = lambda group: self.format_code_changes_with_context(
+                [dict(change, diff='\n'.join(header + [hunk.to_text() for hunk in group]))],
+                project_id, branch,
+                {file_path: [b for b in context_blocks if any(h in group for h in b['diff_blocks'])]}
+            )
+            group = []
+            group_text = None
+            for hunk in hunks:
+                candidate_text = format_hunks(group + [hunk])
+                if group and not self.prompt_planner.fits(candidate_text):
+                    units.append(ReviewUnit(file_path, group_text, score))
+                    group = []
+                    candidate_text = format_hunks([hunk])
+                group.append(hunk)
+                group_text = candidate_text
+            if group:
+                units.append(ReviewUnit(file_path, group_text, score))
+        # 单个@@块仍超出预算时截断
+        for unit in units:
+            if not self.prompt_planner.fits(unit.text):
+                unit.text = self.prompt_planner.truncate(unit.text)
+        return units
+    
+    def merge_file_reviews(self, file_paths, findings, reused_paths):
+        """将各文件的审查结果合并为一条评论"""
+        sections = []
+        for path in file_paths:
+            section = findings.get(path)
+            if section and section not in sections:
+                sections.append(section)
+        
+        scores = [int(m.group(1)) for m in (SCORE_PATTERN.search(s) for s in sections) if m]
+        header = []
+        if scores:
+            header.append(f"### 代码评分：{round(sum(scores) / len(scores))}分（0-100）")
+        if reused_paths:
+            header.append(
+                f"> 共审查 {len(file_paths)} 个文件，其中 {len(reused_paths)} 个文件自上次审查后无变化，复用之前的审查结果"
+            )
+        return '\n\n'.join(header + sections)
     
     def should_review_file(self, file_path):
         """判断是否需要审查该文件"""
@@ -61,79 +315,49 @@ class CodeReviewer:
     
     def parse_diff(self, diff_content):
         """解析diff内容，提取代码变更"""
-        lines = diff_content.split('\n')
-        added_lines = []
-        removed_lines = []
-        diff_blocks = []
-        
-        current_block = {
-            'old_start': 0,
-            'new_start': 0,
-            'old_lines': [],
-            'new_lines': [],
-            'context': []
-        }
-        
-        for line in lines:
-            if line.startswith('@@'):
-                # 新的diff块
-                if current_block['old_lines'] or current_block['new_lines']:
-                    diff_blocks.append(current_block)
-                
-                # 解析@@行
-                match = re.match(r'^@@ -(\d+),?(\d+)? \+(\d+),?(\d+)? @@', line)
-                if match:
-                    current_block = {
-                        'old_start': int(match.group(1)),
-                        'new_start': int(match.group(3)),
-                        'old_lines': [],
-                        'new_lines': [],
-                        'context': []
-                    }
-            elif line.startswith('+') and not line.startswith('+++'):
-                added_lines.append(line[1:])
-                current_block['new_lines'].append(line[1:])
-            elif line.startswith('-') and not line.startswith('---'):
-                removed_lines.append(line[1:])
-                current_block['old_lines'].append(line[1:])
-            elif line.startswith(' '):
-                current_block['context'].append(line[1:])
-        
-        # 添加最后一个块
-        if current_block['old_lines'] or current_block['new_lines']:
-            diff_blocks.append(current_block)
-        
-        return {
-            'added': '\n'.join(added_lines),
-            'removed': '\n'.join(removed_lines),
-            'raw': diff_content,
-            'blocks': diff_blocks
-        }
+        return parse_diff(diff_content)
     
     def get_file_context(self, project_id, file_path, diff_blocks, branch="main"):
-        """获取文件上下文（优化版）"""
+        """
+        获取文件上下文，diff_blocks为DiffHunk列表
+        支持大纲且不超过OUTLINE_MAX_FILE_BYTES的文件：上下文扩展到各块所在的函数/类（受SYMBOL_CONTEXT_MAX_TOKENS限制）；
+        其他文件只使用各块前后CONTEXT_LINES行。窗口内容流式读取，重叠的窗口合并为一个上下文块
+        """
         try:
-            file_content = self._get_cached_file_content(project_id, file_path, branch)
-            if not file_content:
+            if not diff_blocks:
+                return []
+            outline = None
+            if SYMBOL_CONTEXT_MAX_TOKENS > 0 and supports_outline(file_path):
+                outline = self._get_outline(project_id, file_path, branch)
+            slices = None
+            if outline is not None:
+                outline_symbols, line_count, content = outline
+                windows = symbol_windows(outline_symbols, diff_blocks, line_count, CONTEXT_LINES, SYMBOL_CONTEXT_MAX_TOKENS)
+                if content is not None:
+                    # 本次刚下载过完整内容（大纲未命中缓存），直接切片
+                    lines = content.splitlines()
+                    slices = [lines[start - 1:end] for start, end, _, _ in windows]
+            else:
+                windows = [(start, end, hunks, []) for start, end, hunks in context_windows(diff_blocks, CONTEXT_LINES)]
+            if not windows:
+                return []
+            if slices is None:
+                slices = self._get_cached_file_lines(
+                    project_id, file_path, [(start, end) for start, end, _, _ in windows], branch
+                )
+            if not slices:
                 return []
             
-            lines = file_content.split('\n')
             context_blocks = []
-            
-            for block in diff_blocks:
-                new_start = block['new_start']
-                new_end = new_start + len(block['new_lines'])
-                
-                # 获取上下文行
-                context_start = max(0, new_start - CONTEXT_LINES - 1)
-                context_end = min(len(lines), new_end + CONTEXT_LINES)
-                
-                context_lines = lines[context_start:context_end]
+            for (start, _, hunks, symbols), context_lines in zip(windows, slices):
+                if not context_lines:
+                    continue
                 context_blocks.append({
-                    'start_line': context_start + 1,
-                    'end_line': context_end,
+                    'start_line': start,
+                    'end_line': start + len(context_lines) - 1,
                     'content': '\n'.join(context_lines),
-                    'diff_block': block
+                    'diff_blocks': hunks,
+                    'symbols': symbols
                 })
             
             return context_blocks
@@ -141,30 +365,19 @@ class CodeReviewer:
             print(f"获取文件上下文失败: {e}")
             return []
     
-    def format_code_changes_with_context(self, changes, project_id, branch="main"):
-        """格式化代码变更信息（包含上下文，优化版）"""
+    def format_code_changes_with_context(self, changes, project_id, branch="main", contexts=None):
+        """格式化代码变更信息（包含上下文，优化版），contexts为已获取的 {文件路径: 上下文块}"""
         formatted_changes = []
         
-        # 批量获取文件内容，减少API调用
-        files_to_fetch = set()
-        for change in changes:
-            if self.should_review_file(change.get('new_path')):
-                file_path = change.get('new_path', 'unknown')
-                files_to_fetch.add((project_id, file_path, branch))
-        
-        # 预加载文件内容到缓存
-        for project_id, file_path, branch in files_to_fetch:
-            self._get_cached_file_content(project_id, file_path, branch)
+        reviewable = [change for change in changes if self.should_review_file(change.get('new_path'))]
+        if contexts is None:
+            # 并发获取各文件的上下文，减少等待时间
+            contexts = self.prefetch_contexts(project_id, reviewable, branch)
         
-        for change in changes:
-            if not self.should_review_file(change.get('new_path')):
-                continue
-            
+        for change in reviewable:
             file_path = change.get('new_path', 'unknown')
             diff_content = change.get('diff', '')
-            
-            parsed_diff = self.parse_diff(diff_content)
-            context_blocks = self.get_file_context(project_id, file_path, parsed_diff['blocks'], branch)
+            context_blocks = contexts.get(file_path, [])
             
             formatted_change = f"""
 ## 文件: {file_path}
@@ -180,8 +393,10 @@ class CodeReviewer:
             if context_blocks:
                 formatted_change += "### 相关上下文:\n"
                 for i, context_block in enumerate(context_blocks, 1):
+                    symbols = context_block.get('symbols')
+                    location = f"，所在: {'、'.join(symbols)}" if symbols else ''
                     formatted_change += f"""
-**上下文块 {i}** (行 {context_block['start_line']}-{context_block['end_line']}):
+**上下文块 {i}** (行 {context_block['start_line']}-{context_block['end_line']}{location}):
 ```{self._get_file_extension(file_path)}
 {context_block['content']}
 ```
@@ -201,21 +416,19 @@ class CodeReviewer:
                 continue
             
             file_path = change.get('new_path', 'unknown')
-            diff_content = change.get('diff', '')
-            
-            parsed_diff = self.parse_diff(diff_content)
+            parsed_diff = parse_change(change)
             
             formatted_change = f"""
 ## 文件: {file_path}
 
 ### 添加的代码:
 ```{self._get_file_extension(file_path)}
-{parsed_diff['added']}
+{parsed_diff.added_text()}
 ```
 
 ### 删除的代码:
 ```{self._get_file_extension(file_path)}
-{parsed_diff['removed']}
+{parsed_diff.removed_text()}
 ```
 
 ---
@@ -242,38 +455,33 @@ class CodeReviewer:
                 continue
             
             file_path = change.get('new_path', 'unknown')
-            diff_content = change.get('diff', '')
-            
-            parsed_diff = self.parse_diff(diff_content)
+            parsed_diff = parse_change(change)
             
             # 为每个diff块收集评论信息
-            for block in parsed_diff['blocks']:
-                if block['new_lines'] or block['old_lines']:
-                    # 为新增的代码行生成评论
-                    for i, line in enumerate(block['new_lines']):
-                        line_number = block['new_start'] + i
-                        block_content = f"文件: {file_path}\n行号: {line_number}\n代码: {line}\n"
-                        
-                        comment_blocks.append({
-                            'file_path': file_path,
-                            'line_number': line_number,
-                            'line_type': 'new',
-                            'content': block_content,
-                            'code_line': line
-                        })
+            for hunk in parsed_diff.hunks:
+                # 为新增的代码行生成评论
+                for line in hunk.added():
+                    block_content = f"文件: {file_path}\n行号: {line.new_no}\n代码: {line.text}\n"
                     
-                    # 为删除的代码行生成评论
-                    for i, line in enumerate(block['old_lines']):
-                        line_number = block['old_start'] + i
-                        block_content = f"文件: {file_path}\n行号: {line_number}\n删除代码: {line}\n"
-                        
-                        comment_blocks.append({
-                            'file_path': file_path,
-                            'line_number': line_number,
-                            'line_type': 'old',
-                            'content': block_content,
-                            'code_line': line
-                        })
+                    comment_blocks.append({
+                        'file_path': file_path,
+                        'line_number': line.new_no,
+                        'line_type': 'new',
+                        'content': block_content,
+                        'code_line': line.text
+                    })
+                
+                # 为删除的代码行生成评论
+                for line in hunk.removed():
+                    block_content = f"文件: {file_path}\n行号: {line.old_no}\n删除代码: {line.text}\n"
+                    
+                    comment_blocks.append({
+                        'file_path': file_path,
+                        'line_number': line.old_no,
+                        'line_type': 'old',
+                        'content': block_content,
+                        'code_line': line.text
+                    })
         
         # 批量生成评论（限制数量避免过载）
         if comment_blocks:
@@ -291,28 +499,27 @@ class CodeReviewer:
 1. 评论要简洁明了，不超过50字
 2. 针对具体代码行的问题或建议
 3. 使用中文，语气友好
-4. 如果是好的代码，可以给出正面评价
+4. 只评论确实存在问题或值得改进的代码行，没有问题的代码行只回复"无"
 
 代码行：
 {combined_content}
 
 请为每个代码行生成一行评论，用"---"分隔："""
                 
-                ai_response = self.ai_client.review_code(inline_prompt)
+                # 行内评论提示词自带输出格式，不能再套用按文件分节的审查模板
+                ai_response = self._review_code_cached(inline_prompt, template=False)
                 
                 # 分割AI响应
                 responses = ai_response.split('\n---\n')
                 
-                for i, block in enumerate(important_blocks):
-                    if i < len(responses):
-                        comment = responses[i].strip()
-                        # 清理评论内容，只保留第一行
-                        comment = comment.split('\n')[0].strip()
-                        # 限制长度
-                        short_comment = comment[:80] + "..." if len(comment) > 80 else comment
-                    else:
-                        # 默认评论
-                        short_comment = "建议检查这行代码的逻辑"
+                # 只保留AI实际给出的评论，不补充默认评论
+                for block, response in zip(important_blocks, responses):
+                    # 清理评论内容，只保留第一行
+                    comment = response.strip().split('\n')[0].strip()
+                    if not comment or comment.strip('。.') in NO_ISSUE_REPLIES:
+                        continue
+                    # 限制长度
+                    short_comment = comment[:80] + "..." if len(comment) > 80 else comment
                     
                     inline_comments.append({
                         'file_path': block['file_path'],
@@ -321,80 +528,218 @@ class CodeReviewer:
                         'comment': short_comment
                     })
             except Exception as e:
+                # 生成失败时不发布行内评论，避免无意义的默认评论
                 print(f"生成行内评论失败: {e}")
-                # 如果批量处理失败，返回简单的评论
-                for block in important_blocks[:3]:
-                    inline_comments.append({
-                        'file_path': block['file_path'],
-                        'line_number': block['line_number'],
-                        'line_type': block['line_type'],
-                        'comment': f"建议检查这行代码的逻辑和错误处理。"
-                    })
         
         return inline_comments
     
-    def review_merge_request(self, project_id, mr_iid):
-        """审查整个Merge Request（优化版）"""
+    def review_merge_request(self, project_id, mr_iid, progress=None):
+        """
+        审查整个Merge Request（优化版）
+        progress(text, done, total): 每完成一个审查分块时调用，text为已完成文件的审查结果
+        """
+        # 由审查任务调用时沿用任务的追踪，直接调用时单独开启
+        with trace(f"{project_id}-{mr_iid}-{int(time.time())}", project_id=project_id, mr_iid=mr_iid), \
+                review_scope(project_id):
+            return self._review_merge_request(project_id, mr_iid, progress)
+    
+    def _review_merge_request(self, project_id, mr_iid, progress=None):
+        """
+        审查流水线：获取变更与拉取已有讨论并行开始；总结审查（上下文→提示词→AI）与行内评论（AI→发布）
+        两条分支互不依赖、并发执行，最终结果只等待总结和行内评论发布两个阶段
+        """
         try:
-            # 获取代码变更
-            changes = self.gitlab_client.get_merge_request_changes(project_id, mr_iid)
-            merge_info = self.gitlab_client.get_merge_request_info(project_id, mr_iid)
-            
-            # 检查文件数量限制
-            if len(changes) > MAX_FILES:
-                return f"⚠️ 文件数量过多 ({len(changes)} > {MAX_FILES})，跳过审查"
-            
-            # 格式化代码变更（包含上下文）
-            formatted_changes = self.format_code_changes_with_context(
-                changes, project_id, merge_info.get('source_branch', 'main')
-            )
-            
-            if not formatted_changes.strip():
-                return "✅ 没有需要审查的代码变更"
+            pipeline = Pipeline(f"MR#{mr_iid}", max_workers=REVIEW_PIPELINE_WORKERS)
+            # 获取MR信息和代码变更（整个审查流程只请求一次），并区分需要重新审查的文件
+            pipeline.stage('fetch_changes', lambda: self._load_changes(project_id, mr_iid))
+            # 已有讨论只拉取一次，用于行内评论去重和可见性校验
+            pipeline.stage('discussion_index', lambda: self.gitlab_client.get_discussion_index(project_id, mr_iid))
+            # 上下文在获取变更时已逐个文件开始下载，这里只等待完成
+            pipeline.stage('fetch_context', lambda plan: {
+                file_path: future.result() for file_path, future in plan['context_futures'].items()
+            }, deps=('fetch_changes',))
+            pipeline.stage('prompt_build', lambda plan, contexts: self.prompt_planner.plan(self.build_review_units(
+                plan['changed'], project_id, plan['mr_context'].content_ref, contexts
+            )), deps=('fetch_changes', 'fetch_context'))
+            pipeline.stage('llm', lambda plan, planned: self._review_chunks(
+                plan, planned[0], progress
+            ), deps=('fetch_changes', 'prompt_build'))
+            pipeline.stage('summary', self._summarize, deps=('fetch_changes', 'prompt_build', 'llm'))
+            # 行内评论（未变化的文件上次已评论过）
+            pipeline.stage('inline_generation', lambda plan: self.generate_inline_comments(
+                plan['changed'], project_id, plan['mr_context'].content_ref
+            ), deps=('fetch_changes',))
+            pipeline.stage('comment_posting', lambda plan, comments, index: self._post_inline_comments(
+                project_id, mr_iid, plan['mr_context'], comments, index
+            ), deps=('fetch_changes', 'inline_generation', 'discussion_index'))
+            pipeline.run()
             
-            # 使用AI审查
-            review_result = self.ai_client.review_code(formatted_changes)
+            plan = pipeline.result('fetch_changes')
+            if not plan['reviewable']:
+                return ReviewResult("✅ 没有需要审查的代码变更" + self._too_large_note(plan), not plan['too_large_paths'])
+            review_result = pipeline.result('summary')
+            complete = review_result.complete
             
-            # 生成真正的行内评论
-            inline_comments = self.generate_inline_comments(
-                changes, project_id, merge_info.get('source_branch', 'main')
-            )
-            
-            # 添加真正的行内评论
+            inline_comments = pipeline.results.get('inline_generation')
             if inline_comments:
                 try:
-                    # 用lambda适配新接口
-                    def ai_comment_func(file_path, line_number, code_line):
-                        for c in inline_comments:
-                            if c['file_path'] == file_path and c['line_number'] == line_number:
-                                return c['comment']
-                        return "建议检查这行代码的逻辑"
-                    visible_count = self.gitlab_client.add_multiple_inline_comments(project_id, mr_iid, ai_comment_func)
+                    # 只在AI给出评论的位置发布
+                    visible_count = pipeline.result('comment_posting')
                     review_result += f"\n\n✅ 已添加 {visible_count} 个行内评论"
                 except Exception as e:
                     print(f"添加行内评论失败: {e}")
+                    complete = False
                     # 如果行内评论失败，在普通评论中说明
                     review_result += f"\n\n⚠️ 行内评论添加失败，以下是建议的行内评论：\n\n"
                     for comment in inline_comments[:3]:  # 只显示前3个
                         review_result += f"- **{comment['file_path']}** (第{comment['line_number']}行): {comment['comment']}\n"
             
-            # 清理缓存
-            self._clear_cache()
-            
-            return review_result
+            return ReviewResult(review_result, complete)
             
         except Exception as e:
-            # 清理缓存
-            self._clear_cache()
-            return f"❌ 审查失败: {str(e)}"
+            return f"{REVIEW_FAILED_PREFIX}: {str(e)}"
+    
+    def _load_changes(self, project_id, mr_iid):
+        """
+        分页获取MR变更，每收到一个需要重新审查的文件就开始下载其上下文（与后续页的获取重叠）；
+        增量审查：diff摘要与上次审查相同的文件直接复用之前的结果
+        """
+        mr_context = MergeRequestContext.open(self.gitlab_client, project_id, mr_iid)
+        reviewable = []
+        too_large_paths = []
+        findings = {}
+        reused_paths = []
+        changed = []
+        digests = {}
+        context_futures = {}
+        context_executor = ThreadPoolExecutor(max_workers=max(1, CONTEXT_FETCH_CONCURRENCY))
+        try:
+            # 不审查的文件（锁文件、图片等）diff被截断时不下载原始文件重新计算
+            for change in mr_context.iter_changes(self.should_review_file):
+                file_path = change.get('new_path', 'unknown')
+                if not self.should_review_file(file_path):
+                    continue
+                if is_truncated_diff(change):
+                    # diff过大且无法按原始文件重新计算
+                    too_large_paths.append(file_path)
+                    continue
+                reviewable.append(change)
+                digests[file_path] = self._file_digest(project_id, mr_iid, change)
+                cached = self.review_cache.get(digests[file_path])
+                if cached is not None:
+                    findings[file_path] = cached
+                    reused_paths.append(file_path)
+                    continue
+                changed.append(change)
+                context_futures[file_path] = context_executor.submit(
+                    propagate(self._fetch_context), project_id, change, mr_context.content_ref
+                )
+        finally:
+            context_executor.shutdown(wait=False)
+        return {
+            'mr_context': mr_context,
+            'reviewable': reviewable,
+            'too_large_paths': too_large_paths,
+            'changed': changed,
+            'findings': findings,
+            'reused_paths': reused_paths,
+            'digests': digests,
+            'context_futures': context_futures
+        }
     
-    def review_merge_request_async(self, project_id, mr_iid, callback):
-        """异步审查Merge Request"""
-        def review_task():
-            result = self.review_merge_request(project_id, mr_iid)
-            callback(result)
+    def _post_inline_comments(self, project_id, mr_iid, mr_context, inline_comments, discussion_index):
+        """发布行内评论，返回可见评论数；没有评论时不请求GitLab"""
+        if not inline_comments:
+            return 0
+        return self.gitlab_client.add_inline_comments(
+            project_id, mr_iid, inline_comments, mr_context, discussion_index
+        )
+    
+    def _review_chunks(self, plan, chunks, progress=None):
+        """并发审查各分块；提供progress时每完成一个分块报告一次已完成文件的结果"""
+        prompts = ['\n'.join(u.text for u in chunk) for chunk in chunks]
+        if progress is None or not chunks:
+            return self._review_many_cached(prompts)
+        completed = [None] * len(chunks)
+        
+        def on_result(index, result):
+            completed[index] = result
+            findings, _, _ = self._merge_chunk_findings(plan, chunks, completed)
+            file_paths = [c.get('new_path', 'unknown') for c in plan['reviewable']]
+            text = self.merge_file_reviews(file_paths, findings, plan['reused_paths'])
+            progress(text, sum(r is not None for r in completed), len(chunks))
+        return self._review_many_cached(prompts, on_result)
+    
+    def _merge_chunk_findings(self, plan, chunks, responses):
+        """
+        按文件收集各分块的结果（大文件可能分布在多个分块中），未完成的分块（None）跳过
+        返回 (findings, failed_paths, unsectioned_paths)，findings包含复用的上次结果；
+        unsectioned_paths为AI未按文件分节输出的文件，其结果是整个分块的审查内容，不能按文件复用
+        """
+        findings = dict(plan['findings'])
+        file_sections = {}
+        failed_paths = set()
+        unsectioned_paths = set()
+        for chunk, response in zip(chunks, responses):
+            if response is None:
+                continue
+            chunk_paths = list(dict.fromkeys(u.file_path for u in chunk))
+            if isinstance(response, Exception):
+                failed_paths.update(chunk_paths)
+                continue
+            sections = self.split_review_by_file(response, chunk_paths)
+            if not sections:
+                # 整体结果归属本分块的所有文件，合并评论时去重
+                sections = {path: response.strip() for path in chunk_paths}
+                unsectioned_paths.update(chunk_paths)
+            for file_path, section in sections.items():
+                file_sections.setdefault(file_path, []).append(section)
+        for file_path in failed_paths:
+            findings[file_path] = f"## 文件: {file_path}\n⚠️ 该文件审查失败"
+        for file_path, sections in file_sections.items():
+            if file_path in failed_paths:
+                continue
+            # 后续分块的结果去掉重复的文件标题
+            findings[file_path] = '\n\n'.join(
+                [sections[0]] + [s.split('\n', 1)[1] if '\n' in s else '' for s in sections[1:]]
+            ).strip()
+        return findings, failed_paths, unsectioned_paths
+    
+    def _too_large_note(self, plan):
+        """diff过大（GitLab截断且无法重新计算）而未审查的文件说明"""
+        if not plan['too_large_paths']:
+            return ''
+        return (f"\n\n⚠️ 以下 {len(plan['too_large_paths'])} 个文件的diff过大，未审查：\n"
+                + '\n'.join(f"- {path}" for path in plan['too_large_paths']))
+    
+    def _summarize(self, plan, planned, responses):
+        """按文件合并各分块的AI审查结果，生成总结评论内容（ReviewResult，有文件失败、被跳过或diff过大时不完整）"""
+        chunks, dropped = planned
+        if chunks and all(isinstance(r, Exception) for r in responses):
+            raise responses[0]
+        for chunk, response in zip(chunks, responses):
+            if isinstance(response, Exception):
+                print(f"分块审查失败: {list(dict.fromkeys(u.file_path for u in chunk))} {response}")
+        
+        findings, failed_paths, unsectioned_paths = self._merge_chunk_findings(plan, chunks, responses)
+        digests = plan['digests']
+        dropped_paths = {u.file_path for u in dropped}
+        
+        skipped_paths = []
+        for change in plan['changed']:
+            file_path = change.get('new_path', 'unknown')
+            # 部分分块被跳过、或结果未按文件分节的文件不缓存，下次重新审查
+            if (file_path in findings and file_path not in failed_paths and file_path not in dropped_paths
+                    and file_path not in unsectioned_paths):
+                self.review_cache.set(digests[file_path], findings[file_path])
+            if file_path in dropped_paths:
+                skipped_paths.append(file_path)
         
-        thread = threading.Thread(target=review_task)
-        thread.start()
-        return thread
+        file_paths = [c.get('new_path', 'unknown') for c in plan['reviewable']]
+        review_result = self.merge_file_reviews(file_paths, findings, plan['reused_paths'])
+        review_result += self._too_large_note(plan)
+        if skipped_paths:
+            review_result += f"\n\n⚠️ 超出单次审查预算，以下 {len(skipped_paths)} 个相关性较低的文件未审查：\n"
+            review_result += '\n'.join(f"- {path}" for path in skipped_paths)
+        return ReviewResult(review_result, not (failed_paths or skipped_paths or plan['too_large_paths']))
 # @cursor end 
\ No newline at end of file
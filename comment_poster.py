@@ -0,0 +1,136 @@
+# @cursor start
+import random
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from config import INLINE_COMMENT_CONCURRENCY, INLINE_COMMENT_MAX_RETRIES
+from metrics import RETRIES
+from tracing import event, propagate
+
+logger = logging.getLogger(__name__)
+
+# 退避等待的基础时长与上限（秒）
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+
+class RateLimiter:
+    """根据GitLab的RateLimit-*/Retry-After响应头自适应暂停所有请求"""
+
+    def __init__(self, reserve):
+        self.reserve = reserve  # 剩余配额低于该值时暂停到配额重置
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """在暂停窗口内等待"""
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """暂停所有请求至少seconds秒"""
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.time() + seconds)
+
+    def update(self, response):
+        """根据响应头更新暂停窗口，返回建议的重试等待时长（无则为None）"""
+        headers = response.headers or {}
+        retry_after = _parse_float(headers.get('Retry-After'))
+        if retry_after is not None:
+            self.pause(retry_after)
+            return retry_after
+        remaining = _parse_float(headers.get('RateLimit-Remaining'))
+        reset_at = _parse_float(headers.get('RateLimit-Reset'))
+        if remaining is not None and reset_at is not None and remaining <= self.reserve:
+            delay = max(0.0, reset_at - time.time())
+            self.pause(delay)
+            return delay
+        return None
+
+
+def _parse_float(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class InlineCommentPoster:
+    """并发发布行内评论，遵循限流响应头并汇总每条评论的结果"""
+
+    def __init__(self, gitlab_client, concurrency=INLINE_COMMENT_CONCURRENCY,
+                 max_retries=INLINE_COMMENT_MAX_RETRIES):
+        self.gitlab_client = gitlab_client
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.rate_limiter = RateLimiter(reserve=self.concurrency)
+
+    def post_all(self, project_id, mr_iid, comments, diff_refs):
+        """
+        并发发布评论，comments: [{'file_path', 'line_number', 'line_type', 'comment'}]
+        返回 {'posted': 成功数, 'failed': 失败数, 'results': 每条评论的结果}
+        """
+        if not comments:
+            return {'posted': 0, 'failed': 0, 'results': []}
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(comments))) as executor:
+            results = list(executor.map(
+                propagate(lambda c: self._post_one(project_id, mr_iid, c, diff_refs)), comments
+            ))
+        posted = sum(1 for r in results if r['status'] == 'posted')
+        summary = {'posted': posted, 'failed': len(results) - posted, 'results': results}
+        logger.info(f"行内评论发布完成: 成功 {summary['posted']} 个，失败 {summary['failed']} 个")
+        for r in results:
+            if r['status'] != 'posted':
+                logger.warning(f"行内评论失败: {r['file_path']}:{r['line_number']} {r['error']}")
+        return summary
+
+    def _post_one(self, project_id, mr_iid, comment, diff_refs):
+        position = self.gitlab_client.build_inline_position(
+            diff_refs, comment['file_path'], comment['line_number'], comment.get('line_type', 'new')
+        )
+        result = {
+            'file_path': comment['file_path'],
+            'line_number': comment['line_number'],
+            'comment': comment['comment'],
+            'status': 'failed',
+            'attempts': 0,
+            'error': None
+        }
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                RETRIES.inc(backend='gitlab', operation='post_discussion')
+                event('retry', backend='gitlab', operation='post_discussion', attempt=attempt,
+                      file_path=comment['file_path'], line_number=comment['line_number'])
+            self.rate_limiter.wait()
+            result['attempts'] = attempt + 1
+            try:
+                response = self.gitlab_client.post_discussion(project_id, mr_iid, comment['comment'], position)
+            except Exception as e:
+                result['error'] = str(e)
+                self._backoff(attempt, None)
+                continue
+            suggested = self.rate_limiter.update(response)
+            if response.status_code == 201:
+                result['status'] = 'posted'
+                result['error'] = None
+                result['discussion'] = response.json()
+                return result
+            result['error'] = f"{response.status_code}: {response.text[:200]}"
+            if response.status_code != 429 and response.status_code < 500:
+                # 位置无效等客户端错误，重试无意义
+                return result
+            self._backoff(attempt, suggested)
+        return result
+
+    def _backoff(self, attempt, suggested):
+        """指数退避（带抖动），限流头给出等待时长时以其为准"""
+        if suggested is not None:
+            return  # 已由rate_limiter暂停，下一轮wait()生效
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+        self.rate_limiter.pause(delay * random.uniform(0.5, 1.0))
+# @cursor end
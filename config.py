@@ -17,9 +17,43 @@ AI_API_URL = os.getenv("AI_API_URL", "https://api.siliconflow.cn/v1/chat/complet
 AI_API_KEY = os.getenv("AI_API_KEY", "your-api-key-here")
 AI_MODEL = os.getenv("AI_MODEL", "Qwen/Qwen2.5-72B-Instruct")
 
+# 多端点配置（可选，JSON数组），每项: name, provider, url, api_key, model, weight, max_concurrency
+# 未填写的字段使用上面的通用配置；留空时只使用上面这一个端点
+AI_ENDPOINTS = os.getenv("AI_ENDPOINTS", "")
+# 单次AI请求最多尝试的次数（超时、5xx、429时切换到其他端点重试）
+AI_MAX_ATTEMPTS = int(os.getenv("AI_MAX_ATTEMPTS", "3"))
+# 熔断：端点连续失败达到次数后暂停使用，冷却时间（秒）后放行一个试探请求
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "3"))
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))
+
+# ==================== HTTP连接配置 ====================
+# 连接池大小（每个后端复用的keep-alive连接数）与超时（秒）
+GITLAB_POOL_SIZE = int(os.getenv("GITLAB_POOL_SIZE", "10"))
+GITLAB_CONNECT_TIMEOUT = float(os.getenv("GITLAB_CONNECT_TIMEOUT", "5"))
+GITLAB_READ_TIMEOUT = float(os.getenv("GITLAB_READ_TIMEOUT", "30"))
+# MR变更分页获取（/diffs接口）时每页的文件数
+GITLAB_DIFFS_PER_PAGE = int(os.getenv("GITLAB_DIFFS_PER_PAGE", "20"))
+# diff被GitLab截断（too_large/collapsed）时按原始文件重新计算diff，超过该大小（字节）的文件不再计算
+GITLAB_BLOB_DIFF_MAX_BYTES = int(os.getenv("GITLAB_BLOB_DIFF_MAX_BYTES", str(1024 * 1024)))
+AI_POOL_SIZE = int(os.getenv("AI_POOL_SIZE", "10"))
+AI_CONNECT_TIMEOUT = float(os.getenv("AI_CONNECT_TIMEOUT", "10"))
+AI_READ_TIMEOUT = float(os.getenv("AI_READ_TIMEOUT", "300"))
+# 进程内所有审查合计并发的AI请求数（按文件/分块拆分的提示词，共用长连接），以及是否使用SSE流式响应
+AI_CONCURRENCY = int(os.getenv("AI_CONCURRENCY", "4"))
+AI_STREAM = os.getenv("AI_STREAM", "true").lower() == "true"
+# 行内评论并发发布数与失败重试次数（429/5xx时按限流头或指数退避重试）
+INLINE_COMMENT_CONCURRENCY = int(os.getenv("INLINE_COMMENT_CONCURRENCY", "4"))
+INLINE_COMMENT_MAX_RETRIES = int(os.getenv("INLINE_COMMENT_MAX_RETRIES", "3"))
+
 # ==================== 服务器配置 ====================
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", "8080"))
+# 运行模式：production 使用gunicorn多进程（start.sh），development 使用Flask开发服务器
+SERVER_MODE = os.getenv("SERVER_MODE", "production")
+DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+# gunicorn工作进程数与每个进程的请求线程数（每个进程各自运行REVIEW_WORKERS个审查线程，共享同一个任务队列，运行中的审查合计不超过REVIEW_WORKERS）
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "2"))
+WEB_THREADS = int(os.getenv("WEB_THREADS", "8"))
 
 # ==================== 代码审查配置 ====================
 # 需要审查的文件类型
@@ -28,11 +62,72 @@ REVIEW_FILE_TYPES = ['.py', '.js', '.ts', '.java', '.go', '.cpp', '.c', '.php']
 # 忽略的文件类型
 IGNORE_FILE_TYPES = ['package-lock.json', 'yarn.lock', 'mod.go']
 
-# 最大处理文件数量
-MAX_FILES = 50
+# 单个审查提示词的输入token预算（需小于模型上下文窗口减去AI_MAX_TOKENS）
+AI_PROMPT_TOKEN_BUDGET = int(os.getenv("AI_PROMPT_TOKEN_BUDGET", "24000"))
+# AI单次回复的最大token数
+AI_MAX_TOKENS = int(os.getenv("AI_MAX_TOKENS", "2000"))
+# 单次审查最多的提示词分块数，超出部分按相关性从低到高跳过（0为不限制）
+REVIEW_MAX_CHUNKS = int(os.getenv("REVIEW_MAX_CHUNKS", "20"))
 
 # 上下文代码行数
 CONTEXT_LINES = 5
+# 符号上下文：diff块的上下文扩展到所在的函数/类（单个块不超过该token数，超出时使用CONTEXT_LINES行窗口并附带声明行），0为关闭
+SYMBOL_CONTEXT_MAX_TOKENS = int(os.getenv("SYMBOL_CONTEXT_MAX_TOKENS", "800"))
+
+# 获取上下文时并发下载文件的数量上限
+CONTEXT_FETCH_CONCURRENCY = int(os.getenv("CONTEXT_FETCH_CONCURRENCY", "8"))
+
+# 单次审查内并发执行的流水线阶段数（总结审查与行内评论两条分支、上下文获取、讨论拉取可同时进行）
+REVIEW_PIPELINE_WORKERS = int(os.getenv("REVIEW_PIPELINE_WORKERS", "4"))
+
+# 文件内容缓存：进程内共享，按(项目, 路径, 提交SHA)缓存，按字节数LRU淘汰
+FILE_CACHE_MAX_BYTES = int(os.getenv("FILE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# 可选磁盘缓存层（留空关闭），进程重启后仍可复用
+FILE_CACHE_DISK_DB = os.getenv("FILE_CACHE_DISK_DB", "")
+FILE_CACHE_DISK_MAX_BYTES = int(os.getenv("FILE_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# 本地Git镜像（留空关闭）：每个项目一个裸镜像，MR的diff和文件内容从镜像读取，减少GitLab API调用
+GIT_MIRROR_DIR = os.getenv("GIT_MIRROR_DIR", "")
+# 克隆地址模板，支持{project_id}和{path}（如 file:///srv/git/{path}.git）；留空使用项目的HTTP克隆地址并以GITLAB_TOKEN认证
+GIT_MIRROR_URL_TEMPLATE = os.getenv("GIT_MIRROR_URL_TEMPLATE", "")
+# clone/fetch超时（秒）
+GIT_MIRROR_FETCH_TIMEOUT = float(os.getenv("GIT_MIRROR_FETCH_TIMEOUT", "300"))
+
+# ==================== 审查队列配置 ====================
+# 审查工作线程数，同时也是所有进程合计同时进行的审查数上限
+REVIEW_WORKERS = int(os.getenv("REVIEW_WORKERS", "4"))
+# 持久化任务队列（SQLite文件），重启后未完成的审查会继续执行
+REVIEW_QUEUE_DB = os.getenv("REVIEW_QUEUE_DB", "data/review_queue.db")
+# 待处理任务上限（全局/单个项目），超过后拒绝新任务
+REVIEW_QUEUE_MAX_PENDING = int(os.getenv("REVIEW_QUEUE_MAX_PENDING", "200"))
+REVIEW_QUEUE_MAX_PER_PROJECT = int(os.getenv("REVIEW_QUEUE_MAX_PER_PROJECT", "20"))
+# 单个审查任务租约时长（秒），超时的运行中任务会被重新入队（空闲的工作线程每分钟检查一次）
+REVIEW_JOB_TIMEOUT = int(os.getenv("REVIEW_JOB_TIMEOUT", "1800"))
+# 已结束任务的保留天数，过期记录定期删除（每个 (项目, MR, head_sha) 最近一次成功的结果保留用于复用），设为0不清理
+REVIEW_QUEUE_RETENTION_DAYS = float(os.getenv("REVIEW_QUEUE_RETENTION_DAYS", "7"))
+# 审查进度：每完成一个审查分块就原地更新"处理中"评论，两次编辑的最小间隔（秒）
+REVIEW_PROGRESS_INTERVAL = float(os.getenv("REVIEW_PROGRESS_INTERVAL", "10"))
+
+# ==================== 指标配置 ====================
+# 多进程部署时各进程指标快照的共享目录（留空则 /metrics 只输出当前进程的指标）
+METRICS_DIR = os.getenv("METRICS_DIR", "data/metrics")
+# 快照写入间隔（秒）
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+# ==================== 追踪配置 ====================
+# 每次审查的span写入该目录（留空关闭），格式为 jsonl（每行一个span）或 chrome（chrome://tracing / Perfetto）
+TRACE_DIR = os.getenv("TRACE_DIR", "data/traces")
+TRACE_FORMAT = os.getenv("TRACE_FORMAT", "jsonl")
+# 最多保留的追踪文件数，超出后删除最旧的
+TRACE_MAX_FILES = int(os.getenv("TRACE_MAX_FILES", "500"))
+
+# ==================== 审查结果缓存配置 ====================
+# 按代码变更内容哈希缓存AI审查结果，diff未变化时不再调用AI
+REVIEW_CACHE_DB = os.getenv("REVIEW_CACHE_DB", "data/review_cache.db")
+# 缓存容量（字节），超出后按LRU淘汰，设为0关闭缓存
+REVIEW_CACHE_MAX_BYTES = int(os.getenv("REVIEW_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+# 提示词版本，修改审查提示词逻辑后递增以使旧缓存失效
+PROMPT_VERSION = os.getenv("PROMPT_VERSION", "1")
 
 # ==================== 触发配置 ====================
 # 评论触发关键词（不区分大小写）
@@ -57,8 +152,9 @@ REVIEW_PROMPT = """
 4. 最佳实践
 5. 潜在的bug
 
-请用中文回答，格式如下：
+请用中文回答，按文件分别输出审查结果，每个文件一节，文件路径必须与变更内容中的路径完全一致，格式如下：
 
+## 文件: 文件路径
 ### 代码评分：XX分（0-100）
 
 #### ✅ 优点：
@@ -0,0 +1,139 @@
+# @cursor start
+import re
+
+HUNK_HEADER_PATTERN = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+CONTEXT = ' '
+ADDED = '+'
+REMOVED = '-'
+
+
+class DiffLine:
+    """diff中的一行：类型（' '/'+'/'-'）、新旧文件行号和内容"""
+    __slots__ = ('kind', 'old_no', 'new_no', 'text')
+
+    def __init__(self, kind, old_no, new_no, text):
+        self.kind = kind
+        self.old_no = old_no  # 新增行为None
+        self.new_no = new_no  # 删除行为None
+        self.text = text
+
+
+class DiffHunk:
+    """一个@@块"""
+    __slots__ = ('header', 'old_start', 'old_count', 'new_start', 'new_count', 'lines')
+
+    def __init__(self, header, old_start, old_count, new_start, new_count):
+        self.header = header
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+        self.lines = []
+
+    @property
+    def new_end(self):
+        """块在新文件中的最后一行"""
+        return self.new_start + max(self.new_count, 1) - 1
+
+    def added(self):
+        return [line for line in self.lines if line.kind == ADDED]
+
+    def removed(self):
+        return [line for line in self.lines if line.kind == REMOVED]
+
+    def to_text(self):
+        """还原为diff文本"""
+        return '\n'.join([self.header] + [line.kind + line.text for line in self.lines])
+
+
+class ParsedDiff:
+    """单个文件diff的解析结果，各阶段共享"""
+    __slots__ = ('raw', 'preamble', 'hunks', 'added_count', 'removed_count')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.preamble = []  # 第一个@@之前的行（如 ---/+++ 头）
+        self.hunks = []
+        self.added_count = 0
+        self.removed_count = 0
+
+    def added_lines(self):
+        return [line for hunk in self.hunks for line in hunk.lines if line.kind == ADDED]
+
+    def removed_lines(self):
+        return [line for hunk in self.hunks for line in hunk.lines if line.kind == REMOVED]
+
+    def added_line_numbers(self):
+        """可评论的新增行行号集合"""
+        return {line.new_no for line in self.added_lines()}
+
+    def added_text(self):
+        return '\n'.join(line.text for line in self.added_lines())
+
+    def removed_text(self):
+        return '\n'.join(line.text for line in self.removed_lines())
+
+
+def parse_diff(diff_content):
+    """单次遍历解析diff，记录每行的新旧行号"""
+    parsed = ParsedDiff(diff_content)
+    hunk = None
+    old_no = new_no = 0
+    for line in diff_content.split('\n'):
+        if line.startswith('@@'):
+            match = HUNK_HEADER_PATTERN.match(line)
+            if match:
+                old_no = int(match.group(1))
+                new_no = int(match.group(3))
+                hunk = DiffHunk(
+                    line, old_no, int(match.group(2) or 1), new_no, int(match.group(4) or 1)
+                )
+                parsed.hunks.append(hunk)
+                continue
+        if hunk is None:
+            parsed.preamble.append(line)
+            continue
+        kind = line[:1]
+        if kind == ADDED:
+            hunk.lines.append(DiffLine(ADDED, None, new_no, line[1:]))
+            new_no += 1
+            parsed.added_count += 1
+        elif kind == REMOVED:
+            hunk.lines.append(DiffLine(REMOVED, old_no, None, line[1:]))
+            old_no += 1
+            parsed.removed_count += 1
+        elif kind == CONTEXT:
+            hunk.lines.append(DiffLine(CONTEXT, old_no, new_no, line[1:]))
+            old_no += 1
+            new_no += 1
+        # 其余行（如 "\ No newline at end of file"、末尾空行）不影响行号
+    return parsed
+
+
+def context_windows(hunks, context_lines):
+    """
+    计算各块在新文件中需要的上下文窗口（1开始的闭区间），重叠或相邻的窗口合并
+    返回 [(start, end, [DiffHunk])]，按起始行升序
+    """
+    windows = []
+    for hunk in sorted(hunks, key=lambda h: h.new_start):
+        start = max(1, hunk.new_start - context_lines)
+        end = hunk.new_end + context_lines
+        if windows and start <= windows[-1][1] + 1:
+            prev_start, prev_end, prev_hunks = windows[-1]
+            windows[-1] = (prev_start, max(prev_end, end), prev_hunks + [hunk])
+        else:
+            windows.append((start, end, [hunk]))
+    return windows
+
+
+def parse_change(change):
+    """获取变更的解析结果，同一个change只解析一次"""
+    diff_content = change.get('diff', '')
+    parsed = change.get('_parsed_diff')
+    if parsed is None or parsed.raw is not diff_content:
+        parsed = parse_diff(diff_content)
+        change['_parsed_diff'] = parsed
+    return parsed
+# @cursor end
@@ -0,0 +1,48 @@
+# @cursor start
+import hashlib
+
+
+def body_hash(body):
+    """评论内容哈希（忽略首尾空白）"""
+    return hashlib.sha1((body or '').strip().encode('utf-8')).hexdigest()
+
+
+class DiscussionIndex:
+    """MR行内讨论索引，按 (new_path, new_line, 内容哈希) 建立集合，支持O(1)查询"""
+
+    def __init__(self):
+        self._positions = set()  # (path, line, hash)
+        self._revisions = set()  # (head_sha, path, line, hash)
+
+    @classmethod
+    def build(cls, discussions):
+        """从discussions（可为分页生成器）构建索引"""
+        index = cls()
+        for discussion in discussions:
+            index.add_discussion(discussion)
+        return index
+
+    def add_discussion(self, discussion):
+        for note in discussion.get('notes', []):
+            self.add_note(note)
+
+    def add_note(self, note):
+        position = note.get('position') or {}
+        path = position.get('new_path')
+        line = position.get('new_line') or position.get('old_line')
+        if not path or line is None:
+            return
+        digest = body_hash(note.get('body'))
+        self._positions.add((path, line, digest))
+        self._revisions.add((position.get('head_sha'), path, line, digest))
+
+    def __len__(self):
+        return len(self._positions)
+
+    def contains(self, file_path, line_number, body, head_sha=None):
+        """是否已存在相同位置、相同内容的评论；指定head_sha时只匹配该提交上的评论"""
+        digest = body_hash(body)
+        if head_sha is None:
+            return (file_path, line_number, digest) in self._positions
+        return (head_sha, file_path, line_number, digest) in self._revisions
+# @cursor end
@@ -0,0 +1,335 @@
+# @cursor start
+"""
+本地Git镜像后端：为每个项目维护一个裸镜像（git clone --mirror），缺少所需提交时才增量fetch，
+MR的diff、上下文和文件内容都按diff_refs中的SHA用本地git命令计算，不再逐文件调用REST接口；
+镜像不可用（未配置、fetch失败、提交不存在）时退回GitLabClient的REST实现
+"""
+import base64
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+from config import (
+    GITLAB_URL, GITLAB_TOKEN, GITLAB_DIFFS_PER_PAGE, GIT_MIRROR_DIR, GIT_MIRROR_URL_TEMPLATE, GIT_MIRROR_FETCH_TIMEOUT
+)
+from cache_store import is_commit_sha
+from gitlab_client import GitLabClient
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# 本地读取类git命令（diff、cat-file）的超时（秒）
+GIT_COMMAND_TIMEOUT = 60
+
+
+class GitMirrorError(Exception):
+    """镜像操作失败（git命令出错、超时或所需提交不存在）"""
+
+
+class GitMirror:
+    """单个项目的裸镜像；同一镜像的clone/fetch在进程内和进程间（文件锁）都串行执行"""
+
+    def __init__(self, path, clone_url, auth_header=None):
+        self.path = path
+        self.clone_url = clone_url
+        self.auth_header = auth_header  # 只在clone/fetch时通过环境变量传入，不写入镜像配置，也不出现在命令行中
+        self._lock = threading.Lock()
+        self._known_commits = set()
+
+    def _git(self, *args, timeout=GIT_COMMAND_TIMEOUT, in_repo=True):
+        command = ['git']
+        if in_repo:
+            command += ['--git-dir', self.path]
+        command += list(args)
+        env = None
+        if self.auth_header and args[0] in ('clone', 'fetch'):
+            # 命令行参数对本机所有用户可见（ps、/proc），认证头通过GIT_CONFIG_*环境变量传递
+            env = dict(os.environ)
+            index = int(env.get('GIT_CONFIG_COUNT') or 0)
+            env.update({
+                'GIT_CONFIG_COUNT': str(index + 1),
+                f'GIT_CONFIG_KEY_{index}': 'http.extraHeader',
+                f'GIT_CONFIG_VALUE_{index}': self.auth_header
+            })
+        try:
+            result = subprocess.run(command, capture_output=True, timeout=timeout, env=env)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise GitMirrorError(f"git {args[0]} 执行失败: {e}")
+        if result.returncode != 0:
+            stderr = result.stderr.decode('utf-8', errors='replace').strip()
+            raise GitMirrorError(f"git {args[0]} 失败: {stderr[:500]}")
+        return result.stdout
+
+    @contextmanager
+    def _file_lock(self):
+        """多个worker进程共享镜像目录，clone/fetch期间持有文件锁"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def has_commit(self, sha):
+        if sha in self._known_commits:
+            return True
+        try:
+            self._git('cat-file', '-e', f"{sha}^{{commit}}")
+        except GitMirrorError:
+            return False
+        self._known_commits.add(sha)
+        return True
+
+    def ensure_commits(self, *shas):
+        """保证提交都在镜像中：首次使用时clone，缺少提交时fetch一次，fetch后仍缺少则抛出GitMirrorError"""
+        shas = [sha for sha in shas if sha]
+        if os.path.isdir(self.path) and all(self.has_commit(sha) for sha in shas):
+            return
+        with self._lock, self._file_lock():
+            if not os.path.isdir(self.path):
+                self._clone()
+            elif not all(self.has_commit(sha) for sha in shas):
+                with span('git_fetch', mirror=os.path.basename(self.path)):
+                    # 镜像的refspec为+refs/*:refs/*，包含GitLab的refs/merge-requests/*（来自fork的MR也能取到）
+                    self._git('fetch', '--prune', 'origin', timeout=GIT_MIRROR_FETCH_TIMEOUT)
+        missing = [sha for sha in shas if not self.has_commit(sha)]
+        if missing:
+            raise GitMirrorError(f"镜像中不存在提交 {', '.join(missing)}")
+
+    def _clone(self):
+        """先clone到临时目录再改名，避免中断时留下不完整的镜像"""
+        temp_path = tempfile.mkdtemp(prefix='.clone-', dir=os.path.dirname(self.path))
+        try:
+            with span('git_clone', mirror=os.path.basename(self.path)):
+                self._git('clone', '--mirror', '--quiet', self.clone_url, temp_path,
+                          timeout=GIT_MIRROR_FETCH_TIMEOUT, in_repo=False)
+            os.rename(temp_path, self.path)
+            logger.info(f"已创建Git镜像: {self.path}")
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def diff(self, base_sha, head_sha):
+        """
+        计算两个提交间的变更，返回与GitLab /diffs接口相同结构的列表
+        （diff只包含从第一个@@开始的内容，二进制文件和只改权限的文件diff为空）
+        """
+        self.ensure_commits(base_sha, head_sha)
+        patch = self._git(
+            '-c', 'core.quotePath=false', 'diff', '-M', '-U3', '--no-color', '--no-ext-diff',
+            '--src-prefix=a/', '--dst-prefix=b/', base_sha, head_sha
+        ).decode('utf-8', errors='replace')
+        changes = []
+        for section in ('\n' + patch).split('\ndiff --git ')[1:]:
+            change = _parse_patch_section(section)
+            previous = changes[-1] if changes else None
+            if previous and previous['deleted_file'] and change['new_file'] and previous['new_path'] == change['new_path']:
+                # 类型变化（普通文件与符号链接互换）输出为同一路径的删除+新增两节，合并为一个变更
+                previous.update(new_file=False, deleted_file=False, diff=previous['diff'] + change['diff'])
+                continue
+            changes.append(change)
+        return changes
+
+    def read_file(self, sha, file_path):
+        """读取提交中的文件内容，文件不存在时返回None"""
+        self.ensure_commits(sha)
+        try:
+            content = self._git('cat-file', 'blob', f"{sha}:{file_path}")
+        except GitMirrorError:
+            return None
+        return content.decode('utf-8', errors='replace')
+
+    def file_metadata(self, sha, file_path):
+        """文件的blob SHA和大小（不读取内容），文件不存在时返回None"""
+        self.ensure_commits(sha)
+        try:
+            output = self._git('ls-tree', '-l', '-z', sha, '--', file_path)
+        except GitMirrorError:
+            return None
+        # <mode> SP <type> SP <object> SP+ <size> TAB <path>
+        fields = output.split(b'\t', 1)[0].split()
+        if len(fields) != 4 or fields[1] != b'blob':
+            return None
+        return {'blob_id': fields[2].decode(), 'size': int(fields[3])}
+
+
+def _unquote_path(path):
+    """还原git对特殊字符路径的C风格引号转义（如 "a/\\346\\226\\207.py"）"""
+    if not (path.startswith('"') and path.endswith('"')):
+        return path
+    raw = bytearray()
+    body = path[1:-1]
+    index = 0
+    escapes = {'n': 10, 't': 9, '"': 34, '\\': 92, 'a': 7, 'b': 8, 'f': 12, 'r': 13, 'v': 11}
+    while index < len(body):
+        char = body[index]
+        if char == '\\' and index + 1 < len(body):
+            if body[index + 1] in '01234567':
+                raw.append(int(body[index + 1:index + 4], 8))
+                index += 4
+                continue
+            raw.append(escapes.get(body[index + 1], ord(body[index + 1])))
+            index += 2
+            continue
+        raw += char.encode('utf-8')
+        index += 1
+    return raw.decode('utf-8', errors='replace')
+
+
+def _strip_prefix(path, prefix):
+    path = _unquote_path(path.rstrip('\t'))
+    return path[len(prefix):] if path.startswith(prefix) else path
+
+
+def _parse_patch_section(section):
+    """
+    解析 git diff 输出中的一个文件节（已去掉开头的 "diff --git "），路径取自该节自身的文件头：
+    rename/copy from/to 行、---/+++ 行，二者都没有时（二进制、只改权限）取自 "a/路径 b/路径" 行（两侧路径相同）
+    """
+    header, _, hunks = section.partition('\n@@')
+    lines = header.split('\n')
+    old_path = new_path = None
+    flags = {'new_file': False, 'deleted_file': False, 'renamed_file': False}
+    for line in lines[1:]:
+        if line.startswith('new file mode'):
+            flags['new_file'] = True
+        elif line.startswith('deleted file mode'):
+            flags['deleted_file'] = True
+        elif line.startswith(('rename from ', 'copy from ')):
+            flags['renamed_file'] = line.startswith('rename')
+            old_path = _unquote_path(line.split(' ', 2)[2])
+        elif line.startswith(('rename to ', 'copy to ')):
+            new_path = _unquote_path(line.split(' ', 2)[2])
+        elif line.startswith('--- ') and line != '--- /dev/null':
+            old_path = old_path or _strip_prefix(line[4:], 'a/')
+        elif line.startswith('+++ ') and line != '+++ /dev/null':
+            new_path = new_path or _strip_prefix(line[4:], 'b/')
+    if old_path is None or new_path is None:
+        first = lines[0]
+        if first.startswith('"'):
+            # 带引号的路径："a/..." "b/..."
+            quoted_end = first.index('" ', 1) + 1
+            paths = (_strip_prefix(first[:quoted_end], 'a/'), _strip_prefix(first[quoted_end + 1:], 'b/'))
+        else:
+            # 两侧路径相同时行为 "a/P b/P"，按长度切分（路径中可以有空格）
+            length = (len(first) - 5) // 2
+            paths = (first[2:2 + length], first[2:2 + length])
+        old_path = old_path or paths[0]
+        new_path = new_path or paths[1]
+    old_path = old_path if old_path is not None else new_path
+    new_path = new_path if new_path is not None else old_path
+    diff = ('@@' + hunks).rstrip('\n') + '\n' if hunks else ''
+    return dict(flags, old_path=old_path, new_path=new_path, diff=diff)
+
+
+class MirrorStore:
+    """按项目管理镜像，镜像目录为 <root>/<project_id>.git"""
+
+    def __init__(self, root, url_resolver, auth_header=None):
+        self.root = root
+        self.url_resolver = url_resolver
+        self.auth_header = auth_header
+        self._mirrors = {}
+        self._lock = threading.Lock()
+
+    def get(self, project_id):
+        with self._lock:
+            mirror = self._mirrors.get(str(project_id))
+        if mirror is not None:
+            return mirror
+        clone_url = self.url_resolver(project_id)  # 可能需要请求项目信息，不持有锁
+        # 认证头只发送给HTTP地址（本地路径、file://和SSH地址不需要）
+        auth_header = self.auth_header if clone_url.startswith(('http://', 'https://')) else None
+        with self._lock:
+            return self._mirrors.setdefault(str(project_id), GitMirror(
+                os.path.join(self.root, f"{project_id}.git"), clone_url, auth_header
+            ))
+
+
+class MirrorGitLabClient(GitLabClient):
+    """
+    变更、上下文和文件内容优先从本地镜像读取，MR信息、评论等仍使用REST接口；
+    镜像出错时记录警告并退回REST实现，不影响审查
+    """
+
+    def __init__(self, mirror_dir=GIT_MIRROR_DIR, url_template=GIT_MIRROR_URL_TEMPLATE):
+        super().__init__()
+        self.url_template = url_template
+        # GitLab的HTTP克隆接受 oauth2:<访问令牌> 形式的Basic认证
+        token = base64.b64encode(f"oauth2:{GITLAB_TOKEN}".encode()).decode()
+        self.mirrors = MirrorStore(mirror_dir, self._clone_url, f"Authorization: Basic {token}")
+
+    def _clone_url(self, project_id):
+        """URL模板支持 {project_id} 和 {path}（项目完整路径，需要请求一次项目信息）；未配置模板时使用项目的HTTP克隆地址"""
+        if self.url_template and '{path}' not in self.url_template:
+            return self.url_template.format(project_id=project_id)
+        url = f"{GITLAB_URL}/api/v4/projects/{quote(str(project_id), safe='')}"
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        project = response.json()
+        if self.url_template:
+            return self.url_template.format(project_id=project_id, path=project['path_with_namespace'])
+        return project['http_url_to_repo']
+
+    def _mirror(self, project_id):
+        try:
+            return self.mirrors.get(project_id)
+        except Exception as e:
+            raise GitMirrorError(f"无法确定项目 {project_id} 的克隆地址: {e}")
+
+    def iter_merge_request_changes(self, project_id, mr_iid, diff_refs=None, per_page=GITLAB_DIFFS_PER_PAGE,
+                                   path_filter=None):
+        base_sha = (diff_refs or {}).get('base_sha')
+        head_sha = (diff_refs or {}).get('head_sha')
+        if base_sha and head_sha:
+            try:
+                changes = self._mirror(project_id).diff(base_sha, head_sha)
+            except GitMirrorError as e:
+                logger.warning(f"从Git镜像计算MR {mr_iid} 的diff失败，改用REST接口: {e}")
+            else:
+                yield from changes
+                return
+        yield from super().iter_merge_request_changes(project_id, mr_iid, diff_refs, per_page, path_filter)
+
+    def get_file_content(self, project_id, file_path, branch="main"):
+        # 分支名对应的内容随时变化，只有提交SHA从镜像读取
+        if is_commit_sha(branch):
+            try:
+                return self._mirror(project_id).read_file(branch, file_path)
+            except GitMirrorError as e:
+                logger.warning(f"从Git镜像读取 {file_path} 失败，改用REST接口: {e}")
+        return super().get_file_content(project_id, file_path, branch)
+
+    def get_file_metadata(self, project_id, file_path, branch="main"):
+        if is_commit_sha(branch):
+            try:
+                return self._mirror(project_id).file_metadata(branch, file_path)
+            except GitMirrorError as e:
+                logger.warning(f"从Git镜像读取 {file_path} 失败，改用REST接口: {e}")
+        return super().get_file_metadata(project_id, file_path, branch)
+
+    def get_file_lines(self, project_id, file_path, ranges, branch="main"):
+        if is_commit_sha(branch):
+            try:
+                content = self._mirror(project_id).read_file(branch, file_path)
+            except GitMirrorError as e:
+                logger.warning(f"从Git镜像读取 {file_path} 失败，改用REST接口: {e}")
+            else:
+                if content is None:
+                    return None
+                lines = content.splitlines()
+                return [lines[start - 1:end] for start, end in ranges]
+        return super().get_file_lines(project_id, file_path, ranges, branch)
+
+
+def create_gitlab_client():
+    """配置了GIT_MIRROR_DIR时使用本地镜像后端，否则只使用REST接口"""
+    if GIT_MIRROR_DIR:
+        return MirrorGitLabClient()
+    return GitLabClient()
+# @cursor end
@@ -1,9 +1,28 @@
 # @cursor start
+import codecs
+import difflib
+import itertools
+import logging
 import gitlab
 import requests
 from retrying import retry
-from config import GITLAB_URL, GITLAB_TOKEN
-import re
+from config import (
+    GITLAB_URL, GITLAB_TOKEN, GITLAB_POOL_SIZE, GITLAB_CONNECT_TIMEOUT, GITLAB_READ_TIMEOUT,
+    GITLAB_DIFFS_PER_PAGE, GITLAB_BLOB_DIFF_MAX_BYTES
+)
+from http_session import create_session
+from metrics import retry_wait
+from mr_context import MergeRequestContext
+from comment_poster import InlineCommentPoster
+from discussion_index import DiscussionIndex
+from diff_parser import parse_diff, parse_change
+
+logger = logging.getLogger(__name__)
+
+# 流式读取文件时每次读取的字节数
+STREAM_CHUNK_SIZE = 64 * 1024
+# 触发审查的Merge Request事件动作（object_attributes.action）
+MERGE_REQUEST_OPEN_ACTIONS = ('open', 'reopen')
 
 class GitLabClient:
     """GitLab API客户端"""
@@ -11,165 +30,346 @@ class GitLabClient:
     def __init__(self):
         self.gl = gitlab.Gitlab(url=GITLAB_URL, private_token=GITLAB_TOKEN)
         self.headers = {"PRIVATE-TOKEN": GITLAB_TOKEN}
+        # 共享连接池，所有请求复用keep-alive连接
+        self.session = create_session(GITLAB_POOL_SIZE, self.headers, backend="gitlab")
+        self.timeout = (GITLAB_CONNECT_TIMEOUT, GITLAB_READ_TIMEOUT)
+    
+    @retry(stop_max_attempt_number=3, wait_func=retry_wait('gitlab', 'get_merge_request_with_changes', 2000))
+    def get_merge_request_with_changes(self, project_id, mr_iid):
+        """获取Merge Request信息及代码变更（含diff_refs，一次请求）"""
+        url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/changes"
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
     
-    @retry(stop_max_attempt_number=3, wait_fixed=2000)
     def get_merge_request_changes(self, project_id, mr_iid):
         """获取Merge Request的代码变更"""
-        url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/changes"
-        response = requests.get(url, headers=self.headers)
+        diff_refs = self.get_merge_request_info(project_id, mr_iid).get('diff_refs')
+        return list(self.iter_merge_request_changes(project_id, mr_iid, diff_refs))
+    
+    @retry(stop_max_attempt_number=3, wait_func=retry_wait('gitlab', 'get_merge_request_diffs', 2000))
+    def _get_diffs_page(self, project_id, mr_iid, page, per_page):
+        """获取一页文件diff；实例不支持 /diffs 接口（GitLab 15.7以前）时返回None"""
+        url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/diffs"
+        response = self.session.get(url, params={"page": page, "per_page": per_page}, timeout=self.timeout)
+        if response.status_code == 404 and page == 1:
+            return None
         response.raise_for_status()
-        return response.json()["changes"]
+        return response
     
-    @retry(stop_max_attempt_number=3, wait_fixed=2000)
+    def iter_merge_request_changes(self, project_id, mr_iid, diff_refs=None, per_page=GITLAB_DIFFS_PER_PAGE,
+                                   path_filter=None):
+        """
+        分页获取MR的代码变更（生成器，逐个文件返回），同一时间只持有一页响应
+        diff被GitLab截断（too_large/collapsed）的文件按diff_refs的原始文件重新计算diff，
+        path_filter(new_path)为假的文件（调用方不审查）原样返回，不下载原始文件；
+        实例不支持 /diffs 接口时退回一次性的 /changes 接口
+        """
+        page = 1
+        while page:
+            response = self._get_diffs_page(project_id, mr_iid, page, per_page)
+            if response is None:
+                logger.info("GitLab不支持 /diffs 接口，改用 /changes 获取MR变更")
+                mr_data = self.get_merge_request_with_changes(project_id, mr_iid)
+                if mr_data.get('overflow'):
+                    logger.warning(f"MR {mr_iid} 的 /changes 结果被GitLab截断，部分文件不会被审查")
+                for change in mr_data.get('changes', []):
+                    yield self._complete_diff(project_id, change, diff_refs or mr_data.get('diff_refs'), path_filter)
+                return
+            diffs = response.json()
+            for change in diffs:
+                yield self._complete_diff(project_id, change, diff_refs, path_filter)
+            page = _next_page(response, page, len(diffs), per_page)
+    
+    def _complete_diff(self, project_id, change, diff_refs, path_filter=None):
+        """
+        diff被截断时用原始文件重新计算，无法计算时保留原样（too_large仍为真，由调用方跳过）
+        下载原始文件出错（5xx、超时等）只跳过该文件，不影响整个审查
+        """
+        if not is_truncated_diff(change) or not diff_refs:
+            return change
+        file_path = change.get('new_path')
+        if path_filter is not None and not path_filter(file_path):
+            return change
+        try:
+            diff = self.build_blob_diff(project_id, change, diff_refs)
+        except requests.RequestException as e:
+            logger.warning(f"文件 {file_path} 的diff被GitLab截断，下载原始文件失败，跳过该文件: {e}")
+            return dict(change, too_large=True)
+        if diff is None:
+            logger.warning(f"文件 {file_path} 的diff被GitLab截断，且文件过大或为二进制，无法重新计算")
+            return dict(change, too_large=True)
+        logger.info(f"文件 {file_path} 的diff被GitLab截断，已按原始文件重新计算")
+        return dict(change, diff=diff, too_large=False, collapsed=False)
+    
+    def build_blob_diff(self, project_id, change, diff_refs):
+        """
+        按base_sha和head_sha的原始文件计算unified diff（与GitLab的diff格式一致，不含---/+++文件头）
+        任一文件超过GITLAB_BLOB_DIFF_MAX_BYTES或为二进制时返回None
+        """
+        old_lines = [] if change.get('new_file') else \
+            self._get_blob_lines(project_id, change.get('old_path'), diff_refs.get('base_sha'))
+        new_lines = [] if change.get('deleted_file') else \
+            self._get_blob_lines(project_id, change.get('new_path'), diff_refs.get('head_sha'))
+        if old_lines is None or new_lines is None:
+            return None
+        diff = difflib.unified_diff(old_lines, new_lines, lineterm='')
+        lines = list(itertools.islice(diff, 2, None))  # 跳过---/+++文件头
+        return '\n'.join(lines) + '\n' if lines else ''
+    
+    def _get_blob_lines(self, project_id, file_path, ref):
+        """流式下载原始文件，超过大小上限或为二进制时提前停止并返回None"""
+        encoded_path = file_path.replace('/', '%2F')
+        url = f"{GITLAB_URL}/api/v4/projects/{project_id}/repository/files/{encoded_path}/raw"
+        with self.session.get(url, params={"ref": ref}, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 404:
+                return []
+            response.raise_for_status()
+            content = bytearray()
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                content += chunk
+                if len(content) > GITLAB_BLOB_DIFF_MAX_BYTES or b'\0' in chunk:
+                    return None
+        return content.decode('utf-8', errors='replace').splitlines()
+    
+    @retry(stop_max_attempt_number=3, wait_func=retry_wait('gitlab', 'get_merge_request_info', 2000))
     def get_merge_request_info(self, project_id, mr_iid):
         """获取Merge Request信息"""
         url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}"
-        response = requests.get(url, headers=self.headers)
+        response = self.session.get(url, timeout=self.timeout)
         response.raise_for_status()
         return response.json()
     
-    @retry(stop_max_attempt_number=3, wait_fixed=2000)
+    @retry(stop_max_attempt_number=3, wait_func=retry_wait('gitlab', 'add_comment', 2000))
     def add_comment(self, project_id, mr_iid, comment):
         """在Merge Request中添加评论"""
         url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/notes"
         data = {"body": comment}
-        response = requests.post(url, headers=self.headers, json=data)
+        response = self.session.post(url, json=data, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    @retry(stop_max_attempt_number=3, wait_func=retry_wait('gitlab', 'update_comment', 2000))
+    def update_comment(self, project_id, mr_iid, note_id, comment):
+        """修改Merge Request中已有的评论"""
+        url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/notes/{note_id}"
+        data = {"body": comment}
+        response = self.session.put(url, json=data, timeout=self.timeout)
         response.raise_for_status()
         return response.json()
 
     def extract_diff_new_lines(self, diff_content):
         """解析diff，返回所有可评论的new_line行号和内容"""
-        results = []
-        diff_lines = diff_content.split('\n')
-        new_line_num = None
-        for line in diff_lines:
-            if line.startswith('@@'):
-                m = re.match(r'@@ -\\d+(?:,\\d+)? \\+(\\d+)(?:,\\d+)? @@', line)
-                if m:
-                    new_line_num = int(m.group(1))
-                continue
-            if line.startswith('+') and not line.startswith('+++'):
-                if new_line_num is not None:
-                    results.append((new_line_num, line[1:]))  # (new_line, 代码内容)
-                    new_line_num += 1
-            elif line.startswith('-') and not line.startswith('---'):
-                continue
-            else:
-                if new_line_num is not None:
-                    new_line_num += 1
-        return results
-
-    @retry(stop_max_attempt_number=3, wait_fixed=2000)
-    def add_inline_comment(self, project_id, mr_iid, file_path, line_number, comment, line_type="new"):
-        """
-        在Merge Request中添加行内评论（只对diff变更+号行）
-        """
-        mr_info = self.get_merge_request_info(project_id, mr_iid)
-        diff_refs = mr_info.get('diff_refs', {})
-        if not diff_refs:
-            raise Exception("无法获取MR的diff_refs")
-        url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/discussions"
-        position_data = {
+        return [(line.new_no, line.text) for line in parse_diff(diff_content).added_lines()]
+
+    def build_inline_position(self, diff_refs, file_path, line_number, line_type="new"):
+        """构造行内评论的position参数（line_type为old时评论删除行）"""
+        position = {
             "base_sha": diff_refs.get('base_sha'),
             "start_sha": diff_refs.get('start_sha'),
             "head_sha": diff_refs.get('head_sha'),
             "position_type": "text",
-            "new_path": file_path,
-            "new_line": line_number
+            "new_path": file_path
         }
+        if line_type == "old":
+            position["old_path"] = file_path
+            position["old_line"] = line_number
+        else:
+            position["new_line"] = line_number
+        return position
+
+    def post_discussion(self, project_id, mr_iid, body, position):
+        """创建带position的讨论，返回原始响应（由调用方处理状态码和限流头）"""
+        url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/discussions"
         data = {
-            "body": comment,
-            "position": position_data
+            "body": body,
+            "position": position
         }
-        response = requests.post(url, headers=self.headers, json=data)
+        return self.session.post(url, json=data, timeout=self.timeout)
+
+    @retry(stop_max_attempt_number=3, wait_func=retry_wait('gitlab', 'add_inline_comment', 2000))
+    def add_inline_comment(self, project_id, mr_iid, file_path, line_number, comment, line_type="new", diff_refs=None):
+        """
+        在Merge Request中添加行内评论（只对diff变更+号行）
+        diff_refs: 调用方已获取的MR diff_refs，未提供时才请求MR信息
+        """
+        if diff_refs is None:
+            diff_refs = self.get_merge_request_info(project_id, mr_iid).get('diff_refs', {})
+        if not diff_refs:
+            raise Exception("无法获取MR的diff_refs")
+        position_data = self.build_inline_position(diff_refs, file_path, line_number, line_type)
+        response = self.post_discussion(project_id, mr_iid, comment, position_data)
         if response.status_code != 201:
-            print(f"❌ 行内评论添加失败: {response.status_code}")
-            print(f"   响应: {response.text}")
+            logger.error(f"行内评论添加失败: {response.status_code} {response.text[:200]}")
             response.raise_for_status()
         return response.json()
 
-    def get_visible_inline_comments_count(self, project_id, mr_iid, file_path, line_numbers, ai_comments):
-        """
-        统计真正可见的行内评论数（拉取discussions校验）
-        """
+    def iter_merge_request_discussions(self, project_id, mr_iid, per_page=100):
+        """分页获取MR的全部讨论（生成器，逐页返回）"""
         url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/discussions"
-        resp = requests.get(url, headers=self.headers)
-        discussions = resp.json()
-        count = 0
-        for d in discussions:
-            notes = d.get('notes', [])
-            for note in notes:
-                pos = note.get('position', {})
-                if (pos.get('new_path') == file_path and
-                    pos.get('new_line') in line_numbers and
-                    note.get('body') in ai_comments):
-                    count += 1
-        return count
-
-    def add_multiple_inline_comments(self, project_id, mr_iid, ai_comment_func):
+        page = 1
+        while page:
+            response = self.session.get(url, params={"page": page, "per_page": per_page}, timeout=self.timeout)
+            response.raise_for_status()
+            discussions = response.json()
+            yield from discussions
+            page = _next_page(response, page, len(discussions), per_page)
+
+    def get_discussion_index(self, project_id, mr_iid):
+        """一次分页拉取MR讨论并建立索引"""
+        return DiscussionIndex.build(self.iter_merge_request_discussions(project_id, mr_iid))
+
+    def add_inline_comments(self, project_id, mr_iid, inline_comments, mr_context=None, discussion_index=None):
         """
-        批量添加行内评论：只对diff变更+号行，AI评论自动绑定，统计真正可见评论数
-        ai_comment_func: (file_path, line_number, code_line) -> str
+        只在AI给出评论的(文件, 行)位置发布行内评论，按文件分组，统计真正可见评论数
+        inline_comments: [{'file_path', 'line_number', 'line_type', 'comment'}]
+        mr_context: 本次审查的MergeRequestContext，复用已获取的变更和diff_refs
+        discussion_index: 已构建的DiscussionIndex，未提供时分页拉取一次
         """
-        changes = self.get_merge_request_changes(project_id, mr_iid)
-        count = 0
-        visible_count = 0
-        for change in changes:
-            file_path = change.get('new_path', change.get('old_path', 'unknown'))
-            diff_content = change.get('diff', '')
-            diff_lines = self.extract_diff_new_lines(diff_content)
-            ai_comments = []
-            line_numbers = []
-            for line_number, code_line in diff_lines:
-                comment = ai_comment_func(file_path, line_number, code_line)
-                ai_comments.append(comment)
-                line_numbers.append(line_number)
-                try:
-                    self.add_inline_comment(
-                        project_id=project_id,
-                        mr_iid=mr_iid,
-                        file_path=file_path,
-                        line_number=line_number,
-                        comment=comment,
-                        line_type="new"
-                    )
-                    print(f"✅ 行内评论成功: {file_path}:{line_number}")
-                    count += 1
-                except Exception as e:
-                    print(f"❌ 行内评论失败: {file_path}:{line_number} {e}")
-            # 统计本文件真正可见的评论数
-            if line_numbers and ai_comments:
-                visible = self.get_visible_inline_comments_count(project_id, mr_iid, file_path, line_numbers, ai_comments)
-                visible_count += visible
-        print(f"共尝试添加 {count} 个行内评论（仅diff变更+号行），真正可见 {visible_count} 个")
+        if mr_context is None:
+            mr_context = MergeRequestContext.load(self, project_id, mr_iid)
+        diff_refs = mr_context.diff_refs
+        if not diff_refs:
+            raise Exception("无法获取MR的diff_refs")
+        
+        comments_by_file = {}
+        for comment in inline_comments:
+            comments_by_file.setdefault(comment['file_path'], []).append(comment)
+        changes_by_path = {
+            change.get('new_path'): change
+            for change in mr_context.changes if change.get('new_path') in comments_by_file
+        }
+        
+        # 已有讨论只拉取一次，用于跳过同一head_sha上已发布过的评论和校验可见性
+        if discussion_index is None:
+            discussion_index = self.get_discussion_index(project_id, mr_iid)
+        head_sha = diff_refs.get('head_sha')
+        
+        # 只解析有评论的文件，新增行位置必须是diff中的+号行
+        comments = []
+        skipped = 0
+        for file_path, file_comments in comments_by_file.items():
+            change = changes_by_path.get(file_path)
+            commentable_lines = parse_change(change).added_line_numbers() if change else set()
+            for comment in sorted(file_comments, key=lambda c: c['line_number']):
+                if comment.get('line_type', 'new') == 'new' and comment['line_number'] not in commentable_lines:
+                    logger.warning(f"跳过不在diff新增行上的评论: {file_path}:{comment['line_number']}")
+                    continue
+                if discussion_index.contains(file_path, comment['line_number'], comment['comment'], head_sha):
+                    skipped += 1
+                    continue
+                comments.append(comment)
+        
+        # 并发发布，遵循GitLab限流响应头
+        summary = InlineCommentPoster(self).post_all(project_id, mr_iid, comments, diff_refs)
+        
+        # 用创建接口返回的讨论更新索引，按集合校验真正可见的评论数
+        for result in summary['results']:
+            if result.get('discussion'):
+                discussion_index.add_discussion(result['discussion'])
+        visible_count = sum(
+            1 for result in summary['results']
+            if result['status'] == 'posted' and discussion_index.contains(
+                result['file_path'], result['line_number'], result['comment']
+            )
+        )
+        logger.info(f"共尝试添加 {len(comments)} 个行内评论，成功 {summary['posted']} 个，真正可见 {visible_count} 个，"
+                    f"跳过已发布 {skipped} 个")
+        return visible_count
 
     def get_file_content(self, project_id, file_path, branch="main"):
         """获取文件内容"""
         encoded_path = file_path.replace('/', '%2F')
         url = f"{GITLAB_URL}/api/v4/projects/{project_id}/repository/files/{encoded_path}/raw"
         params = {"ref": branch}
-        response = requests.get(url, headers=self.headers, params=params)
+        response = self.session.get(url, params=params, timeout=self.timeout)
         if response.status_code == 200:
             return response.text
         return None
+
+    def get_file_metadata(self, project_id, file_path, branch="main"):
+        """
+        只获取文件元数据（HEAD请求，不下载内容），返回 {'blob_id': git blob SHA, 'size': 字节数}
+        文件不存在时返回None
+        """
+        encoded_path = file_path.replace('/', '%2F')
+        url = f"{GITLAB_URL}/api/v4/projects/{project_id}/repository/files/{encoded_path}"
+        response = self.session.head(url, params={"ref": branch}, timeout=self.timeout)
+        if response.status_code != 200:
+            return None
+        return {
+            'blob_id': response.headers.get('X-Gitlab-Blob-Id'),
+            'size': int(response.headers.get('X-Gitlab-Size') or 0)
+        }
+
+    def get_file_lines(self, project_id, file_path, ranges, branch="main"):
+        """
+        流式读取文件，只保留ranges内的行，读完最后一个区间即停止下载
+        ranges: [(start, end)]，1开始的闭区间，升序且互不重叠
+        返回与ranges一一对应的行列表（超出文件末尾的部分被截掉），文件不存在时返回None
+        """
+        encoded_path = file_path.replace('/', '%2F')
+        url = f"{GITLAB_URL}/api/v4/projects/{project_id}/repository/files/{encoded_path}/raw"
+        params = {"ref": branch}
+        with self.session.get(url, params=params, timeout=self.timeout, stream=True) as response:
+            if response.status_code != 200:
+                return None
+            slices = [[] for _ in ranges]
+            index = 0
+            for line_no, line in enumerate(_iter_lines(response), 1):
+                while index < len(ranges) and line_no > ranges[index][1]:
+                    index += 1
+                if index == len(ranges):
+                    break
+                if line_no >= ranges[index][0]:
+                    slices[index].append(line)
+            return slices
     
     def get_project_files(self, project_id, branch="main", path=""):
         """获取项目文件列表"""
         url = f"{GITLAB_URL}/api/v4/projects/{project_id}/repository/tree"
         params = {"ref": branch, "path": path, "recursive": "true"}
-        response = requests.get(url, headers=self.headers, params=params)
+        response = self.session.get(url, params=params, timeout=self.timeout)
         if response.status_code == 200:
             files = response.json()
             return [file["path"] for file in files if file["type"] == "blob"]
         return []
     
     def is_merge_request_opened(self, webhook_data):
-        """判断是否是Merge Request打开事件"""
+        """判断是否是Merge Request打开（或重新打开）事件；更新、审批、编辑等其他动作不触发审查"""
         try:
             attributes = webhook_data.get("object_attributes", {})
-            state = attributes.get("state")
-            action = webhook_data.get("object_kind")
-            return action == "merge_request" and state == "opened"
+            return (webhook_data.get("object_kind") == "merge_request"
+                    and attributes.get("action") in MERGE_REQUEST_OPEN_ACTIONS)
         except Exception:
             return False
+
+
+def is_truncated_diff(change):
+    """GitLab因文件过大未返回（或折叠了）该文件的diff"""
+    return bool(change.get('too_large') or (change.get('collapsed') and not change.get('diff')))
+
+
+def _next_page(response, page, count, per_page):
+    """下一页页码，没有下一页时返回None"""
+    next_page = response.headers.get('X-Next-Page')
+    if next_page:
+        return int(next_page)
+    if 'X-Next-Page' not in response.headers and count == per_page:
+        return page + 1  # 未返回分页头时按页大小推断
+    return None
+
+
+def _iter_lines(response):
+    """按行增量解码响应体（UTF-8），不保留换行符"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+        pending += decoder.decode(chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        yield from lines
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
 # @cursor end 
\ No newline at end of file
@@ -0,0 +1,27 @@
+# @cursor start
+"""
+gunicorn配置（生产模式）：gunicorn -c gunicorn.conf.py app:app
+
+每个工作进程各自运行审查线程池，通过同一个SQLite任务队列协调；
+webhook请求只做过滤和入队，GitLab超时重试前即可返回
+"""
+from config import HOST, PORT, WEB_WORKERS, WEB_THREADS
+
+bind = f"{HOST}:{PORT}"
+workers = WEB_WORKERS
+worker_class = "gthread"
+threads = WEB_THREADS
+# webhook突发时的连接等待队列长度
+backlog = 2048
+keepalive = 5
+timeout = 30
+graceful_timeout = 30
+# 不预加载应用：审查工作线程在各工作进程fork之后启动
+preload_app = False
+
+
+def worker_exit(server, worker):
+    """工作进程退出时停止领取新任务（运行中的任务在重启后由队列恢复）"""
+    import app
+    app.review_scheduler.stop(timeout=5)
+# @cursor end
@@ -0,0 +1,52 @@
+# @cursor start
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import record_http
+from tracing import span
+
+
+class InstrumentedSession(requests.Session):
+    """记录每个请求的状态、耗时和字节数（按后端统计指标，审查中的请求同时记录为span）"""
+
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+
+    def request(self, method, url, *args, **kwargs):
+        with span(f"{self.backend} {method}", path=urlsplit(url).path) as item:
+            start = time.perf_counter()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.RequestException as e:
+                record_http(self.backend, type(e).__name__, time.perf_counter() - start)
+                raise
+            record_http(self.backend, response.status_code, time.perf_counter() - start)
+            body = response.request.body
+            item.set(
+                status=response.status_code,
+                request_bytes=len(body) if body else 0,
+                response_bytes=_response_size(response, kwargs.get('stream'))
+            )
+            return response
+
+
+def _response_size(response, stream):
+    """响应体字节数；流式响应不读取内容，只取Content-Length"""
+    if stream:
+        length = response.headers.get('Content-Length')
+        return int(length) if length and length.isdigit() else None
+    return len(response.content)
+
+
+def create_session(pool_size, headers=None, backend="http"):
+    """创建带连接池（keep-alive）的HTTP会话，供多线程共享；backend用于指标标签"""
+    session = InstrumentedSession(backend)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+# @cursor end
@@ -0,0 +1,326 @@
+# @cursor start
+"""
+进程内指标，按Prometheus文本格式输出（无外部依赖）
+
+gunicorn多进程时，各进程定期把自己的指标快照写入METRICS_DIR，
+/metrics 汇总所有存活进程的数据；标记为 aggregate=False 的指标（如队列深度）只取当前进程的值
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from config import METRICS_DIR, METRICS_FLUSH_INTERVAL
+from tracing import event
+
+# 耗时分桶（秒）
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# 单次审查token数分桶
+TOKEN_BUCKETS = (500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), aggregate=True, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.aggregate = aggregate  # 多进程时是否累加各进程的值
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def set_function(self, function):
+        """采集时调用function()取值，返回 {标签值元组: 数值}"""
+        self._function = function
+
+    def samples(self):
+        """返回 [(后缀, ((标签名, 标签值), ...), 数值)]"""
+        if self._function is not None:
+            values = self._function()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [('', tuple(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, **kwargs):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, **kwargs)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """记录with块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(state[0]), state[1], state[2]) for key, state in self._values.items()}
+        samples = []
+        for key, (counts, total, count) in values.items():
+            labels = tuple(zip(self.labelnames, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                samples.append(('_bucket', labels + (('le', _format_value(bound)),), bucket_count))
+            samples.append(('_bucket', labels + (('le', '+Inf'),), count))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+class Registry:
+    """指标注册表，负责多进程汇总和文本格式输出"""
+
+    def __init__(self, shared_dir=None):
+        self.shared_dir = shared_dir
+        self._metrics = []
+        self._flusher = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def _snapshot(self):
+        """当前进程中需要跨进程累加的指标"""
+        return {
+            metric.name: [[suffix, [list(pair) for pair in labels], value] for suffix, labels, value in metric.samples()]
+            for metric in self._metrics if metric.aggregate
+        }
+
+    def flush(self):
+        """把当前进程的指标快照写入共享目录"""
+        if not self.shared_dir:
+            return
+        os.makedirs(self.shared_dir, exist_ok=True)
+        path = os.path.join(self.shared_dir, f"{os.getpid()}.json")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_flusher(self, interval=METRICS_FLUSH_INTERVAL):
+        """后台定期写入快照（多进程部署时使用）"""
+        if not self.shared_dir or self._flusher is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+                time.sleep(interval)
+
+        self._flusher = threading.Thread(target=loop, name="metrics-flusher", daemon=True)
+        self._flusher.start()
+
+    def _other_snapshots(self):
+        """读取其他存活进程的快照，已退出进程的快照直接删除"""
+        if not self.shared_dir or not os.path.isdir(self.shared_dir):
+            return []
+        snapshots = []
+        for filename in os.listdir(self.shared_dir):
+            pid, _, ext = filename.partition('.')
+            if ext != 'json' or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            path = os.path.join(self.shared_dir, filename)
+            if not _pid_alive(int(pid)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        """输出Prometheus文本格式"""
+        others = self._other_snapshots()
+        lines = []
+        for metric in self._metrics:
+            merged = {}
+            for suffix, labels, value in metric.samples():
+                merged[(suffix, labels)] = merged.get((suffix, labels), 0) + value
+            if metric.aggregate:
+                for snapshot in others:
+                    for suffix, labels, value in snapshot.get(metric.name, []):
+                        key = (suffix, tuple(tuple(pair) for pair in labels))
+                        merged[key] = merged.get(key, 0) + value
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for (suffix, labels), value in merged.items():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+REGISTRY = Registry(METRICS_DIR)
+
+# ==================== 审查流程指标 ====================
+STAGE_SECONDS = Histogram(
+    'review_bot_stage_seconds', '审查各阶段耗时（秒）', ['stage']
+)
+REVIEW_SECONDS = Histogram(
+    'review_bot_review_seconds', '审查任务总耗时（秒）', ['status']
+)
+REVIEW_JOBS = Counter(
+    'review_bot_review_jobs_total', '执行完成的审查任务数', ['status']
+)
+ACTIVE_REVIEWS = Gauge(
+    'review_bot_active_reviews', '正在执行的审查任务数'
+)
+QUEUE_JOBS = Gauge(
+    'review_bot_queue_jobs', '任务队列中各状态的任务数', ['status'], aggregate=False
+)
+REVIEW_TOKENS = Histogram(
+    'review_bot_review_tokens', '单次审查消耗的token数', ['project', 'provider'], buckets=TOKEN_BUCKETS
+)
+
+# ==================== 缓存指标 ====================
+CACHE_HITS = Counter('review_bot_cache_hits_total', '缓存命中次数', ['cache'])
+CACHE_MISSES = Counter('review_bot_cache_misses_total', '缓存未命中次数', ['cache'])
+
+# ==================== 外部调用指标 ====================
+HTTP_REQUESTS = Counter(
+    'review_bot_http_requests_total', 'GitLab/LLM请求数（status为状态码或异常类型）', ['backend', 'status']
+)
+HTTP_SECONDS = Histogram(
+    'review_bot_http_request_seconds', 'GitLab/LLM请求耗时（秒）', ['backend']
+)
+HTTP_ERRORS = Counter(
+    'review_bot_http_errors_total', 'GitLab/LLM请求错误数（HTTP错误状态或网络异常）', ['backend', 'reason']
+)
+RETRIES = Counter(
+    'review_bot_retries_total', 'GitLab/LLM请求重试次数', ['backend', 'operation']
+)
+LLM_TOKENS = Counter(
+    'review_bot_llm_tokens_total', 'LLM消耗的token数', ['provider', 'kind']
+)
+LLM_FAILOVERS = Counter(
+    'review_bot_llm_failovers_total', 'LLM请求失败后切换端点重试的次数（reason为状态码或异常类型）', ['endpoint', 'reason']
+)
+LLM_ENDPOINT_UP = Gauge(
+    'review_bot_llm_endpoint_up', 'LLM端点是否可用（熔断中为0）', ['endpoint'], aggregate=False
+)
+
+
+def record_http(backend, status, seconds):
+    """记录一次外部请求：status为HTTP状态码或异常类型名"""
+    HTTP_REQUESTS.inc(backend=backend, status=status)
+    HTTP_SECONDS.observe(seconds, backend=backend)
+    if not isinstance(status, int) or status >= 400:
+        HTTP_ERRORS.inc(backend=backend, reason=status)
+
+
+def retry_wait(backend, operation, wait_ms):
+    """供retrying使用的wait_func：记录重试次数并固定等待wait_ms毫秒"""
+    def wait(attempt_number, delay_since_first_attempt_ms):
+        RETRIES.inc(backend=backend, operation=operation)
+        event('retry', backend=backend, operation=operation, attempt=attempt_number, wait_ms=wait_ms)
+        return wait_ms
+    return wait
+
+
+# 当前审查的token统计（审查线程及其中的asyncio任务共享）
+_current_review = contextvars.ContextVar('current_review', default=None)
+
+
+@contextmanager
+def review_scope(project_id):
+    """统计with块内（当前审查）各提供商消耗的token数"""
+    tokens = {}
+    token = _current_review.set(tokens)
+    try:
+        yield tokens
+    finally:
+        _current_review.reset(token)
+        for provider, count in tokens.items():
+            REVIEW_TOKENS.observe(count, project=project_id, provider=provider)
+
+
+def record_tokens(provider, prompt_tokens, completion_tokens):
+    """记录一次LLM调用的token用量"""
+    LLM_TOKENS.inc(prompt_tokens, provider=provider, kind='prompt')
+    LLM_TOKENS.inc(completion_tokens, provider=provider, kind='completion')
+    tokens = _current_review.get()
+    if tokens is not None:
+        tokens[provider] = tokens.get(provider, 0) + prompt_tokens + completion_tokens
+# @cursor end
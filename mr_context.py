@@ -0,0 +1,54 @@
+# @cursor start
+
+
+class MergeRequestContext:
+    """单次审查的MR上下文：MR信息、diff_refs和代码变更只获取一次，在各阶段间传递"""
+
+    def __init__(self, project_id, mr_iid, info, changes, gitlab_client=None):
+        self.project_id = project_id
+        self.mr_iid = mr_iid
+        self.info = info
+        self.changes = changes
+        self.gitlab_client = gitlab_client
+
+    @classmethod
+    def open(cls, gitlab_client, project_id, mr_iid):
+        """只获取MR信息，代码变更由 iter_changes 分页获取"""
+        info = gitlab_client.get_merge_request_info(project_id, mr_iid)
+        return cls(project_id, mr_iid, info, [], gitlab_client)
+
+    @classmethod
+    def load(cls, gitlab_client, project_id, mr_iid):
+        """获取MR信息和全部代码变更"""
+        context = cls.open(gitlab_client, project_id, mr_iid)
+        for _ in context.iter_changes():
+            pass
+        return context
+
+    def iter_changes(self, path_filter=None):
+        """
+        逐个文件返回代码变更（边分页下载边返回），同时收集到changes中供后续阶段使用
+        path_filter(new_path)为假的文件diff被截断时不重新计算
+        """
+        for change in self.gitlab_client.iter_merge_request_changes(
+                self.project_id, self.mr_iid, self.diff_refs, path_filter=path_filter):
+            self.changes.append(change)
+            yield change
+
+    @property
+    def diff_refs(self):
+        return self.info.get('diff_refs') or {}
+
+    @property
+    def head_sha(self):
+        return self.diff_refs.get('head_sha')
+
+    @property
+    def source_branch(self):
+        return self.info.get('source_branch', 'main')
+
+    @property
+    def content_ref(self):
+        """读取文件内容使用的ref：优先head_sha（内容不可变，可跨审查缓存）"""
+        return self.head_sha or self.source_branch
+# @cursor end
@@ -0,0 +1,92 @@
+# @cursor start
+"""
+审查阶段流水线：各阶段声明依赖，依赖完成即在线程池中并发执行（DAG），
+每个阶段的耗时记录到 review_bot_stage_seconds 指标和追踪span中
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metrics import STAGE_SECONDS
+from tracing import span, propagate
+
+logger = logging.getLogger(__name__)
+
+
+class StageFailedError(Exception):
+    """依赖的阶段失败，当前阶段未执行"""
+
+
+class Pipeline:
+    """按依赖关系并发执行的阶段集合；阶段函数的参数为各依赖阶段的结果（按声明顺序）"""
+
+    def __init__(self, name, max_workers=4):
+        self.name = name
+        self.max_workers = max_workers
+        self._stages = {}  # 阶段名 -> (函数, 依赖)
+        self.results = {}
+        self.errors = {}
+        self.timings = {}  # 阶段名 -> (相对流水线开始的启动时间, 耗时)，单位秒
+        self.elapsed = 0.0
+
+    def stage(self, name, function, deps=()):
+        """添加阶段；依赖必须已添加（保证无环）"""
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"阶段 {name} 的依赖 {dep} 未定义")
+        self._stages[name] = (function, tuple(deps))
+        return self
+
+    def result(self, name):
+        """阶段结果；阶段本身或其依赖失败时抛出对应异常"""
+        if name in self.errors:
+            raise self.errors[name]
+        return self.results[name]
+
+    def _execute(self, name, started):
+        function, deps = self._stages[name]
+        offset = time.perf_counter() - started
+        try:
+            with STAGE_SECONDS.time(stage=name), span(name):
+                return function(*(self.results[dep] for dep in deps))
+        finally:
+            self.timings[name] = (offset, time.perf_counter() - started - offset)
+
+    def run(self):
+        """执行所有阶段，返回自身；某阶段失败时其下游阶段不执行，记录为StageFailedError"""
+        started = time.perf_counter()
+        pending = dict(self._stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name) as executor:
+            while pending or running:
+                for name, (_, deps) in list(pending.items()):
+                    failed = [dep for dep in deps if dep in self.errors]
+                    if failed:
+                        error = StageFailedError(f"依赖阶段 {failed[0]} 失败: {self.errors[failed[0]]}")
+                        error.__cause__ = self.errors[failed[0]]
+                        self.errors[name] = error
+                        del pending[name]
+                    elif all(dep in self.results for dep in deps):
+                        running[executor.submit(propagate(self._execute), name, started)] = name
+                        del pending[name]
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as e:
+                        self.errors[name] = e
+        self.elapsed = time.perf_counter() - started
+        logger.info(f"{self.name} 阶段耗时: {self.report()}")
+        return self
+
+    def report(self):
+        """各阶段的启动时间和耗时，以及总耗时与各阶段耗时之和（并发节省的时间）"""
+        parts = [
+            f"{name} +{offset:.2f}s/{duration:.2f}s{'(失败)' if name in self.errors else ''}"
+            for name, (offset, duration) in sorted(self.timings.items(), key=lambda item: item[1][0])
+        ]
+        serial = sum(duration for _, duration in self.timings.values())
+        return f"{', '.join(parts)}; 总计 {self.elapsed:.2f}s（串行需 {serial:.2f}s）"
+# @cursor end
@@ -0,0 +1,74 @@
+# @cursor start
+"""
+审查进度评论：webhook收到请求时发布的"处理中"评论在审查过程中原地编辑（notes PUT接口），
+先展示已完成分块的结果，审查结束后替换为最终结果，每次审查只占用一条评论
+"""
+import logging
+import threading
+import time
+from config import REVIEW_PROGRESS_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressNote:
+    """原地编辑的进度评论；两次编辑至少间隔min_interval秒，间隔内的多次更新只发送最新内容"""
+
+    def __init__(self, gitlab_client, project_id, mr_iid, note_id, min_interval=REVIEW_PROGRESS_INTERVAL):
+        self.gitlab_client = gitlab_client
+        self.project_id = project_id
+        self.mr_iid = mr_iid
+        self.note_id = note_id
+        self.min_interval = min_interval
+        self.edits = 0
+        self._pending = None
+        self._timer = None
+        self._last_edit = 0.0
+        self._closed = False
+        self._lock = threading.Lock()  # 保护待发送内容和定时器
+        self._send_lock = threading.Lock()  # 保证编辑按顺序发送，最终结果不会被旧进度覆盖
+
+    def update(self, body):
+        """提交中间进度，不阻塞调用方（可在事件循环中调用），由后台定时器按速率限制发送"""
+        with self._lock:
+            if self._closed:
+                return
+            self._pending = body
+            if self._timer is not None:
+                return
+            delay = max(0.0, self._last_edit + self.min_interval - time.monotonic())
+            self._timer = threading.Timer(delay, self._flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush(self):
+        with self._send_lock:
+            with self._lock:
+                body, self._pending, self._timer = self._pending, None, None
+                if body is None or self._closed:
+                    return
+                self._last_edit = time.monotonic()
+            self._edit(body)
+
+    def finish(self, body):
+        """写入最终结果（同步）；编辑失败时改为发布新评论，保证结果可见"""
+        with self._lock:
+            self._closed = True
+            self._pending = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        with self._send_lock:
+            if self._edit(body):
+                return
+            self.gitlab_client.add_comment(self.project_id, self.mr_iid, body)
+
+    def _edit(self, body):
+        try:
+            self.gitlab_client.update_comment(self.project_id, self.mr_iid, self.note_id, body)
+        except Exception as e:
+            logger.warning(f"更新进度评论 {self.note_id} 失败: {e}")
+            return False
+        self.edits += 1
+        return True
+# @cursor end
@@ -0,0 +1,97 @@
+# @cursor start
+import re
+from config import AI_PROMPT_TOKEN_BUDGET, REVIEW_MAX_CHUNKS, REVIEW_PROMPT
+from diff_parser import parse_change
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # 未安装tiktoken时使用估算
+    _ENCODING = None
+
+CJK_PATTERN = re.compile(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+# 相关性较低的路径（测试、生成代码、第三方代码），排序时降权
+LOW_RELEVANCE_MARKERS = ('test', 'spec', 'mock', 'vendor', 'generated', 'third_party', '.min.')
+
+
+def estimate_tokens(text):
+    """估算文本token数：有tiktoken时精确计算，否则按中日韩字符1个、其余约4字符1个估算"""
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def relevance_score(change):
+    """文件相关性评分：变更行数越多越相关，测试/生成/第三方代码降权"""
+    parsed_diff = parse_change(change)
+    score = float(parsed_diff.added_count + parsed_diff.removed_count)
+    if change.get('new_file'):
+        score *= 1.2
+    path = (change.get('new_path') or '').lower()
+    if any(marker in path for marker in LOW_RELEVANCE_MARKERS):
+        score *= 0.3
+    return score
+
+
+class ReviewUnit:
+    """提示词中的一个片段：一个文件或大文件按块拆分后的一部分"""
+    __slots__ = ('file_path', 'text', 'tokens', 'score')
+
+    def __init__(self, file_path, text, score):
+        self.file_path = file_path
+        self.text = text
+        self.tokens = estimate_tokens(text)
+        self.score = score
+
+
+class PromptPlanner:
+    """按token预算把审查片段打包成多个提示词"""
+
+    def __init__(self, token_budget=AI_PROMPT_TOKEN_BUDGET, max_chunks=REVIEW_MAX_CHUNKS):
+        # 预算需扣除提示词模板本身
+        self.token_budget = max(1, token_budget - estimate_tokens(REVIEW_PROMPT))
+        self.max_chunks = max_chunks
+
+    def fits(self, text):
+        """文本是否能放入单个提示词"""
+        return estimate_tokens(text) <= self.token_budget
+
+    def truncate(self, text):
+        """将超出预算的文本截断到预算内"""
+        if self.fits(text):
+            return text
+        suffix = "\n... (内容过长，已截断)\n```\n"
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.fits(text[:mid] + suffix):
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low] + suffix
+
+    def plan(self, units):
+        """
+        按相关性从高到低首次适应装箱，返回 (chunks, dropped)
+        chunks: [[ReviewUnit]]，dropped: 超出分块数上限而未审查的片段
+        """
+        chunks = []
+        sizes = []
+        for unit in sorted(units, key=lambda u: u.score, reverse=True):
+            for i, size in enumerate(sizes):
+                if size + unit.tokens <= self.token_budget:
+                    chunks[i].append(unit)
+                    sizes[i] += unit.tokens
+                    break
+            else:
+                chunks.append([unit])
+                sizes.append(unit.tokens)
+        if self.max_chunks and len(chunks) > self.max_chunks:
+            dropped = [unit for chunk in chunks[self.max_chunks:] for unit in chunk]
+            return chunks[:self.max_chunks], dropped
+        return chunks, []
+# @cursor end
@@ -0,0 +1,238 @@
+# @cursor start
+"""
+LLM提供商端点池：按权重、实测延迟和错误率在多个端点间分配请求，
+端点超时或返回5xx/429时由调用方换端点重试；连续失败的端点熔断，冷却后放行一个试探请求
+"""
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from config import (
+    AI_PROVIDER, AI_API_URL, AI_API_KEY, AI_MODEL, AI_ENDPOINTS,
+    AI_BREAKER_FAILURES, AI_BREAKER_COOLDOWN
+)
+
+logger = logging.getLogger(__name__)
+
+# 需要换端点重试的HTTP状态码
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# 延迟、错误率滑动平均的平滑系数
+EWMA_ALPHA = 0.3
+# 错误率对路由分值的惩罚系数（错误率10%时分值约减半）
+ERROR_PENALTY = 10
+# 等待并发名额时的轮询间隔（秒）
+ACQUIRE_POLL_INTERVAL = 0.05
+# AI_ENDPOINTS中每个端点允许的字段
+ENDPOINT_FIELDS = ('name', 'provider', 'url', 'api_key', 'model', 'weight', 'max_concurrency')
+
+
+class Endpoint:
+    """一个提供商端点：请求格式由provider决定，并记录健康状态"""
+
+    def __init__(self, name, provider, url, api_key, model, weight=1.0, max_concurrency=0):
+        self.name = name
+        self.provider = provider
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+        self.weight = max(0.0, float(weight))
+        self.max_concurrency = int(max_concurrency)  # 0为不限制
+        self.latency = None  # 成功请求耗时的滑动平均（秒），流式请求为首字延迟
+        self.error_rate = 0.0  # 失败率的滑动平均
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0  # 熔断截止时间，0为未熔断
+        self.probing = False  # 冷却结束后是否已放行试探请求
+
+    def is_open(self, now):
+        return now < self.open_until
+
+    def is_available(self, now):
+        """未熔断，或冷却已结束且还没有试探请求"""
+        if self.open_until == 0.0:
+            return True
+        return not self.is_open(now) and not self.probing
+
+    def is_saturated(self):
+        return 0 < self.max_concurrency <= self.in_flight
+
+    def status(self, now):
+        if self.open_until == 0.0:
+            state = 'closed'
+        elif self.is_open(now):
+            state = 'open'
+        else:
+            state = 'half_open'
+        return {
+            'name': self.name,
+            'provider': self.provider,
+            'model': self.model,
+            'state': state,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'error_rate': round(self.error_rate, 3),
+            'in_flight': self.in_flight
+        }
+
+
+class ProviderPool:
+    """线程安全的端点池，同步审查线程和各审查的事件循环共享同一份健康状态"""
+
+    def __init__(self, endpoints, breaker_failures=AI_BREAKER_FAILURES, breaker_cooldown=AI_BREAKER_COOLDOWN):
+        if not endpoints:
+            raise ValueError("至少需要配置一个AI端点")
+        self.endpoints = endpoints
+        self.breaker_failures = max(1, breaker_failures)
+        self.breaker_cooldown = breaker_cooldown
+        self._condition = threading.Condition()
+
+    @property
+    def primary(self):
+        return self.endpoints[0]
+
+    @property
+    def model_key(self):
+        """已配置端点的 提供商:模型 集合，用作审查结果缓存键的一部分（任一端点更换模型后旧结果失效）"""
+        return ','.join(sorted({f"{e.provider}:{e.model}" for e in self.endpoints}))
+
+    def _score(self, endpoint, default_latency):
+        latency = endpoint.latency if endpoint.latency is not None else default_latency
+        return endpoint.weight / (latency * (1 + endpoint.in_flight) * (1 + ERROR_PENALTY * endpoint.error_rate))
+
+    def _try_acquire(self, exclude):
+        """
+        选择端点并占用一个并发名额，返回 (端点, 需等待的秒数)；需要等待并发名额时返回None
+
+        优先选择未尝试过的端点；全部尝试过时允许再次使用（单端点时即为重试）。
+        所有端点都在熔断中时仍选择最早恢复的一个，等待其冷却结束（最多breaker_cooldown秒），而不是直接让审查失败
+        """
+        now = time.time()
+        candidates = [e for e in self.endpoints if e.name not in exclude] or self.endpoints
+        healthy = [e for e in candidates if e.is_available(now)]
+        available = [e for e in healthy if not e.is_saturated()]
+        available = [e for e in available if e.weight > 0] or available
+        if healthy and not available:
+            # 可用端点只是并发已满，等待名额而不是去试探熔断中的端点
+            return None
+        if available:
+            # 没有测量数据的端点按已知最快的延迟估计，保证新端点能被探测到
+            measured = [e.latency for e in available if e.latency is not None]
+            default_latency = min(measured) if measured else 1.0
+            scores = [self._score(e, default_latency) for e in available]
+            endpoint = random.choices(available, weights=scores)[0] if sum(scores) > 0 else available[0]
+            delay = 0.0
+        else:
+            free = [e for e in candidates if not e.is_saturated()]
+            if not free:
+                return None
+            endpoint = min(free, key=lambda e: e.open_until)
+            delay = min(max(0.0, endpoint.open_until - now), self.breaker_cooldown)
+        if endpoint.open_until:
+            endpoint.probing = True
+        endpoint.in_flight += 1
+        return endpoint, delay
+
+    def acquire(self, exclude=()):
+        """同步获取端点，没有空闲并发名额时阻塞等待"""
+        with self._condition:
+            while True:
+                selected = self._try_acquire(exclude)
+                if selected is not None:
+                    return selected
+                self._condition.wait()
+
+    async def acquire_async(self, exclude=()):
+        """异步获取端点：轮询等待，不阻塞事件循环（占用名额的其他协程可能在同一循环中）"""
+        while True:
+            with self._condition:
+                selected = self._try_acquire(exclude)
+            if selected is not None:
+                return selected
+            await asyncio.sleep(ACQUIRE_POLL_INTERVAL)
+
+    def release(self, endpoint, latency=None, failure=None, retry_after=None):
+        """
+        归还并发名额并更新健康状态
+
+        latency不为None表示成功；failure为失败原因（状态码或异常类型）；两者都为None表示
+        与端点健康无关的失败（如请求参数错误），只归还名额
+        """
+        with self._condition:
+            endpoint.in_flight -= 1
+            was_probing = endpoint.probing
+            endpoint.probing = False
+            if latency is not None:
+                endpoint.latency = latency if endpoint.latency is None else \
+                    (1 - EWMA_ALPHA) * endpoint.latency + EWMA_ALPHA * latency
+                endpoint.error_rate *= 1 - EWMA_ALPHA
+                endpoint.consecutive_failures = 0
+                if endpoint.open_until:
+                    logger.info(f"AI端点 {endpoint.name} 已恢复")
+                endpoint.open_until = 0.0
+            elif failure is not None:
+                endpoint.error_rate = (1 - EWMA_ALPHA) * endpoint.error_rate + EWMA_ALPHA
+                endpoint.consecutive_failures += 1
+                cooldown = None
+                if retry_after is not None:
+                    cooldown = retry_after
+                elif was_probing or endpoint.consecutive_failures >= self.breaker_failures:
+                    cooldown = self.breaker_cooldown
+                if cooldown is not None:
+                    endpoint.open_until = max(endpoint.open_until, time.time() + cooldown)
+                    logger.warning(f"AI端点 {endpoint.name} 熔断 {cooldown:.0f} 秒: {failure}"
+                                   f"（连续失败 {endpoint.consecutive_failures} 次）")
+            self._condition.notify_all()
+
+    def status(self):
+        now = time.time()
+        with self._condition:
+            return [endpoint.status(now) for endpoint in self.endpoints]
+
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def load_endpoints(raw=AI_ENDPOINTS):
+    """解析AI_ENDPOINTS（JSON数组），未填写的字段使用通用AI配置；为空时只有通用配置这一个端点"""
+    default = {'provider': AI_PROVIDER, 'url': AI_API_URL, 'api_key': AI_API_KEY, 'model': AI_MODEL}
+    if not raw.strip():
+        return [Endpoint(AI_PROVIDER, **default)]
+    try:
+        items = json.loads(raw)
+    except ValueError as e:
+        raise ValueError(f"AI_ENDPOINTS不是有效的JSON: {e}")
+    if not isinstance(items, list) or not items:
+        raise ValueError("AI_ENDPOINTS必须是非空的JSON数组")
+    endpoints = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"AI_ENDPOINTS第 {index + 1} 项必须是JSON对象")
+        unknown = [key for key in item if key not in ENDPOINT_FIELDS]
+        if unknown:
+            raise ValueError(f"AI_ENDPOINTS第 {index + 1} 项包含未知字段: {', '.join(unknown)}"
+                             f"（可用字段: {', '.join(ENDPOINT_FIELDS)}）")
+        options = dict(default, **item)
+        name = options.pop('name', None) or f"{options['provider']}-{index + 1}"
+        if any(e.name == name for e in endpoints):
+            raise ValueError(f"AI_ENDPOINTS中端点名称重复: {name}")
+        endpoints.append(Endpoint(name, **options))
+    return endpoints
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_shared_pool():
+    """进程内共享的端点池（所有AIClient共享健康状态）"""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = ProviderPool(load_endpoints())
+        return _shared_pool
+# @cursor end
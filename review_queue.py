@@ -0,0 +1,412 @@
+# @cursor start
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import logging
+from metrics import ACTIVE_REVIEWS, REVIEW_JOBS, REVIEW_SECONDS
+from config import (
+    REVIEW_QUEUE_DB, REVIEW_WORKERS, REVIEW_QUEUE_MAX_PENDING,
+    REVIEW_QUEUE_MAX_PER_PROJECT, REVIEW_JOB_TIMEOUT, REVIEW_QUEUE_RETENTION_DAYS
+)
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+ATTACHED = 'attached'  # 合并到同一head_sha的进行中任务，等待其结果
+
+# 进程被重启时最多重新入队的次数，避免"毒任务"无限循环
+MAX_ATTEMPTS = 3
+# 清理过期任务记录的最小间隔（秒）
+PURGE_INTERVAL = 3600
+# 检查运行中任务租约（超时或持有进程已退出）的最小间隔（秒）
+RECOVER_INTERVAL = 60
+
+
+class QueueFullError(Exception):
+    """审查队列已满（背压）"""
+
+
+class ReviewQueue:
+    """基于SQLite的持久化审查任务队列，支持多进程共享"""
+
+    def __init__(self, db_path=REVIEW_QUEUE_DB, max_pending=REVIEW_QUEUE_MAX_PENDING,
+                 max_per_project=REVIEW_QUEUE_MAX_PER_PROJECT, max_running=REVIEW_WORKERS):
+        self.db_path = db_path
+        self.max_pending = max_pending
+        self.max_per_project = max_per_project
+        # 所有进程合计的运行中任务上限（每个gunicorn进程各有一组工作线程）
+        self.max_running = max_running
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    project_id TEXT NOT NULL,
+                    mr_iid INTEGER NOT NULL,
+                    trigger TEXT NOT NULL,
+                    payload TEXT,
+                    head_sha TEXT,
+                    parent_id INTEGER,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    result TEXT,
+                    reusable INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, ddl in (('head_sha', 'TEXT'), ('parent_id', 'INTEGER'),
+                                ('reusable', 'INTEGER NOT NULL DEFAULT 0')):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {ddl}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, project_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_revision ON jobs(project_id, mr_iid, head_sha)")
+
+    def _connect(self):
+        """每次操作独立连接，线程安全"""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, project_id, mr_iid, trigger, payload=None, head_sha=None, reuse=True):
+        """
+        任务入队，超过容量时抛出QueueFullError；reuse为False时（手动要求重新审查）不复用已结束的结果
+        返回 (job_id, mode)，mode: queued 新任务 / attached 合并到进行中任务 / reused 复用已有结果
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if head_sha:
+                    coalesced = self._coalesce(conn, project_id, mr_iid, trigger, payload, head_sha, reuse)
+                    if coalesced:
+                        conn.execute("COMMIT")
+                        return coalesced
+                pending = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ?", (PENDING,)
+                ).fetchone()[0]
+                if pending >= self.max_pending:
+                    raise QueueFullError(f"审查队列已满 ({pending}/{self.max_pending})")
+                project_pending = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ? AND project_id = ?",
+                    (PENDING, str(project_id))
+                ).fetchone()[0]
+                if project_pending >= self.max_per_project:
+                    raise QueueFullError(
+                        f"项目 {project_id} 待审查任务过多 ({project_pending}/{self.max_per_project})"
+                    )
+                job_id = self._insert(conn, project_id, mr_iid, trigger, payload, head_sha, PENDING)
+                conn.execute("COMMIT")
+                return job_id, 'queued'
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _coalesce(self, conn, project_id, mr_iid, trigger, payload, head_sha, reuse=True):
+        """
+        同一(project, MR, head_sha)已有任务时合并，不再重复审查
+        已结束的任务只复用完整成功的结果，reuse为False时只合并到进行中的任务
+        """
+        row = conn.execute(
+            "SELECT id, status FROM jobs "
+            "WHERE project_id = ? AND mr_iid = ? AND head_sha = ? AND parent_id IS NULL "
+            "AND (status IN (?, ?) OR (status = ? AND reusable = 1 AND ?)) ORDER BY id DESC LIMIT 1",
+            (str(project_id), mr_iid, head_sha, PENDING, RUNNING, DONE, int(reuse))
+        ).fetchone()
+        if row is None:
+            return None
+        if row['status'] == DONE:
+            # 已审查过的head_sha：排队一个只投递已有结果的轻量任务
+            job_id = self._insert(conn, project_id, mr_iid, trigger, payload, head_sha, PENDING, row['id'])
+            return job_id, 'reused'
+        job_id = self._insert(conn, project_id, mr_iid, trigger, payload, head_sha, ATTACHED, row['id'])
+        return job_id, 'attached'
+
+    def _insert(self, conn, project_id, mr_iid, trigger, payload, head_sha, status, parent_id=None):
+        cursor = conn.execute(
+            "INSERT INTO jobs (project_id, mr_iid, trigger, payload, head_sha, parent_id, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(project_id), mr_iid, trigger, json.dumps(payload or {}), head_sha, parent_id,
+             status, time.time())
+        )
+        return cursor.lastrowid
+
+    def claim(self):
+        """
+        领取下一个任务：优先分配给运行中任务最少的项目，保证项目间公平
+        所有进程的运行中任务达到max_running时不领取，返回None
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                running = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ?", (RUNNING,)
+                ).fetchone()[0]
+                if running >= self.max_running:
+                    conn.execute("COMMIT")
+                    return None
+                row = conn.execute("""
+                    SELECT j.* FROM jobs j
+                    WHERE j.status = ?
+                    ORDER BY (SELECT COUNT(*) FROM jobs r
+                              WHERE r.project_id = j.project_id AND r.status = ?), j.id
+                    LIMIT 1
+                """, (PENDING, RUNNING)).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = ?, owner = ?, started_at = ?, attempts = attempts + 1 "
+                    "WHERE id = ?",
+                    (RUNNING, self.owner, time.time(), row['id'])
+                )
+                parent = None
+                if row['parent_id'] is not None:
+                    parent = conn.execute(
+                        "SELECT status, result FROM jobs WHERE id = ?", (row['parent_id'],)
+                    ).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'] or '{}')
+        # 合并/复用的任务直接投递父任务的结果；只复用成功的结果，否则重新审查
+        job['reused_result'] = parent['result'] if parent and parent['status'] == DONE else None
+        return job
+
+    def update_payload(self, job_id, payload):
+        """更新任务附带的数据（如工作线程发布的处理中评论ID）"""
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET payload = ? WHERE id = ?", (json.dumps(payload), job_id))
+
+    def complete(self, job_id, result, reusable=True):
+        """标记任务完成；reusable为False（部分失败的结果）时不被之后的触发复用"""
+        self._finish(job_id, DONE, result, reusable)
+
+    def fail(self, job_id, error):
+        """标记任务失败"""
+        self._finish(job_id, FAILED, error)
+
+    def _finish(self, job_id, status, result, reusable=False):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, result = ?, reusable = ?, finished_at = ? WHERE id = ?",
+                    (status, result, int(reusable), time.time(), job_id)
+                )
+                self._release_attached(conn, job_id, status)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _release_attached(self, conn, job_id, status):
+        """
+        父任务结束后处理合并进来的任务：成功时转为待投递（复用结果）；
+        失败时不投递失败信息，最早的一个转为独立的待审查任务，其余改为合并到该任务
+        """
+        if status == DONE:
+            conn.execute(
+                "UPDATE jobs SET status = ? WHERE parent_id = ? AND status = ?",
+                (PENDING, job_id, ATTACHED)
+            )
+            return
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE parent_id = ? AND status = ? ORDER BY id LIMIT 1", (job_id, ATTACHED)
+        ).fetchone()
+        if row is None:
+            return
+        conn.execute("UPDATE jobs SET status = ?, parent_id = NULL WHERE id = ?", (PENDING, row['id']))
+        conn.execute(
+            "UPDATE jobs SET parent_id = ? WHERE parent_id = ? AND status = ?", (row['id'], job_id, ATTACHED)
+        )
+
+    def recover(self, timeout=REVIEW_JOB_TIMEOUT):
+        """重启后恢复：本机已退出进程或超时租约持有的运行中任务重新入队"""
+        now = time.time()
+        hostname = socket.gethostname()
+        recovered = 0
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT id, owner, started_at, attempts FROM jobs WHERE status = ?", (RUNNING,)
+                ).fetchall()
+                for row in rows:
+                    if not self._is_stale(row, hostname, now, timeout):
+                        continue
+                    if row['attempts'] >= MAX_ATTEMPTS:
+                        conn.execute(
+                            "UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                            (FAILED, "重试次数过多", now, row['id'])
+                        )
+                        self._release_attached(conn, row['id'], FAILED)
+                    else:
+                        conn.execute(
+                            "UPDATE jobs SET status = ?, owner = NULL WHERE id = ?", (PENDING, row['id'])
+                        )
+                        recovered += 1
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return recovered
+
+    def purge(self, retention_days=REVIEW_QUEUE_RETENTION_DAYS):
+        """
+        删除结束超过retention_days天的任务记录，返回删除数
+        保留每个 (项目, MR, head_sha) 最近一次可复用的审查（供重复触发复用），以及仍被待投递任务引用的父任务
+        """
+        if retention_days <= 0:
+            return 0
+        cutoff = time.time() - retention_days * 86400
+        with self._connect() as conn:
+            cursor = conn.execute("""
+                DELETE FROM jobs
+                WHERE status IN (?, ?) AND finished_at < ?
+                AND id NOT IN (SELECT MAX(id) FROM jobs
+                               WHERE status = ? AND reusable = 1 AND parent_id IS NULL AND head_sha IS NOT NULL
+                               GROUP BY project_id, mr_iid, head_sha)
+                AND id NOT IN (SELECT parent_id FROM jobs
+                               WHERE parent_id IS NOT NULL AND status IN (?, ?, ?))
+            """, (DONE, FAILED, cutoff, DONE, PENDING, RUNNING, ATTACHED))
+            return cursor.rowcount
+
+    def _is_stale(self, row, hostname, now, timeout):
+        """判断运行中任务的持有者是否已失效"""
+        if row['started_at'] is None or now - row['started_at'] > timeout:
+            return True
+        host, _, pid = (row['owner'] or '').rpartition(':')
+        if host != hostname or not pid.isdigit():
+            return False
+        if int(pid) == os.getpid():
+            return False
+        try:
+            os.kill(int(pid), 0)
+            return False
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+
+    def stats(self):
+        """按状态统计任务数"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+class ReviewScheduler:
+    """有界审查工作线程池，从持久化队列中消费任务"""
+
+    def __init__(self, queue, handler, workers=REVIEW_WORKERS, poll_interval=5.0):
+        self.queue = queue
+        # handler(job) -> str，返回审查结果（带complete属性且为False时不可复用）；job['reused_result']非空时直接投递
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._maintenance_lock = threading.Lock()
+        self._last_recover = time.time()  # start()中已恢复过一次
+        self._last_purge = 0.0
+
+    def start(self):
+        """恢复中断的任务并启动工作线程"""
+        if self._threads:
+            return
+        recovered = self.queue.recover()
+        if recovered:
+            logger.info(f"已恢复 {recovered} 个中断的审查任务")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"review-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """停止工作线程（运行中的任务会在重启后恢复）"""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, project_id, mr_iid, trigger, payload=None, head_sha=None, reuse=True):
+        """提交审查任务并唤醒空闲工作线程，返回 (job_id, mode)"""
+        job_id, mode = self.queue.enqueue(project_id, mr_iid, trigger, payload, head_sha, reuse)
+        if mode != 'attached':
+            self._wakeup.set()
+        return job_id, mode
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                job = self.queue.claim()
+            except sqlite3.Error as e:
+                logger.error(f"领取审查任务失败: {e}")
+                job = None
+            if job is None:
+                self._maintain()
+                # 其他进程入队的任务依靠轮询发现
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._wakeup.set()  # 可能还有更多任务，唤醒其他空闲线程
+            self._run_job(job)
+
+    def _maintain(self):
+        """
+        空闲时的队列维护（每个进程一个线程执行）：每RECOVER_INTERVAL秒把租约超时或持有进程已退出的
+        运行中任务重新入队（否则会一直占用全局运行上限），每PURGE_INTERVAL秒清理过期任务记录
+        """
+        if not self._maintenance_lock.acquire(blocking=False):
+            return
+        try:
+            now = time.time()
+            if now - self._last_recover >= RECOVER_INTERVAL:
+                self._last_recover = now
+                recovered = self.queue.recover()
+                if recovered:
+                    logger.info(f"已恢复 {recovered} 个租约失效的审查任务")
+                    self._wakeup.set()
+            if now - self._last_purge >= PURGE_INTERVAL:
+                self._last_purge = now
+                purged = self.queue.purge()
+                if purged:
+                    logger.info(f"已清理 {purged} 条过期审查任务记录")
+        except sqlite3.Error as e:
+            logger.error(f"审查队列维护失败: {e}")
+        finally:
+            self._maintenance_lock.release()
+
+    def _run_job(self, job):
+        ACTIVE_REVIEWS.inc()
+        start = time.perf_counter()
+        status = DONE
+        try:
+            result = self.handler(job)
+            self.queue.complete(job['id'], result, getattr(result, 'complete', True))
+        except Exception as e:
+            status = FAILED
+            logger.error(f"审查任务 {job['id']} 执行失败: {e}")
+            self.queue.fail(job['id'], str(e))
+        finally:
+            ACTIVE_REVIEWS.dec()
+            REVIEW_SECONDS.observe(time.perf_counter() - start, status=status)
+            REVIEW_JOBS.inc(status=status)
+# @cursor end
@@ -77,4 +77,10 @@ echo "🔗 Webhook地址: http://your-server-ip:8080/webhook"
 echo "📝 日志输出:"
 echo "----------------------------------------"
 
-python3 app.py 
\ No newline at end of file
+# 运行模式：production 使用gunicorn多进程，development 使用Flask开发服务器
+SERVER_MODE=$(python3 -c "from config import SERVER_MODE; print(SERVER_MODE)")
+if [ "$SERVER_MODE" = "development" ]; then
+    exec python3 app.py
+else
+    exec gunicorn -c gunicorn.conf.py app:app
+fi 
\ No newline at end of file
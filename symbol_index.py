@@ -0,0 +1,277 @@
+# @cursor start
+"""
+符号大纲索引：解析文件中的函数、类、方法所在行范围，用于把diff块的上下文扩展到所在的完整符号
+
+Python使用ast解析（语法错误时退回缩进扫描），其余REVIEW_FILE_TYPES使用轻量的花括号扫描；
+大纲只取决于文件内容，按git blob SHA缓存，内容未变的文件在之后的审查中直接复用；
+大纲中记录每个符号的token数和文件行数，命中缓存时无需下载完整文件即可确定上下文窗口
+"""
+import ast
+import json
+import os
+import re
+import threading
+from prompt_planner import estimate_tokens
+
+# 大纲格式或解析逻辑变化时递增，使旧缓存失效
+OUTLINE_VERSION = 2
+# 超过该大小（字节）的文件不下载完整内容、不解析大纲，使用固定行数窗口
+OUTLINE_MAX_FILE_BYTES = 512 * 1024
+
+# 部分Python版本的ast.parse在多线程并发调用时会出错（AST constructor recursion depth mismatch），解析时串行
+_ast_lock = threading.Lock()
+
+BRACE_EXTENSIONS = ('.js', '.jsx', '.ts', '.tsx', '.java', '.go', '.cpp', '.cc', '.h', '.hpp', '.c', '.php')
+
+# 花括号语言中不是声明的块（控制语句等）
+CONTROL_KEYWORDS = {
+    'if', 'for', 'foreach', 'while', 'switch', 'catch', 'else', 'elseif', 'do', 'try', 'finally', 'return',
+    'synchronized', 'using', 'lock', 'with', 'select', 'go', 'defer', 'new', 'typeof', 'sizeof', 'func', 'function'
+}
+GO_TYPE_DECLARATION = re.compile(r'\btype\s+([A-Za-z_]\w*)\s+(struct|interface)\b')
+ANNOTATION = re.compile(r'@[\w.]+(?:\([^()]*\))?')
+TYPE_DECLARATION = re.compile(r'\b(class|interface|struct|enum|trait|namespace|impl)\s+([A-Za-z_$][\w$]*)')
+ARROW_FUNCTION = re.compile(r'([A-Za-z_$][\w$]*)\s*[:=]\s*(?:async\s*)?(?:\([^()]*\)|[A-Za-z_$][\w$]*)\s*(?::[^=]+)?=>\s*$')
+CALL_LIKE = re.compile(r'([A-Za-z_$~][\w$]*)\s*\(')
+PYTHON_DEFINITION = re.compile(r'^(\s*)(?:async\s+def|def|class)\s+(\w+)')
+STRING_OR_COMMENT = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`(?:\\.|[^`\\])*`|//.*|/\*.*?\*/')
+
+
+class Symbol:
+    """一个符号：start/end为包含装饰器、注解在内的行范围，line为声明（名称）所在行，均从1开始；tokens为符号全文的token数"""
+    __slots__ = ('kind', 'name', 'start', 'end', 'line', 'tokens')
+
+    def __init__(self, kind, name, start, end, line=None, tokens=0):
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.end = end
+        self.line = line or start
+        self.tokens = tokens
+
+    @property
+    def label(self):
+        return f"{self.kind} {self.name}"
+
+
+def supports_outline(file_path):
+    ext = os.path.splitext(file_path or '')[1].lower()
+    return ext == '.py' or ext in BRACE_EXTENSIONS
+
+
+def build_outline(file_path, content):
+    """解析文件大纲，返回按起始行排序的Symbol列表；不支持的文件类型返回空列表"""
+    ext = os.path.splitext(file_path or '')[1].lower()
+    lines = content.splitlines()
+    if ext == '.py':
+        try:
+            with _ast_lock:
+                tree = ast.parse(content)
+            symbols = _python_outline(tree)
+        except (SyntaxError, ValueError, SystemError, RecursionError):
+            symbols = _indent_outline(lines)
+    elif ext in BRACE_EXTENSIONS:
+        symbols = _brace_outline(lines)
+    else:
+        return []
+    for symbol in symbols:
+        symbol.tokens = estimate_tokens('\n'.join(lines[symbol.start - 1:symbol.end]))
+    return sorted(symbols, key=lambda s: (s.start, -s.end))
+
+
+def dump_outline(symbols, line_count):
+    return json.dumps({
+        'line_count': line_count,
+        'symbols': [[s.kind, s.name, s.start, s.end, s.line, s.tokens] for s in symbols]
+    }, ensure_ascii=False)
+
+
+def load_outline(text):
+    """返回 (符号列表, 文件行数)"""
+    data = json.loads(text)
+    return [Symbol(*item) for item in data['symbols']], data['line_count']
+
+
+def _python_outline(tree):
+    symbols = []
+
+    def visit(node, prefix, parent_kind):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                if isinstance(child, ast.ClassDef):
+                    kind = 'class'
+                else:
+                    kind = 'method' if parent_kind == 'class' else 'function'
+                name = f"{prefix}{child.name}"
+                start = min([child.lineno] + [d.lineno for d in child.decorator_list])
+                symbols.append(Symbol(kind, name, start, child.end_lineno, child.lineno))
+                visit(child, f"{name}.", kind)
+            else:
+                visit(child, prefix, parent_kind)
+
+    visit(tree, '', None)
+    return symbols
+
+
+def _indent_outline(lines):
+    """按缩进划分def/class的范围：到下一个缩进不大于声明行的非空行为止"""
+    symbols = []
+    open_symbols = []  # (缩进, Symbol)
+    last_code_line = 0
+    for line_no, line in enumerate(lines, 1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        indent = len(line) - len(line.lstrip())
+        while open_symbols and indent <= open_symbols[-1][0]:
+            open_symbols.pop()[1].end = last_code_line
+        match = PYTHON_DEFINITION.match(line)
+        if match:
+            start = line_no
+            while start > 1 and lines[start - 2].strip().startswith('@'):
+                start -= 1
+            prefix = '.'.join(s.name.rsplit('.', 1)[-1] for _, s in open_symbols)
+            kind = 'class' if stripped.startswith('class') else ('method' if open_symbols else 'function')
+            symbol = Symbol(kind, f"{prefix}.{match.group(2)}" if prefix else match.group(2), start, line_no, line_no)
+            symbols.append(symbol)
+            open_symbols.append((indent, symbol))
+        last_code_line = line_no
+    for _, symbol in open_symbols:
+        symbol.end = last_code_line
+    return symbols
+
+
+def _declaration(header):
+    """根据 { 之前的语句判断块是否为声明，返回 (类型, 名称) 或None"""
+    header = ' '.join(ANNOTATION.sub(' ', header).split())
+    if not header or header.endswith(('=', ',', '(', '[', 'return')):
+        return None  # 对象字面量、初始化列表等
+    match = ARROW_FUNCTION.search(header)
+    if match:
+        return 'function', match.group(1)
+    first_word = re.match(r'[\w$]*', header).group(0)
+    if first_word in CONTROL_KEYWORDS - {'func', 'function'}:
+        return None
+    match = GO_TYPE_DECLARATION.search(header)
+    if match:
+        return match.group(2), match.group(1)
+    match = TYPE_DECLARATION.search(header)
+    if match and '(' not in header[:match.start()]:
+        return match.group(1), match.group(2)
+    if header.count('(') != header.count(')') or '=>' in header:
+        return None  # 回调参数中的匿名函数
+    for match in CALL_LIKE.finditer(header):
+        name = match.group(1)
+        if name not in CONTROL_KEYWORDS:
+            if '=' in header[:match.start()].replace('==', ''):
+                return None
+            return 'function', name
+    return None
+
+
+def _brace_outline(lines):
+    """
+    扫描花括号配对：{ 之前的语句（上一个 ; { } 之后的内容）像函数或类型声明时，记录到匹配的 } 为止的范围
+    忽略字符串和注释中的括号，不处理跨行字符串等少见情况
+    """
+    symbols = []
+    stack = []  # 每个未闭合的 { 对应的Symbol，非声明块为None
+    pending = []  # 当前语句的 (行号, 代码片段)
+    in_block_comment = False
+    for line_no, line in enumerate(lines, 1):
+        code = line
+        if in_block_comment:
+            end = code.find('*/')
+            if end < 0:
+                continue
+            code = code[end + 2:]
+            in_block_comment = False
+        code = STRING_OR_COMMENT.sub(lambda m: '' if m.group(0).startswith('/') else '""', code)
+        start = code.find('/*')
+        if start >= 0:
+            code = code[:start]
+            in_block_comment = True
+        if code.lstrip().startswith('#'):
+            pending = []  # C预处理指令、PHP注释
+            continue
+        segment_start = 0
+        for index, char in enumerate(code):
+            if char not in '{};':
+                continue
+            piece = code[segment_start:index]
+            segment_start = index + 1
+            if char == '{':
+                header = pending + [(line_no, piece)]
+                declaration = _declaration(' '.join(text for _, text in header))
+                symbol = None
+                if declaration is not None:
+                    kind, name = declaration
+                    name_line = next((n for n, text in header if re.search(rf'(?<![\w$]){re.escape(name)}(?![\w$])', text)),
+                                     line_no)
+                    start = name_line
+                    # 向上包含紧邻的注解/装饰器行
+                    while start > 1 and lines[start - 2].strip().startswith('@'):
+                        start -= 1
+                    parents = [s for s in stack if s is not None]
+                    if parents and kind == 'function' and parents[-1].kind in ('class', 'interface', 'struct', 'trait', 'impl'):
+                        kind = 'method'
+                    qualified = '.'.join([p.name.rsplit('.', 1)[-1] for p in parents[-1:]] + [name])
+                    symbol = Symbol(kind, qualified, start, line_no, name_line)
+                stack.append(symbol)
+            elif char == '}' and stack:
+                symbol = stack.pop()
+                if symbol is not None:
+                    symbol.end = line_no
+                    symbols.append(symbol)
+            pending = []
+        rest = code[segment_start:]
+        if rest.strip():
+            pending.append((line_no, rest))
+    return symbols
+
+
+def enclosing_symbol(outline, start, end):
+    """包含 [start, end] 的最内层符号，没有时返回None"""
+    best = None
+    for symbol in outline:
+        if symbol.start > start:
+            break
+        if symbol.end >= end and (best is None or symbol.end - symbol.start <= best.end - best.start):
+            best = symbol
+    return best
+
+
+def symbol_windows(outline, hunks, line_count, context_lines, max_tokens):
+    """
+    计算各diff块的上下文窗口：扩展到所在的最内层符号（不超过max_tokens）；
+    没有所在符号时使用前后context_lines行，符号过大时使用前后context_lines行并附带符号的声明行
+    重叠或相邻的窗口合并，返回 [(start, end, [DiffHunk], [符号标签])]，按起始行升序
+    """
+    ranges = []
+    for hunk in hunks:
+        window = (max(1, hunk.new_start - context_lines), min(line_count, hunk.new_end + context_lines))
+        symbol = enclosing_symbol(outline, hunk.new_start, hunk.new_end)
+        if symbol is None:
+            ranges.append((window[0], window[1], hunk, None))
+            continue
+        if symbol.tokens <= max_tokens:
+            ranges.append((symbol.start, symbol.end, hunk, symbol.label))
+            continue
+        ranges.append((max(window[0], symbol.start), min(window[1], symbol.end), hunk, symbol.label))
+        if symbol.line < window[0]:
+            ranges.append((symbol.line, symbol.line, hunk, None))
+    windows = []
+    for start, end, hunk, label in sorted(ranges, key=lambda r: r[0]):
+        if start > end:
+            continue
+        if windows and start <= windows[-1][1] + 1:
+            prev_start, prev_end, prev_hunks, prev_labels = windows[-1]
+            windows[-1] = (prev_start, max(prev_end, end), prev_hunks, prev_labels)
+        else:
+            windows.append((start, end, [], []))
+        if hunk not in windows[-1][2]:
+            windows[-1][2].append(hunk)
+        if label is not None and label not in windows[-1][3]:
+            windows[-1][3].append(label)
+    return windows
+# @cursor end
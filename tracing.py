@@ -0,0 +1,198 @@
+# @cursor start
+"""
+单次审查的追踪：审查内的GitLab请求、LLM调用和重试记录为带起止时间的span，
+审查结束后写入本地文件（JSON Lines 或 Chrome trace 格式，可用 chrome://tracing / Perfetto 打开），无需采集服务
+"""
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from config import TRACE_DIR, TRACE_FORMAT, TRACE_MAX_FILES
+
+logger = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """一个计时区间；attrs记录状态码、字节数等属性"""
+    __slots__ = ('span_id', 'parent_id', 'name', 'start', 'end', 'thread', 'attrs')
+
+    def __init__(self, span_id, parent_id, name, attrs):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.end = None
+        self.thread = threading.current_thread().name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self, trace_id):
+        return {
+            'trace_id': trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'end': self.end,
+            'duration_ms': round((self.end - self.start) * 1000, 3),
+            'thread': self.thread,
+            'attrs': self.attrs
+        }
+
+
+class _NoopSpan:
+    """不在审查追踪内时使用，忽略所有属性"""
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """一次审查的所有span"""
+
+    def __init__(self, trace_id, attrs):
+        self.trace_id = trace_id
+        self.attrs = attrs
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def new_span(self, name, attrs):
+        parent = _current_span.get()
+        return Span(next(self._ids), parent.span_id if parent is not None else None, name, attrs)
+
+    def finish(self, span):
+        span.end = time.time()
+        with self._lock:
+            self.spans.append(span)
+
+    def to_jsonl(self):
+        return ''.join(json.dumps(span.to_dict(self.trace_id), ensure_ascii=False) + '\n' for span in self.spans)
+
+    def to_chrome(self):
+        """Chrome trace事件格式（ph=X 完整事件，ts/dur单位为微秒）"""
+        pid = os.getpid()
+        events = [{
+            'name': 'process_name', 'ph': 'M', 'pid': pid,
+            'args': {'name': f"review {self.trace_id}"}
+        }]
+        thread_ids = {}
+        for span in self.spans:
+            if span.thread not in thread_ids:
+                thread_ids[span.thread] = len(thread_ids) + 1
+                events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_ids[span.thread],
+                    'args': {'name': span.thread}
+                })
+            events.append({
+                'name': span.name,
+                'cat': span.name.split(' ', 1)[0],
+                'ph': 'X',
+                'ts': int(span.start * 1e6),
+                'dur': max(1, int((span.end - span.start) * 1e6)),
+                'pid': pid,
+                'tid': thread_ids[span.thread],
+                'args': dict(span.attrs, span_id=span.span_id, parent_id=span.parent_id)
+            })
+        return json.dumps({'traceEvents': events, 'otherData': dict(self.attrs, trace_id=self.trace_id)},
+                          ensure_ascii=False)
+
+
+@contextmanager
+def trace(trace_id, **attrs):
+    """开启一次审查的追踪，结束时写入文件；已在追踪中时不重复开启"""
+    if _current_trace.get() is not None or not TRACE_DIR:
+        yield _current_trace.get()
+        return
+    current = Trace(str(trace_id), attrs)
+    trace_token = _current_trace.set(current)
+    try:
+        with span('review', **attrs):
+            yield current
+    finally:
+        _current_trace.reset(trace_token)
+        try:
+            export(current)
+        except OSError as e:
+            logger.warning(f"写入追踪文件失败: {e}")
+
+
+@contextmanager
+def span(name, **attrs):
+    """记录with块为当前追踪中的一个span，不在追踪中时不记录"""
+    current = _current_trace.get()
+    if current is None:
+        yield NOOP_SPAN
+        return
+    item = current.new_span(name, attrs)
+    token = _current_span.set(item)
+    try:
+        yield item
+    except BaseException as e:
+        item.set(error=type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.finish(item)
+
+
+def event(name, **attrs):
+    """记录瞬时事件（如重试）"""
+    current = _current_trace.get()
+    if current is None:
+        return
+    item = current.new_span(name, attrs)
+    current.finish(item)
+
+
+def propagate(function):
+    """包装在线程池中执行的函数，使其继承调用方的追踪上下文"""
+    context = contextvars.copy_context()
+
+    def wrapper(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return wrapper
+
+
+def export(current):
+    """按TRACE_FORMAT写入 TRACE_DIR/<trace_id>.jsonl 或 .json，并只保留最近TRACE_MAX_FILES个文件"""
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    safe_id = ''.join(c if c.isalnum() or c in '-_' else '_' for c in current.trace_id)
+    if TRACE_FORMAT == 'chrome':
+        path = os.path.join(TRACE_DIR, f"{safe_id}.json")
+        content = current.to_chrome()
+    else:
+        path = os.path.join(TRACE_DIR, f"{safe_id}.jsonl")
+        content = current.to_jsonl()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    _prune(TRACE_DIR, TRACE_MAX_FILES)
+    return path
+
+
+def _prune(directory, max_files):
+    if max_files <= 0:
+        return
+    entries = [os.path.join(directory, name) for name in os.listdir(directory)]
+    if len(entries) <= max_files:
+        return
+    entries.sort(key=lambda path: os.path.getmtime(path))
+    for path in entries[:len(entries) - max_files]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+# @cursor end